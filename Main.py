@@ -1,40 +1,122 @@
-import numpy as np
-import pandas as pd
-import matplotlib.pyplot as plt
-import pickle
+import logging
+import os
 import streamlit as st
 import helper.utils as ut
 import helper.interventions as interv
-import shap
-import json
+import helper.fall_events as fe
+import helper.artifacts as art
+import helper.telemetry as tm
+import helper.result_store as rs
+import helper.memory_accounting as ma
 from streamlit_configuration import page_config as pc
+# numpy, pandas, sklearn (unpickling of the model), matplotlib and shap are imported on the first submit,
+# so they do not delay the first paint of the page. See 'benchmarks/cold_start.py'.
 # import time
 
 # Page configuration
 pc.streamlit_page_config()
 
-# Deserializing serialized data
+# Model version that serves the predictions (see helper/model_registry.py). Its arrays come from the versioned,
+# memory-mapped artifact bundle (see helper/artifact_bundle.py); a new bundle is warmed up in the background and
+# swapped in for the next submits, without a restart. EPIF_MODEL_POLL_SECONDS sets how often the bundle is checked
+# (0 disables the reload). A corrupted bundle, or one exported from other pickles, stops the app at startup
 @st.cache_resource
-def load_model():
-  with open('./model/clf_pipeline.pkl', 'rb') as model_file:
-    return pickle.load(model_file)
+def load_model_registry():
+  import helper.model_registry as mr
+  registry = mr.ModelRegistry()
+  return registry.start(float(os.environ.get('EPIF_MODEL_POLL_SECONDS', mr.DEFAULT_POLL_SECONDS)))
 
+# Predictions and explanations keyed on the input vector and the model artifacts.
+# Set EPIF_CACHE_DIR to keep them on disk as well, shared by every server process.
 @st.cache_resource
-def load_shap_explainer():
-  with open('./model/shap_explainer.pkl', 'rb') as shap_explainer_file:
-    return pickle.load(shap_explainer_file)
-    
+def load_explanation_cache():
+  import helper.explanation_cache as ec
+  return ec.ExplanationCache(directory=os.environ.get('EPIF_CACHE_DIR'))
+
+@st.cache_resource
+def load_waterfall_renderer():
+  import helper.rendering as rd
+  return rd.WaterfallRenderer()
+
 @st.cache_resource
 def load_columns_types():
-  with open('./data/columns_types.pkl', 'rb') as columns_types_file:
-    return pickle.load(columns_types_file)
+  return load_model_registry().current().bundle.columns_types
+
+# Ranges, steps and required fields of the model's features, shared with the batch paths
+@st.cache_resource
+def load_input_schema():
+  import helper.input_schema as ins
+  return ins.build_schema(load_columns_types())
+
+# Structured logs of the timing spans and the Prometheus export of their histograms (see helper/telemetry.py).
+# Returns the metrics file (EPIF_METRICS_FILE) or None
+@st.cache_resource
+def load_metrics_exporter():
+  tm.configure_logging()
+  if os.environ.get('EPIF_METRICS_PORT'):
+    tm.REGISTRY.serve(int(os.environ['EPIF_METRICS_PORT']))
+  return os.environ.get('EPIF_METRICS_FILE')
+
+# Finished predictions of the session, keyed on the hash of their inputs. A session keeps at most
+# EPIF_SESSION_MAX_RESULTS results, and no more than EPIF_SESSION_MAX_MB of them (the last one is always kept)
+SESSION_MAX_RESULTS = int(os.environ.get('EPIF_SESSION_MAX_RESULTS', rs.DEFAULT_MAXSIZE))
+SESSION_MAX_BYTES = float(os.environ.get('EPIF_SESSION_MAX_MB', ma.DEFAULT_SESSION_MAX_MB)) * 2**20
+
+def session_result_store():
+  if 'result_store' not in st.session_state:
+    st.session_state.result_store = rs.ResultStore(SESSION_MAX_RESULTS)
+  return st.session_state.result_store
+
+# Bytes retained by the sessions of the process (see helper/memory_accounting.py)
+@st.cache_resource
+def load_session_ledger():
+  return ma.SessionLedger()
+
+# Bytes retained by the shared caches, sized in a background thread every EPIF_MEMORY_MONITOR_SECONDS seconds: the
+# model again only after a swap, the intervention table and the input schema only once. Started once a prediction
+# is drawn, when every cache is loaded
+@st.cache_resource
+def load_memory_monitor():
+  registry = load_model_registry()
+  monitor = ma.MemoryMonitor(
+    caches={
+      'model': registry,
+      'explanation_cache': load_explanation_cache(),
+      'waterfall_renderer': load_waterfall_renderer(),
+      'interventions': load_intervention_table(),
+      'input_schema': load_input_schema(),
+    },
+    versions={'model': lambda: registry.current().digest, 'interventions': lambda: None, 'input_schema': lambda: None},
+    ledger=load_session_ledger()
+  )
+  return monitor.start(float(os.environ.get('EPIF_MEMORY_MONITOR_SECONDS', ma.DEFAULT_MONITOR_SECONDS)))
+
+def account_memory(model_version):
+  """ Bound the results of the session to SESSION_MAX_BYTES and record the bytes retained by its session state """
+  from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+  # The shared objects the results reference are counted as caches (see load_memory_monitor), not in the session
+  shared = [load_model_registry(), load_explanation_cache(), model_version, model_version.scorer, model_version.explainer]
+  results = session_result_store()
+  results_bytes = ma.bound_results(results, SESSION_MAX_BYTES, shared)
+  sizes = {key: ma.deep_sizeof(st.session_state[key], shared) for key in st.session_state if key != 'result_store'}
+  sizes['result_store'] = results_bytes
+
+  ctx = get_script_run_ctx()
+  load_session_ledger().record(ctx.session_id if ctx is not None else 'unknown', sizes)
+  tm.log_event('session_memory', session_bytes=sum(sizes.values()), results=len(results))
 
 # Load interventions data
 @st.cache_resource
 def load_intervention_data():
   """ Return the intervention data """
-  with open('./data/interventions.json', 'r', encoding="utf-8") as interventions_file:
-    return json.load(interventions_file)
+  return art.load_intervention_data()
+
+# Intervention sections of every (profile, fall location) pair
+@st.cache_resource
+def load_intervention_table():
+  import helper.intervention_rules as ir
+  return ir.DecisionTable(load_intervention_data())
 
 
 # https://docs.streamlit.io/develop/api-reference/widgets/st.number_input
@@ -51,9 +133,6 @@ def functional_test_input(label, min, max, step, numeric_format, help_name):
   )
 
 
-# Call serialized data structures
-model = load_model()
-
 # -- Streamlit app --
 header = st.container()
 
@@ -82,71 +161,54 @@ with header:
   st.space()
 
 
-# Validation of each input field of the header section
+# Validation of the inputs of the form, against the input schema of the model (see helper/input_schema.py)
 # Returns the message of the error. If there is no error then return empty string
-def input_validation(widget_names: list) -> str:
-    non_prop_columns = numerical_columns + ordinal_columns + binary_columns
-    prop_columns = [column for column in widget_names if column not in non_prop_columns]
+def input_validation(user_inputs: dict, falls_no: int) -> str:
+    import helper.input_schema as ins
+
+    card_fields = ins.fall_card_fields(falls_no)
+    schema = load_input_schema().with_fields(card_fields)
+
+    # The form counts an unanswered Yes/No field as 0 ('No'), the schema must see it empty
+    form = dict(user_inputs)
+    form.update({col: None for col in binary_columns if st.session_state.get(col) is None})
+    form.update({field.name: st.session_state.get(field.name) for field in card_fields})
+    report = schema.validate(form)
+
+    # Unfilled fields, grouped by fall case (col name example: {label}_fall_{fall_index}) and Yes/No fields
+    fall_index_labels_error = {i: [] for i in range(1, falls_no + 1)}
+    binary_labels_error = []
+    invalid_errors = []
+    for _, name, message in report.errors():
+      field = schema.fields.get(name)
+      label = field.label if field is not None else name
+      if message != ins.MISSING_MESSAGE:
+        invalid_errors.append(f"Field '{label}' {message}.")
+      elif field.kind == ins.CATEGORICAL:
+        fall_index_labels_error[int(name.rsplit('_', 1)[1])].append(label)
+      else:
+        binary_labels_error.append(label)
 
     errors = []
-    msg = ''
-    # Checking if there is any 'key' that it doesn't exist in the widget_names list
-    try:
-      for key in non_prop_columns + prop_columns:
-        if key in ('HospitalAdmissions', 'HospDays_min'): # The two features names are handled by an aggregated use, based on 'hospital_days_no' variable
-          break
-        if key not in st.session_state:
-          errors.append(f"st.session_state has no key named '{key}'. ")
-      if len(errors) != 0:
-        raise ValueError(', '.join(errors))
-    except ValueError as e:
-      print(f'{e}\n\n Did you forget to initialize the key/s?')
-
-    # Validating each input field value of prop fields
-    fall_related_errors = []
-    for i in range(1, falls_no + 1):
-      fall_index_columns = [col for col in prop_columns if col.endswith(f"{i}")]
-      # print('fall_index_columns', fall_index_columns)
-      fall_index_labels_error = []
-      for col in fall_index_columns:
-        if type(col) in (int, float):
-          # The column corresponds to a numeric input field which is already handled by the streamlit input field.
-          break
-        if st.session_state[col] is (None):
-          # col name example : {label}_fall_{fall_index}'
-          label, _, fall_index = col.split(sep='_')
-          fall_index_labels_error.append(label)
-
-      # Join every unfilled input into a list
-      label_errors = ", ".join(f"'{x}'" for x in fall_index_labels_error)
-      
-      # Append error message
-      if (len(fall_index_labels_error) == 1):
+    for i, labels in fall_index_labels_error.items():
+      label_errors = ", ".join(f"'{x}'" for x in labels)
+      if len(labels) == 1:
         errors.append(f"In fall case {i}, the {label_errors} field must be filled.")
-      elif (len(fall_index_labels_error) > 0):
+      elif len(labels) > 0:
         errors.append(f"In fall case {i}, fields {label_errors} must be filled.")
 
-  # Validating each input field value of binary fields
-    fall_binary_input_error = []
-    for col in binary_columns:
-      if st.session_state[col] is (None):
-        # col name example : has_{binary_feature}
-        _, label = col.split(sep='_')
-        fall_binary_input_error.append(label)
-    
-    # Join every unfilled input into a list
-    binary_labels_errors = ", ".join(f"'{x}'" for x in fall_binary_input_error)
-    
-    # Append error message
-    if (len(binary_labels_errors) == 1):
+    binary_labels_errors = ", ".join(f"'{x}'" for x in binary_labels_error)
+    if len(binary_labels_error) == 1:
       errors.append(f"Field {binary_labels_errors} must be filled.")
-    elif (len(binary_labels_errors) > 0):
+    elif len(binary_labels_error) > 0:
       errors.append(f"Fields {binary_labels_errors} must be filled.")
 
     # Format precisely the error message
-    if errors: 
-      # The list called 'errors' is not empty
-      msg = f"You must fill every input field:\n\n {"  \n".join(errors)}"
+    msg = ''
+    if errors:
+      msg = f"You must fill every input field:\n\n {"  \n".join(errors + invalid_errors)}"
+    elif invalid_errors:
+      msg = f"Invalid input field/s:\n\n {"  \n".join(invalid_errors)}"
     return msg
 
 
@@ -164,315 +226,479 @@ activity_columns = {
   'PhysicalActivity': ['None', 'Walk', 'Intensive (i.e. Workout, Dance, Bike)']
 }
 
+# What-if curves: {feature: label of its tab}
+SWEEP_LABELS = {
+  'TUG_Score': 'TUG',
+  'BBS_Score': 'BBS',
+  'FICSIT4_Score': 'FICSIT-4',
+  'ShortFESI_Score': 'Short FES-I',
+  'PillsPerDay': 'Pills Per Day',
+  'PhysicalActivity': 'Physical Activity',
+  'Age': 'Age'
+}
 
-# -- NON PREDICTION SECTION --
-
-st.caption('The fields below, does not impact the model prediction')
-general_info_cols = st.columns(2)
-
-with general_info_cols[0]:
-  falls_no = st.slider(
-    'How many falls occured the last 12 months?',
-    min_value=1,
-    max_value=5,
-    value=1,
-    step=1,
-    key='falls_no',
-    help='Please select the number of fall incidents of the elder. The field affects the number of fall incident cases that will be drawn below'
-  )
-
-if(falls_no == 1):
-  location_options = ['Indoor', 'Outdoor']
-else:
-  location_options = ['Indoor', 'Outdoor', 'Both']
-
-with general_info_cols[1]:
-  fall_location = st.selectbox(
-    label='Fall location',
-    options=location_options,
-    # default='Inside',
-    index=0,
-    key='fall_location',
-    width='stretch',
-    help='The field is used to inform appropriate personalised interventions'
-  )
-
+# SHAP explanations are computed at once when their budget is small, otherwise they show a first estimate that is
+# refined in the background (see helper/anytime_shap.py).
+# EPIF_SHAP_MAX_EVALS sets their evaluation budget, EPIF_SHAP_DEADLINE the seconds after which the refinement stops
+SHAP_MAX_EVALS = int(os.environ['EPIF_SHAP_MAX_EVALS']) if os.environ.get('EPIF_SHAP_MAX_EVALS') else None
+SHAP_DEADLINE = float(os.environ['EPIF_SHAP_DEADLINE']) if os.environ.get('EPIF_SHAP_DEADLINE') else None
+SHAP_REFRESH_SECONDS = 0.5 # Redraw period of the waterfall plots while their estimate is refined
+
+
+# The page is split into fragments, so an interaction only reruns the part of the page it belongs to:
+#   header          -- static, drawn on full reruns only
+#   patient_section -- fall count, fall location and the prediction form (the fall cards depend on the
+#                      count, so they rerun along with it). A submit stores the prediction and reruns the app
+#   results_section -- draws the stored prediction of the current inputs (session_result_store). Its waterfall
+#                      plots are redrawn on a timer while a large SHAP budget is refined (explanation_section)
+# When a rerun of the inputs changes what the results panel shows (other inputs, other fall location), the
+# app is rerun as well, and the panel is redrawn from the store, without calling the model.
+# The run time of each fragment is recorded as a span (see benchmarks/reruns.py).
+@st.fragment
+@tm.span('fragment_patient_section')
+def patient_section():
+  # -- NON PREDICTION SECTION --
+
+  st.caption('The fields below, does not impact the model prediction')
+  general_info_cols = st.columns(2)
+
+  with general_info_cols[0]:
+    falls_no = st.slider(
+      'How many falls occured the last 12 months?',
+      min_value=1,
+      max_value=ut.max_falls,
+      value=1,
+      step=1,
+      key='falls_no',
+      help='Please select the number of fall incidents of the elder. The field affects the number of fall incident cases that will be drawn below'
+    )
 
-# -- PREDICTION section --
+  if(falls_no == 1):
+    location_options = ['Indoor', 'Outdoor']
+  else:
+    location_options = ['Indoor', 'Outdoor', 'Both']
+
+  with general_info_cols[1]:
+    fall_location = st.selectbox(
+      label='Fall location',
+      options=location_options,
+      # default='Inside',
+      index=0,
+      key='fall_location',
+      width='stretch',
+      help='The field is used to inform appropriate personalised interventions'
+    )
 
-CATEGORICAL_PROPORTIONAL_WEIGHT = 0.2 # The weight of the proportional features of the dataset
 
-st.space(size="medium")
-with st.form("model_fields_form", border=False):
-  st.header('Predict patient profile')
-  st.divider()
+  # -- PREDICTION section --
 
-  # model[0] -> StandardScaler
-  # model[1] -> SVC model
-  user_inputs = {k:None for k in model[0].get_feature_names_out()}
-  # print(user_inputs)
+  st.space(size="medium")
+  with st.form("model_fields_form", border=False):
+    st.header('Predict patient profile')
+    st.divider()
 
-  st.caption('Demographic')
-  user_inputs['Age'] = st.number_input(
-    label='Age',
-    min_value=65,
-    max_value=80,
-    step=1,
-    key='Age')
+    # Every feature of the model. They are ordered as model[0].get_feature_names_out() on submit
+    user_inputs = {k:None for k in numerical_columns + ordinal_columns + binary_columns + prop_columns}
+    # print(user_inputs)
 
-  st.space()
-  st.caption('Health Status')
-  
-  user_inputs['PillsPerDay'] = st.slider(
-    label='Pills Per Day',
-    min_value=0,
-    max_value=5,
-    step=1,
-    key='PillsPerDay')
-
-  clinical_cols = st.columns(2)
-  for i, (col, model_col) in enumerate(zip(health_status_columns, binary_columns)):
-    target_col = 0 if i%2==0 else 1
-    if 'Blood Test' in col:
-      placehldr = f'Does the faller have regular blood check-ups?'
-    else:
-      placehldr = f'Does the faller have {col}?'
-    with clinical_cols[target_col]:
-      selected = st.selectbox(
-        label=col,
-        placeholder=placehldr,
-        options=['No', 'Yes'],     
-        index=None,
-        key=model_col)
-      user_inputs[model_col] = 1 if selected == 'Yes' else 0
-
-  phys_activ_selected = st.selectbox(
-    label='Physical Activity',
-    options=activity_columns['PhysicalActivity'],
-    index=0,
-    key='PhysicalActivity')
-  user_inputs['PhysicalActivity'] = activity_columns['PhysicalActivity'].index(phys_activ_selected) + 1 # Increment by 1 because: the values of the corresponding feature are in the form of: 1,2,3
+    st.caption('Demographic')
+    user_inputs['Age'] = st.number_input(
+      label='Age',
+      min_value=ut.feature_ranges['Age']['min'],
+      max_value=ut.feature_ranges['Age']['max'],
+      step=1,
+      key='Age')
 
-  st.space()
-  st.caption('Functional Tests')
+    st.space()
+    st.caption('Health Status')
   
-  idx = 0
-  functional_test_item = []
-  functional_cols = st.columns(2)
-  while(idx < len(ut.functional_test_data['column'])):
-    if(ut.functional_test_data['type'][idx] in ['int', 'float']):
-      for col in ut.functional_test_data:
-        if(col != 'type'):
-          functional_test_item.append(ut.functional_test_data[col][idx])
-      target_col = 0 if idx%2==0 else 1
-      with functional_cols[target_col]:
-        user_inputs[ut.functional_test_data['column'][idx]] = functional_test_input(*functional_test_item)
-    else:
-      raise TypeError("Only integers and floats are allowed (as 'type' value).")
-    functional_test_item.clear()
-    idx += 1
-
-  st.space()
-  st.caption('Fall Related')
-
-  # CARDS - per fall incident
-  if "cards" not in st.session_state:
-    st.session_state.cards = {}
-      
-  fall_index = 0
-  hospital_days_no = []
-
-  # Return all proportioned (prior categorical) features
-  all_categorical_features = [option for sublist in ut.prop_columns.values() for option in sublist]
+    user_inputs['PillsPerDay'] = st.slider(
+      label='Pills Per Day',
+      min_value=ut.feature_ranges['PillsPerDay']['min'],
+      max_value=ut.feature_ranges['PillsPerDay']['max'],
+      step=1,
+      key='PillsPerDay')
+
+    clinical_cols = st.columns(2)
+    for i, (col, model_col) in enumerate(zip(health_status_columns, binary_columns)):
+      target_col = 0 if i%2==0 else 1
+      if 'Blood Test' in col:
+        placehldr = f'Does the faller have regular blood check-ups?'
+      else:
+        placehldr = f'Does the faller have {col}?'
+      with clinical_cols[target_col]:
+        selected = st.selectbox(
+          label=col,
+          placeholder=placehldr,
+          options=['No', 'Yes'],     
+          index=None,
+          key=model_col)
+        user_inputs[model_col] = 1 if selected == 'Yes' else 0
+
+    phys_activ_selected = st.selectbox(
+      label='Physical Activity',
+      options=activity_columns['PhysicalActivity'],
+      index=0,
+      key='PhysicalActivity')
+    user_inputs['PhysicalActivity'] = activity_columns['PhysicalActivity'].index(phys_activ_selected) + 1 # Increment by 1 because: the values of the corresponding feature are in the form of: 1,2,3
+
+    st.space()
+    st.caption('Functional Tests')
   
-  # Return a dict containing: k: proportioned feature name, v: numerical value
-  input_prop_data = {feature: 0.0 for feature in all_categorical_features}
-  # print(input_prop_data.keys())
-
-  widgets_key_names = []
-  widgets_key_names.extend(ut.widgets_key_names)
-  # print('before: ', widgets_key_names)
-
-  # Creates a card for each fall case
-  # Returns the current index of which is called {fall_index}
-  def card_column(fall_index):
-    # The keys of widgets inside the card, has the form: hosp_days_fall_{fall_index}. They are not in the form of the model's features names
-    fall_index += 1
-    st.write(f'Fall Case {fall_index}')
-    
-    key_name = f'hosp_days_fall_{fall_index}'
-    if key_name not in widgets_key_names:
-        widgets_key_names.append(key_name)
+    idx = 0
+    functional_test_item = []
+    functional_cols = st.columns(2)
+    while(idx < len(ut.functional_test_data['column'])):
+      if(ut.functional_test_data['type'][idx] in ['int', 'float']):
+        for col in ut.functional_test_data:
+          if(col != 'type'):
+            functional_test_item.append(ut.functional_test_data[col][idx])
+        target_col = 0 if idx%2==0 else 1
+        with functional_cols[target_col]:
+          user_inputs[ut.functional_test_data['column'][idx]] = functional_test_input(*functional_test_item)
+      else:
+        raise TypeError("Only integers and floats are allowed (as 'type' value).")
+      functional_test_item.clear()
+      idx += 1
+
+    st.space()
+    st.caption('Fall Related')
+
+    # CARDS - per fall incident
+    # The widgets of the cards that are no longer drawn (fewer falls) leave the session state
+    for key in [key for key in st.session_state if '_fall_' in key and key.rsplit('_', 1)[-1].isdigit() and int(key.rsplit('_', 1)[-1]) > falls_no]:
+      del st.session_state[key]
+
+    fall_index = 0
+    # One dict per fall card: {'Cause', 'Location', 'Time': selected option, 'hospital_days': days}.
+    # Encoded into the proportional features as the fall events of the batch paths (see helper/fall_events.py)
+    falls = []
+
+    # Creates a card for each fall case
+    # Returns the current index of which is called {fall_index}
+    def card_column(fall_index):
+      # The keys of widgets inside the card, has the form: hosp_days_fall_{fall_index}. They are not in the form of the model's features names
+      fall_index += 1
+      st.write(f'Fall Case {fall_index}')
     
-    days = st.number_input(
-      label='Days of hospitalization',
-      min_value=0,
-      max_value=20,
-      label_visibility='visible',
-      help='The limit value is 20, due to the need of consistency with the data the model had fit to.',
-      step=1,
-      key=key_name
-    )
-    hospital_days_no.append(days)
-
-    for label, options in ut.prop_columns.items():
-      key_name = f'{label}_fall_{fall_index}'
-      if key_name not in widgets_key_names:
-        widgets_key_names.append(key_name)
-        
-      selected = st.selectbox(
-        label=f'Select fall {label}',
-        options=options,
-        index=None,
-        # help='Need help?',
+      key_name = f'hosp_days_fall_{fall_index}'
+      days = st.number_input(
+        label='Days of hospitalization',
+        min_value=ut.feature_ranges['HospDays_min']['min'],
+        max_value=ut.feature_ranges['HospDays_min']['max'],
+        label_visibility='visible',
+        help='The limit value is 20, due to the need of consistency with the data the model had fit to.',
+        step=1,
         key=key_name
       )
-      if selected and selected in input_prop_data:
-        input_prop_data[selected] += CATEGORICAL_PROPORTIONAL_WEIGHT
-        if(selected != 'Other'): 
-          # There is no feature called 'Other'. It's just for convenience of user
-          real_feature_name = ut.prop_columns_mapping[selected]
-          user_inputs[real_feature_name] = input_prop_data[selected]
-    return fall_index
-
-  # Dynamic Fall cards creation
-  for i in range(0, falls_no, 2):
-    if(fall_index+2 > falls_no):
-      col = st.container(border=True)
-      with col:
-        fall_index = card_column(fall_index)
-    else:
-      cols = st.columns(2, gap="medium", border=True)
-
-      # left CARD
-      with cols[0]:
-        fall_index = card_column(fall_index)
+      fall = {fe.HOSPITAL_DAYS_COLUMN: days}
+      falls.append(fall)
+
+      for label, options in ut.prop_columns.items():
+        key_name = f'{label}_fall_{fall_index}'
+        selected = st.selectbox(
+          label=f'Select fall {label}',
+          options=options,
+          index=None,
+          # help='Need help?',
+          key=key_name
+        )
+        fall[label] = selected
+      return fall_index
+
+    # Dynamic Fall cards creation
+    for i in range(0, falls_no, 2):
+      if(fall_index+2 > falls_no):
+        col = st.container(border=True)
+        with col:
+          fall_index = card_column(fall_index)
+      else:
+        cols = st.columns(2, gap="medium", border=True)
+
+        # left CARD
+        with cols[0]:
+          fall_index = card_column(fall_index)
       
-      # right CARD
-      with cols[1]:
-        fall_index = card_column(fall_index)
+        # right CARD
+        with cols[1]:
+          fall_index = card_column(fall_index)
 
 
-  user_inputs['HospDays_min'] = min(hospital_days_no)
-  user_inputs['HospitalAdmissions'] = sum(x>0 for x in hospital_days_no)
+    user_inputs.update(fe.encode_falls(falls))
 
-  try:
-    # The 'else 0.0' statement is very suspicious and prone to make the debuggind difficult
-    # It may change in the future
+    try:
+      # The 'else 0.0' statement is very suspicious and prone to make the debuggind difficult
+      # It may change in the future
 
-    # round the numerical features values into 2 decimals
-    user_inputs = {k: round(v, 2) if(isinstance(v,(int, float))) else 0.0 for k, v in user_inputs.items()}
-  except:
-    raise Exception('An error occured when user_inputs converted to round. Maybe incorrect |user_input| type.')
+      # round the numerical features values into 2 decimals
+      user_inputs = {k: round(v, 2) if(isinstance(v,(int, float))) else 0.0 for k, v in user_inputs.items()}
+    except:
+      raise Exception('An error occured when user_inputs converted to round. Maybe incorrect |user_input| type.')
 
-  submit_button = st.form_submit_button(label='Predict profile', key='form_submit_button')
+    submit_button = st.form_submit_button(label='Predict profile', key='form_submit_button')
 
-  st.space(size="small")
+    st.space(size="small")
 
+    # Message of the last submit's validation
+    if st.session_state.get('form_error'):
+      st.error(st.session_state.form_error, icon='🚨')
+
+  # The inputs (as last submitted, fall count and location included) select the result to show
+  results = session_result_store()
+  model_version = load_model_registry().current()
+  input_key = rs.input_hash(user_inputs, model_version.digest)
+  previous_view = st.session_state.get('input_view')
+  st.session_state.input_view = (input_key, fall_location)
 
-  def check_close_classes(winner_prob, probs):
-    threshold = 0.10
-    print('probs:', probs)
-    close_classes = [ c for c, p in enumerate(probs) if ((winner_prob - p) <= threshold) ]
-    return close_classes
-    
-  
   if submit_button:
-    # st.session_state.form_submit_button = True
-    msg = input_validation(widgets_key_names)
-
-    input_row_df = pd.DataFrame([user_inputs])#, columns=user_inputs.keys())
-
-    if len(msg) == 0:
-      try:
-        # Predict
-        y_pred_proba = model.predict_proba(input_row_df)
-        # print('y_pred_proba: \n',y_pred_proba)
-        
-        winner_class = np.argmax(y_pred_proba)
-        # print('y_pred_proba[winner_class]: ', y_pred_proba[0][winner_class])
-        # print('winner_class: ', winner_class)
-        
-        close_classes = check_close_classes(y_pred_proba[0][winner_class], y_pred_proba[0])
-        # print('close_classes are:', close_classes)
-        
-        y_pred_proba_df = pd.DataFrame(y_pred_proba)
-        y_pred_proba_df.columns = ["Low risk", "Moderate risk", "High risk"]
-
-        
-        st.space()
-        st.subheader('Predicted Profile')
-        # Show DataFrame
-        st.dataframe(y_pred_proba_df, hide_index=True,
-                    column_config={
-              "Low risk": st.column_config.ProgressColumn(
-              label="Low risk",
-              format="%.3f",
-              min_value=0,
-              max_value=1
-            ),
-              "Moderate risk": st.column_config.ProgressColumn(
-              label="Moderate risk",
-              format="%.3f",
-              min_value=0,
-              max_value=1
-            ),
-              "High risk": st.column_config.ProgressColumn(
-              label="High risk",
-              format="%.3f",
-              min_value=0,
-              max_value=1
+    metrics_file = load_metrics_exporter()
+    with tm.REGISTRY.submit(model_version=model_version.version) as submit_id:
+      import numpy as np
+      import pandas as pd
+      import helper.scoring as sc
+      import helper.explanation_cache as ec
+      import helper.what_if as wi
+      import helper.counterfactual as cf
+
+      # Same predict_proba as the pipeline (model[0] -> StandardScaler, model[1] -> SVC model), in NumPy only
+      scorer = model_version.scorer
+      # st.session_state.form_submit_button = True
+      with tm.span('input_validation'):
+        msg = input_validation(user_inputs, falls_no)
+
+      with tm.span('dataframe_build'):
+        input_row_df = pd.DataFrame([user_inputs], columns=scorer.feature_names)
+
+      st.session_state.form_error = msg
+      if len(msg) == 0 and input_key in results:
+        tm.log_event('result_store_hit')
+      elif len(msg) == 0:
+        try:
+          # Predict and explain (cached, the explainer is skipped for an already seen patient).
+          # On a miss the explanation is computed at once, or is a first estimate refined in a background thread
+          cache_key = ec.canonical_key(input_row_df.to_numpy(dtype=float), model_version.digest)
+          # Spans 'explanation_cache_get', then 'predict_proba' and 'shap_first_estimate' on a miss
+          y_pred_proba, explanation = ec.predict_and_explain_anytime(
+            load_explanation_cache(), cache_key, scorer, model_version.explainer, input_row_df,
+            max_evals=SHAP_MAX_EVALS, deadline=SHAP_DEADLINE
+          )
+
+          winner_class = int(np.argmax(y_pred_proba))
+          close_classes = sc.check_close_classes(y_pred_proba[0][winner_class], y_pred_proba[0])
+
+          # All the variants of all the inputs are scored in one batch
+          with tm.span('what_if_sweep'):
+            sweep_curves = wi.sweep(scorer, input_row_df, features=list(SWEEP_LABELS))
+
+          # Smallest improvement of the modifiable inputs that reaches each lower profile
+          with tm.span('counterfactual_search', winner_class=winner_class):
+            counterfactuals = cf.lower_profiles(
+              cf.CounterfactualSearch(scorer, scorer.feature_names), input_row_df.to_numpy(dtype=float)[0], winner_class
             )
+
+          results.put(input_key, {
+            'submit_id': submit_id,
+            'model_version': model_version.version,
+            'cache_key': cache_key,
+            'proba': y_pred_proba,
+            'explanation': explanation,
+            'winner_class': winner_class,
+            'close_classes': close_classes,
+            'sweep_curves': sweep_curves,
+            'counterfactuals': counterfactuals,
+            'user_inputs': user_inputs
           })
+        except Exception as e:
+          tm.log_event('submit_error', level=logging.ERROR, error=repr(e))
+      with tm.span('session_memory_accounting'):
+        account_memory(model_version)
+    if metrics_file:
+      tm.REGISTRY.write_prometheus(metrics_file)
+    # The results panel and the validation message are drawn from the session state
+    st.rerun()
+  elif previous_view not in (None, st.session_state.input_view) and (previous_view[0] in results or input_key in results):
+    st.rerun()
+
+
+def explanation_section(prediction, refreshing):
+  """ Draw the waterfall plots of the close classes from the current SHAP estimate
+
+  Keyword argument:
+  prediction -- the stored prediction (see patient_section)
+  refreshing -- the fragment is rerun on a timer, until the estimate is done
+  """
+  import shap
+  import helper.scoring as sc
+
+  explanation = prediction['explanation']
+  close_classes = prediction['close_classes']
+  feature_names = explanation.explainer.feature_names
+  with tm.bind_submit(prediction['submit_id']):
+    waterfall_cols = st.columns(len(close_classes))
+    for col, class_id in zip(waterfall_cols, close_classes):
+      with col:
+        if (class_id == prediction['winner_class']):
+          st.markdown(f":green-badge[:material/check: {sc.RISK_PROFILES[class_id]}]", text_alignment = "center")
+        else:
+          st.markdown(f":gray-badge[:material/clear: {sc.RISK_PROFILES[class_id]}]", text_alignment = "center")
+        snapshot = explanation.snapshot(class_id)
+        class_explanation = shap.Explanation(
+          values=snapshot['values'],
+          base_values=snapshot['expected_value'],
+          data=explanation.x,
+          feature_names=feature_names
+        )
+        # Drawn by shap.plots.waterfall (see helper/rendering.py). Only the final estimate (the whole budget spent, as the
+        # explanation cache) is cached as PNG bytes: the intermediate ones are never requested again
+        final = snapshot['done'] and snapshot['permutations'] >= snapshot['max_permutations']
+        with tm.span('waterfall_plot', class_id=int(class_id), permutations=snapshot['permutations'], cached=final):
+          waterfall_png = load_waterfall_renderer().render(prediction['cache_key'], class_id, class_explanation, cache=final)
+        st.image(waterfall_png, output_format='PNG')
+
+        # Convergence of the estimate
+        permutations = f"{snapshot['permutations']}/{snapshot['max_permutations']} permutations"
+        error = f"±{snapshot['stderr']:.3f}" if snapshot['stderr'] != float('inf') else '± n/a'
+        if snapshot['converged']:
+          st.caption(f":material/check_circle: Ranking stable · {permutations} · {error}")
+        elif snapshot['done']:
+          st.caption(f":material/timer_off: Stopped at the deadline, the ranking may still change · {permutations} · {error}")
+        else:
+          st.caption(f":material/hourglass_top: Refining the estimate · {permutations} · {error}")
+
+  # The estimate is done: a full rerun draws the section again, without the timer
+  if refreshing and explanation.done:
+    st.rerun()
+
+
+def counterfactual_section(prediction):
+  """ Draw the smallest change of the modifiable inputs that moves the patient to each lower profile
+
+  Keyword argument:
+  prediction -- the stored prediction (see patient_section)
+  """
+  import pandas as pd
+  import helper.scoring as sc
+
+  counterfactuals = prediction['counterfactuals']
+  if not counterfactuals:
+    return
+  st.markdown("**What would need to improve for a lower risk profile?** The smallest change of the inputs a care plan can act on (the rest stay as filled in):")
+
+  def shown_value(feature, value):
+    if feature == 'PhysicalActivity':
+      return activity_columns['PhysicalActivity'][int(value) - 1]
+    return f"{value:g}"
+
+  shown = []
+  for target_class in sorted(counterfactuals, reverse=True): # The closest profile first
+    if not counterfactuals[target_class]:
+      st.caption(f"No change of the modifiable inputs reaches the {sc.RISK_PROFILES[target_class]} profile.")
+      continue
+    best = counterfactuals[target_class][0]
+    if best['changes'] in shown: # A change to a lower profile moves the patient past this one as well
+      continue
+    shown.append(best['changes'])
+    st.caption(f"To {sc.RISK_PROFILES[best['winner_class']]} ({best['proba'][best['winner_class']]:.0%})")
+    st.dataframe(
+      pd.DataFrame(
+        [(SWEEP_LABELS[feature], shown_value(feature, current), shown_value(feature, needed)) for feature, (current, needed) in best['changes'].items()],
+        columns=['Input', 'Current', 'Needed']
+      ),
+      hide_index=True
+    )
 
-        # Success message
-        st.success(f'The patient was successfully assigned to: {y_pred_proba_df.columns[winner_class].upper()} profile', icon=":material/done:", width="stretch")
-
-        # -- Interpertation section --
-        st.space(size="small")
-        st.subheader("Why was the patient assigned to this profile?")
-        st.markdown(f"Based on the baseline of {y_pred_proba_df.columns[winner_class]} profile, the features that pushed the result into it are shown in red, opposing featues are shown in blue: ")
-
-        # Interpretation of results using SHAP library
-        explainer = load_shap_explainer()
-        shap_values = explainer(input_row_df)
-        # shap_values.shape
-        
-        waterfall_cols = st.columns(len(close_classes))
-        i = 0
-        for class_id in close_classes:
-          with waterfall_cols[i]:
-            print(winner_class, ':', class_id)
-            if (class_id == winner_class):
-              st.markdown(f":green-badge[:material/check: {y_pred_proba_df.columns[class_id]}]", text_alignment = "center")
-            else:
-              st.markdown(f":gray-badge[:material/clear: {y_pred_proba_df.columns[class_id]}]", text_alignment = "center")
-            plt.figure(figsize=(6, 5))
-            plot = shap.plots.waterfall(
-              shap_values[0, :, class_id],
-              # shap_values[0, :, winner_class],
-              max_display=10
-            )
-            st.pyplot(plt.gcf())
-  
-          # Clear figure to avoid overlaps
-            plt.clf() 
-            i += 1
-
-        # -- Interventions section --
-        st.space()
-        class_key = f"class_{winner_class}"
-        interv_data = load_intervention_data()
-        location_type = st.session_state.fall_location
-        # print("render_interventions parameters:",  class_key, "|", location_type, "|", "Time: ", time.localtime(time.time()))
-
-        # Get intervention data 
-        class_data = interv_data.get(class_key)
-
-        # Call intervention display function
-        interv.render_interventions(class_data, location_type)
-        
-      except Exception as e:
-        print(e, 'L0000L')
+
+@st.fragment
+@tm.span('fragment_results_section')
+def results_section():
+  input_key, location_type = st.session_state.get('input_view', (None, None))
+  prediction = session_result_store().get(input_key)
+  if prediction is None:
+    return
+
+  import pandas as pd
+  import helper.scoring as sc
+
+  winner_class = prediction['winner_class']
+  close_classes = prediction['close_classes']
+  user_inputs = prediction['user_inputs']
+  y_pred_proba_df = pd.DataFrame(prediction['proba'])
+  y_pred_proba_df.columns = sc.RISK_PROFILES
+
+  with tm.bind_submit(prediction['submit_id']):
+    st.space()
+    st.subheader('Predicted Profile')
+    # Show DataFrame
+    st.dataframe(y_pred_proba_df, hide_index=True,
+                column_config={
+          "Low risk": st.column_config.ProgressColumn(
+          label="Low risk",
+          format="%.3f",
+          min_value=0,
+          max_value=1
+        ),
+          "Moderate risk": st.column_config.ProgressColumn(
+          label="Moderate risk",
+          format="%.3f",
+          min_value=0,
+          max_value=1
+        ),
+          "High risk": st.column_config.ProgressColumn(
+          label="High risk",
+          format="%.3f",
+          min_value=0,
+          max_value=1
+        )
+      })
+
+    # Success message
+    st.success(f'The patient was successfully assigned to: {y_pred_proba_df.columns[winner_class].upper()} profile', icon=":material/done:", width="stretch")
+
+    # -- Interpertation section --
+    st.space(size="small")
+    st.subheader("Why was the patient assigned to this profile?")
+    st.markdown(f"Based on the baseline of {y_pred_proba_df.columns[winner_class]} profile, the features that pushed the result into it are shown in red, opposing featues are shown in blue: ")
+
+    # Interpretation of results using SHAP library, redrawn on a timer only while the estimate is refined
+    if prediction['explanation'].done:
+      explanation_section(prediction, refreshing=False)
     else:
-      st.error(msg, icon='🚨')
\ No newline at end of file
+      st.fragment(explanation_section, run_every=SHAP_REFRESH_SECONDS)(prediction, refreshing=True)
+
+    counterfactual_section(prediction)
+
+    cache_stats = load_explanation_cache().stats()
+    st.caption(f"Model version: {prediction['model_version']} | Explanation cache: {cache_stats['hits'] + cache_stats['disk_hits']} hits | {cache_stats['misses']} misses")
+
+    # -- What-if section --
+    st.space()
+    st.subheader("What if an input changes?")
+    st.markdown("Probability of each profile, when a single input takes every allowed value and the rest stay as filled in:")
+    sweep_tabs = st.tabs(list(SWEEP_LABELS.values()))
+    for tab, (feature, curve) in zip(sweep_tabs, prediction['sweep_curves'].items()):
+      with tab:
+        st.line_chart(curve, x_label=SWEEP_LABELS[feature], y_label='Probability')
+        st.caption(f"Current value: {user_inputs[feature]}")
+
+    # -- Interventions section --
+    st.space()
+    class_key = f"class_{winner_class}"
+    interv_data = load_intervention_data()
+
+    # Get intervention data 
+    class_data = interv_data.get(class_key)
+
+    # Sections of the profile that apply to the fall location of the patient
+    import helper.intervention_rules as ir
+    mask = ir.location_flags(user_inputs, location_type)
+    sections = load_intervention_table().select(class_key, mask)
+
+    # Call intervention display function
+    with tm.span('render_interventions', class_key=class_key, location_type=location_type, flags=ir.active_flags(mask)):
+      interv.render_interventions(class_data, sections)
+
+    load_memory_monitor()
+
+
+patient_section()
+results_section()
@@ -0,0 +1,132 @@
+# Cold-start budget of the landing page and of the other pages.
+# Every script is executed once, through Streamlit's AppTest, in a fresh interpreter started with
+# `python -X importtime`. The report keeps, per script:
+#   - the wall time of the first run of the script (time to first paint, without the browser),
+#   - the time spent importing modules during that run and the heaviest top-level imports.
+# The report is saved as JSON and tracked in git ('benchmarks/results/cold_start.json'), so a release
+# that brings back a heavy import at the top of a page shows up in the diff and fails the budget check.
+#
+# Usage (from the root folder of the project):
+#   python -m benchmarks.cold_start                 # measure and print
+#   python -m benchmarks.cold_start --save          # measure and update the tracked report
+#   python -m benchmarks.cold_start --check         # fail if a script exceeds its budget
+import argparse
+import json
+import os
+import platform
+import re
+import subprocess
+import sys
+import time
+
+SCRIPTS = ['Main.py', 'pages/1_Data_Summary.py', 'pages/2_Glossary.py', 'pages/3_FAQ.py']
+REPORT_PATH = './benchmarks/results/cold_start.json'
+BUDGET_MS = {
+  # Budgets of the first run of each script, generous enough for a slower CPU than the measuring one
+  'Main.py': 800,
+  'pages/1_Data_Summary.py': 800,
+  'pages/2_Glossary.py': 800,
+  'pages/3_FAQ.py': 800,
+}
+HEAVY_MODULES = ['numpy', 'pandas', 'sklearn', 'matplotlib', 'shap', 'scipy']
+TOP_IMPORTS = 10
+START_MARKER = '--- cold_start: script run ---'
+IMPORTTIME_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)$')
+
+
+def check_compiles(script):
+  """ Raise SystemExit if the script does not compile: AppTest does not report it in app.exception, the run
+  would be measured as an empty page """
+  with open(script, encoding='utf-8') as script_file:
+    try:
+      compile(script_file.read(), script, 'exec')
+    except SyntaxError as e:
+      raise SystemExit(f"{script} does not compile on Python {platform.python_version()}: {e}")
+
+
+def _run_script(script):
+  """ Child process: run the script once with AppTest and print its wall time in ms """
+  from streamlit.testing.v1 import AppTest
+
+  sys.path.insert(0, os.getcwd())
+  check_compiles(script)
+  app = AppTest.from_file(script, default_timeout=120)
+  print(START_MARKER, file=sys.stderr, flush=True)
+  start = time.perf_counter()
+  app.run()
+  elapsed_ms = (time.perf_counter() - start) * 1000
+  if app.exception:
+    raise SystemExit(f"{script} raised: {app.exception[0].message}")
+  print(json.dumps({'run_ms': elapsed_ms}))
+
+
+def parse_importtime(stderr):
+  """ Return the top-level imports {module: cumulative ms} that happened after the start marker """
+  lines = stderr.splitlines()
+  if START_MARKER in lines:
+    lines = lines[lines.index(START_MARKER) + 1:]
+
+  top_level = {}
+  for line in lines:
+    match = IMPORTTIME_LINE.match(line)
+    if match and match.group(3) == '':
+      top_level[match.group(4)] = int(match.group(2)) / 1000
+  return top_level
+
+
+def measure(script):
+  """ Return the cold-start measures of a single script """
+  completed = subprocess.run(
+    [sys.executable, '-X', 'importtime', '-m', 'benchmarks.cold_start', '--run', script],
+    capture_output=True,
+    text=True
+  )
+  if completed.returncode != 0:
+    errors = [line for line in completed.stderr.splitlines() if not line.startswith('import time:')]
+    raise SystemExit(f"The cold start of {script} could not be measured:\n" + '\n'.join(errors[-5:]))
+  run_ms = json.loads(completed.stdout.strip().splitlines()[-1])['run_ms']
+  imports = parse_importtime(completed.stderr)
+  heaviest = sorted(imports.items(), key=lambda item: item[1], reverse=True)[:TOP_IMPORTS]
+  return {
+    'run_ms': round(run_ms, 1),
+    'import_ms': round(sum(imports.values()), 1),
+    'heavy_modules_imported': [m for m in HEAVY_MODULES if any(name.split('.')[0] == m for name in imports)],
+    'top_imports_ms': {name: round(ms, 1) for name, ms in heaviest},
+  }
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Measure the cold start of the Streamlit scripts.')
+  parser.add_argument('--run', help=argparse.SUPPRESS)
+  parser.add_argument('--save', action='store_true', help=f"update '{REPORT_PATH}'")
+  parser.add_argument('--check', action='store_true', help='fail if a script exceeds its budget')
+  args = parser.parse_args(argv)
+
+  if args.run:
+    _run_script(args.run)
+    return
+
+  report = {
+    'python': platform.python_version(),
+    'platform': platform.platform(),
+    'budget_ms': BUDGET_MS,
+    'scripts': {script: measure(script) for script in SCRIPTS}
+  }
+  print(json.dumps(report, indent=2))
+
+  if args.save:
+    with open(REPORT_PATH, 'w', encoding='utf-8') as report_file:
+      json.dump(report, report_file, indent=2)
+      report_file.write('\n')
+
+  if args.check:
+    over_budget = [
+      f"{script}: {measures['run_ms']} ms > {BUDGET_MS[script]} ms"
+      for script, measures in report['scripts'].items() if measures['run_ms'] > BUDGET_MS[script]
+    ]
+    if over_budget:
+      raise SystemExit('Cold-start budget exceeded:\n' + '\n'.join(over_budget))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,179 @@
+# Benchmark of every stage of a prediction, at batch sizes 1, 100 and 10k.
+# Stages:
+#   feature_assembly        -- form inputs (dicts) -> rounded DataFrame in the model's feature order, as 'Main.py'
+#   predict_proba           -- the pickled sklearn pipeline
+#   predict_proba_compiled  -- the NumPy scorer (helper/compiled_scorer.py)
+#   shap_explainer          -- the explainer of the app (helper/fast_shap.py)
+#   waterfall_rendering     -- waterfall plot of the winner class into PNG bytes (helper/rendering.py, no cache)
+#   intervention_rendering  -- location flags, helper/intervention_rules.py lookup and
+#                              helper/interventions.render_interventions (Streamlit in bare mode)
+# The per-row stages (explanation and rendering) are measured on at most --explain-limit rows of a batch and
+# extrapolated to the batch size; the report marks them as such.
+# Results are saved as JSON, so two commits can be compared:
+#
+# Usage (from the root folder of the project):
+#   python -m benchmarks.pipeline_stages --output benchmarks/results/stages_new.json
+#   python -m benchmarks.pipeline_stages --output new.json --compare benchmarks/results/stages_old.json
+import argparse
+import json
+import platform
+import statistics
+import subprocess
+import time
+
+import numpy as np
+import pandas as pd
+
+import helper.artifacts as art
+import helper.compiled_scorer as cs
+import helper.fast_shap as fs
+import helper.intervention_rules as ir
+import helper.rendering as rd
+from benchmarks import synthetic
+
+BATCH_SIZES = [1, 100, 10_000]
+DEFAULT_REPEAT = 3
+DEFAULT_EXPLAIN_LIMIT = 20
+REGRESSION_THRESHOLD = 1.2 # A stage slower than 1.2x the base is reported as a regression
+
+
+def _timed(fn, repeat):
+  """ Return the median and the min wall time (s) of |repeat| calls of fn """
+  timings = []
+  for _ in range(repeat):
+    start = time.perf_counter()
+    fn()
+    timings.append(time.perf_counter() - start)
+  return statistics.median(timings), min(timings)
+
+
+def _assemble(inputs, features):
+  """ The feature assembly of 'Main.py': rounding into 2 decimals and a DataFrame in the model's order """
+  rows = [{k: round(v, 2) if isinstance(v, (int, float)) else 0.0 for k, v in user_inputs.items()} for user_inputs in inputs]
+  return pd.DataFrame(rows, columns=features)
+
+
+def _render_waterfalls(shap_values, winner_classes):
+  for i, class_id in enumerate(winner_classes):
+    explanation = shap_values[i, :, class_id]
+    rd.waterfall_bytes(explanation)
+
+
+def _render_interventions(interv_data, table, X, winner_classes):
+  import helper.interventions as interv
+  masks = ir.location_flags(X)
+  for class_id, mask in zip(winner_classes, masks):
+    interv.render_interventions(interv_data.get(f"class_{class_id}"), table.select(f"class_{class_id}", int(mask)))
+
+
+def git_commit():
+  try:
+    return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def run(batch_sizes=BATCH_SIZES, repeat=DEFAULT_REPEAT, explain_limit=DEFAULT_EXPLAIN_LIMIT, seed=0):
+  """ Return the report {stage: {batch size: measures}} """
+  import streamlit.logger
+  streamlit.logger.set_log_level('error') # Streamlit calls outside of `streamlit run` only warn
+
+  model = art.load_model()
+  scorer = cs.CompiledScorer.from_pipeline(model)
+  explainer = fs.FastSVCExplainer(scorer, art.load_shap_explainer().masker.data)
+  interv_data = art.load_intervention_data()
+  table = ir.DecisionTable(interv_data)
+  features = scorer.feature_names
+
+  # Warm-up, so lazy initialisations are not measured
+  warm_up = synthetic.generate_patients(2, seed=seed)[features]
+  explainer(warm_up)
+  _render_waterfalls(explainer(warm_up[:1]), [0])
+
+  stages = {}
+  for batch_size in batch_sizes:
+    inputs = synthetic.form_inputs(synthetic.generate_patients(batch_size, seed=seed))
+    X = _assemble(inputs, features)
+    winner_classes = np.argmax(scorer.predict_proba(X), axis=1)
+    n_explained = min(batch_size, explain_limit)
+    shap_values = explainer(X[:n_explained])
+
+    measures = {
+      'feature_assembly': (lambda: _assemble(inputs, features), batch_size),
+      'predict_proba': (lambda: model.predict_proba(X), batch_size),
+      'predict_proba_compiled': (lambda: scorer.predict_proba(X), batch_size),
+      'shap_explainer': (lambda: explainer(X[:n_explained]), n_explained),
+      'waterfall_rendering': (lambda: _render_waterfalls(shap_values, winner_classes[:n_explained]), n_explained),
+      'intervention_rendering': (lambda: _render_interventions(interv_data, table, X, winner_classes), batch_size),
+    }
+    for stage, (fn, rows_measured) in measures.items():
+      median, best = _timed(fn, repeat)
+      scale = batch_size / rows_measured
+      stages.setdefault(stage, {})[str(batch_size)] = {
+        'seconds': median * scale,
+        'min_seconds': best * scale,
+        'per_row_ms': median / rows_measured * 1000,
+        'rows_measured': rows_measured,
+        'extrapolated': rows_measured < batch_size
+      }
+
+  return {
+    'commit': git_commit(),
+    'python': platform.python_version(),
+    'numpy': np.__version__,
+    'platform': platform.platform(),
+    'processor': platform.processor(),
+    'repeat': repeat,
+    'stages': stages
+  }
+
+
+def compare(report, base, threshold=REGRESSION_THRESHOLD):
+  """ Return the lines of the comparison and the list of regressions (stage, batch size, ratio) """
+  lines, regressions = [], []
+  lines.append(f"{'stage':<24}{'batch':>8}{'base (s)':>12}{'new (s)':>12}{'ratio':>8}")
+  for stage, batches in report['stages'].items():
+    for batch_size, measures in batches.items():
+      base_measures = base.get('stages', {}).get(stage, {}).get(batch_size)
+      if base_measures is None:
+        continue
+      ratio = measures['seconds'] / base_measures['seconds'] if base_measures['seconds'] > 0 else float('inf')
+      flag = '  <- regression' if ratio > threshold else ''
+      lines.append(f"{stage:<24}{batch_size:>8}{base_measures['seconds']:>12.4f}{measures['seconds']:>12.4f}{ratio:>8.2f}{flag}")
+      if ratio > threshold:
+        regressions.append((stage, batch_size, ratio))
+  return lines, regressions
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Benchmark every stage of an EPIF prediction.')
+  parser.add_argument('--output', default=None, help='JSON file of the results (benchmarks/results/stages_<commit>.json if None)')
+  parser.add_argument('--compare', default=None, help='JSON results of a base commit')
+  parser.add_argument('--batch-sizes', type=int, nargs='+', default=BATCH_SIZES)
+  parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT)
+  parser.add_argument('--explain-limit', type=int, default=DEFAULT_EXPLAIN_LIMIT, help='max explained/rendered rows per batch')
+  parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD, help='slowdown ratio reported as regression')
+  args = parser.parse_args(argv)
+
+  report = run(args.batch_sizes, args.repeat, args.explain_limit)
+  output = args.output or f"./benchmarks/results/stages_{report['commit'] or 'local'}.json"
+  with open(output, 'w', encoding='utf-8') as output_file:
+    json.dump(report, output_file, indent=2)
+    output_file.write('\n')
+
+  for stage, batches in report['stages'].items():
+    for batch_size, measures in batches.items():
+      note = ' (extrapolated)' if measures['extrapolated'] else ''
+      print(f"{stage:<24}{batch_size:>8} rows: {measures['seconds']:.4f} s{note}")
+  print(f"Results saved into '{output}'")
+
+  if args.compare:
+    with open(args.compare, 'r', encoding='utf-8') as base_file:
+      lines, regressions = compare(report, json.load(base_file), args.threshold)
+    print('\n'.join(lines))
+    if regressions:
+      raise SystemExit(f"{len(regressions)} stage/s slower than {args.threshold}x the base.")
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,124 @@
+# Rerun time per interaction of the landing page.
+# Every interaction is replayed through Streamlit's AppTest, which always reruns the whole script, so the
+# report keeps, per interaction:
+#   - full_rerun_ms     -- wall time of the whole script, i.e. the cost of the interaction when every widget
+#                          change reran 'Main.py' (before the page was split into fragments),
+#   - fragment_rerun_ms -- run time of the fragment the interaction belongs to (its 'fragment_*' span), i.e.
+#                          the cost of the interaction with fragment-scoped reruns.
+# A submit reruns its fragment and then the whole app (the results panel is drawn from the session state), so
+# both are counted for it.
+#
+# Usage (from the root folder of the project):
+#   python -m benchmarks.reruns                # measure and print
+#   python -m benchmarks.reruns --save         # measure and update 'benchmarks/results/reruns.json'
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+
+from benchmarks.cold_start import check_compiles
+
+REPORT_PATH = './benchmarks/results/reruns.json'
+DEFAULT_REPEAT = 5
+FORM_ANSWERS = {
+  'has_BloodTest': 'No', 'has_BalanceDeficitis': 'No', 'has_CardiovascularProblems': 'No',
+  'has_Osteoporosis': 'No', 'has_Diabetes': 'No', 'has_Vertigo': 'Yes'
+}
+
+
+def _fragment_seconds(stage):
+  import helper.telemetry as tm
+  return tm.REGISTRY.totals().get(stage, (0, 0.0))[1]
+
+
+def _fill_form(app):
+  for key, value in FORM_ANSWERS.items():
+    app.selectbox(key=key).set_value(value)
+  for key in ['Cause_fall_1', 'Location_fall_1', 'Time_fall_1']:
+    selectbox = app.selectbox(key=key)
+    selectbox.set_value(selectbox.options[1])
+
+
+# {interaction: (action on the app, fragment that reruns, whole app rerun as well)}
+INTERACTIONS = {
+  'falls_no': (lambda app, i: app.slider(key='falls_no').set_value(2 + i % 3), 'fragment_patient_section', False),
+  'fall_location': (lambda app, i: app.selectbox(key='fall_location').set_value(['Outdoor', 'Indoor'][i % 2]), 'fragment_patient_section', False),
+  'form_submit': (lambda app, i: app.button(key='form_submit_button').click(), 'fragment_patient_section', True),
+  'falls_no_with_prediction': (lambda app, i: app.slider(key='falls_no').set_value(2 + i % 3), 'fragment_patient_section', False),
+}
+
+
+def check_rendered(app, script='Main.py'):
+  """ Raise SystemExit if the run of the script raised or did not draw the form """
+  if app.exception:
+    raise SystemExit(f"{script} raised: {app.exception[0].message}")
+  if not any(slider.key == 'falls_no' for slider in app.slider):
+    raise SystemExit(f"{script} did not draw the form")
+
+
+def measure(repeat=DEFAULT_REPEAT):
+  """ Return {interaction: measures (ms)} """
+  from streamlit.testing.v1 import AppTest
+
+  sys.path.insert(0, os.getcwd())
+  check_compiles('Main.py')
+  app = AppTest.from_file('Main.py', default_timeout=120)
+  app.run()
+  check_rendered(app)
+  _fill_form(app)
+  app.button(key='form_submit_button').click().run() # Warm-up: loads the model and the explainer
+  app = AppTest.from_file('Main.py', default_timeout=120)
+  app.run()
+  _fill_form(app)
+
+  report = {}
+  for interaction, (action, fragment, full_rerun) in INTERACTIONS.items():
+    if interaction in ('form_submit', 'falls_no_with_prediction'):
+      app.slider(key='falls_no').set_value(1).run() # The form only fills the first fall case
+      _fill_form(app)
+      app.button(key='form_submit_button').click().run()
+    full_ms, fragment_ms = [], []
+    for i in range(repeat):
+      if interaction == 'form_submit':
+        _fill_form(app)
+      before = _fragment_seconds(fragment)
+      start = time.perf_counter()
+      action(app, i).run()
+      full_ms.append((time.perf_counter() - start) * 1000)
+      if app.exception:
+        raise SystemExit(f"'{interaction}' raised: {app.exception[0].message}")
+      # AppTest reran the whole script: its fragment span is the cost of a fragment-scoped rerun
+      fragment_run = (_fragment_seconds(fragment) - before) * 1000
+      fragment_ms.append(full_ms[-1] if full_rerun else fragment_run)
+    report[interaction] = {
+      'full_rerun_ms': round(statistics.median(full_ms), 1),
+      'fragment_rerun_ms': round(statistics.median(fragment_ms), 1),
+      'prediction_shown': len(app.subheader) > 0 and app.subheader[0].value == 'Predicted Profile'
+    }
+  return report
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Rerun time per interaction of the landing page.')
+  parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT)
+  parser.add_argument('--save', action='store_true', help=f"update '{REPORT_PATH}'")
+  args = parser.parse_args(argv)
+
+  report = {
+    'python': platform.python_version(),
+    'platform': platform.platform(),
+    'repeat': args.repeat,
+    'interactions': measure(args.repeat)
+  }
+  print(json.dumps(report, indent=2))
+  if args.save:
+    with open(REPORT_PATH, 'w', encoding='utf-8') as report_file:
+      json.dump(report, report_file, indent=2)
+      report_file.write('\n')
+
+
+if __name__ == '__main__':
+  main()
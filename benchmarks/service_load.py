@@ -0,0 +1,96 @@
+# Load generator of the HTTP service (helper/service.py).
+# |concurrency| clients, each on its own keep-alive connection, send requests back to back until |requests|
+# have been answered. The report has the client side p50/p99 latency, the throughput and the service's
+# own statistics (GET /stats), e.g. the mean size of the micro-batches.
+#
+# Usage (from the root folder of the project, with the service running):
+#   python -m benchmarks.service_load --port 8502 --concurrency 64 --requests 5000 --endpoint predict
+import argparse
+import asyncio
+import json
+import time
+
+import numpy as np
+
+import helper.service as svc
+from benchmarks import synthetic
+
+
+async def _request(reader, writer, method, path, payload=None):
+  """ Send a request on a keep-alive connection and return (status, JSON response) """
+  body = json.dumps(payload).encode('utf-8') if payload is not None else b''
+  writer.write(
+    f"{method} {path} HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\n"
+    f"Content-Length: {len(body)}\r\n\r\n".encode('latin-1') + body
+  )
+  await writer.drain()
+  status = int((await reader.readline()).split()[1])
+  length = 0
+  while True:
+    line = await reader.readline()
+    if line in (b'\r\n', b''):
+      break
+    name, _, value = line.decode('latin-1').partition(':')
+    if name.strip().lower() == 'content-length':
+      length = int(value)
+  return status, json.loads(await reader.readexactly(length))
+
+
+async def _client(host, port, endpoint, patients, counter, latencies, errors):
+  reader, writer = await asyncio.open_connection(host, port)
+  try:
+    while counter['left'] > 0:
+      counter['left'] -= 1
+      patient = patients[counter['left'] % len(patients)]
+      start = time.perf_counter()
+      status, _ = await _request(reader, writer, 'POST', f'/{endpoint}', {'patient': patient})
+      latencies.append(time.perf_counter() - start)
+      if status != 200:
+        errors.append(status)
+  finally:
+    writer.close()
+
+
+async def run_load(host, port, patients, concurrency, n_requests, endpoint='predict'):
+  """ Return the load report of |n_requests| requests sent by |concurrency| clients """
+  counter = {'left': n_requests}
+  latencies, errors = [], []
+  start = time.perf_counter()
+  await asyncio.gather(*[
+    _client(host, port, endpoint, patients, counter, latencies, errors) for _ in range(concurrency)
+  ])
+  elapsed = time.perf_counter() - start
+
+  reader, writer = await asyncio.open_connection(host, port)
+  _, service_stats = await _request(reader, writer, 'GET', '/stats')
+  writer.close()
+
+  p50, p99 = np.percentile(np.asarray(latencies) * 1000, [50, 99])
+  return {
+    'endpoint': endpoint,
+    'concurrency': concurrency,
+    'requests': len(latencies),
+    'errors': len(errors),
+    'latency_ms': {'p50': round(float(p50), 2), 'p99': round(float(p99), 2)},
+    'throughput_rps': round(len(latencies) / elapsed, 1),
+    'service': service_stats
+  }
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Load generator of the EPIF HTTP service.')
+  parser.add_argument('--host', default=svc.DEFAULT_HOST)
+  parser.add_argument('--port', type=int, default=svc.DEFAULT_PORT)
+  parser.add_argument('--concurrency', type=int, default=64)
+  parser.add_argument('--requests', type=int, default=5000)
+  parser.add_argument('--endpoint', choices=['predict', 'explain'], default='predict')
+  parser.add_argument('--patients', type=int, default=1000, help='number of distinct synthetic patients')
+  args = parser.parse_args(argv)
+
+  patients = synthetic.form_inputs(synthetic.generate_patients(args.patients))
+  report = asyncio.run(run_load(args.host, args.port, patients, args.concurrency, args.requests, args.endpoint))
+  print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+  main()
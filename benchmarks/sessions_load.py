@@ -0,0 +1,216 @@
+# Concurrent-session load test of the Streamlit app.
+# |users| simulated clinicians replay a scripted session at the same time, each one in its own thread with its
+# own AppTest (its own session state), in this process: like the sessions of a Streamlit server, they share the
+# process, its GIL and its st.cache_resource loaders (model, explainer, caches). A session:
+#   open        -- 'Main.py' is opened (first run of the script)
+#   falls_no    -- the number of falls is changed (1 to 5, it differs per user and per round)
+#   fill_form   -- every field is filled (a different patient per user and per round)
+#   submit      -- the prediction is submitted and the results are drawn
+#   glossary, data_summary, faq -- the other pages are opened
+# The report has, per number of concurrent users: the latency percentiles of every step, the sessions per
+# minute, the CPU use of the process (CPU time / wall time, 1.0 is one core busy) and the memory per session
+# (growth of the resident set size while the sessions are alive, divided by the number of sessions).
+# The first session of the process is run alone before the measures (model loading, imports).
+# AppTest runs one app at a time: every run installs a mock Streamlit Runtime (and the test config) and removes
+# it at the end, so concurrent runs would remove each other's. The harness installs one for the whole process
+# instead (shared_runtime), as a server has a single Runtime for all its sessions. Likewise, every run compiles
+# the script again, and concurrent compiles are not safe on every Python version: the bytecode is compiled once
+# per script, as the server's script cache does.
+#
+# Usage (from the root folder of the project):
+#   python -m benchmarks.sessions_load --users 1 4 8 --rounds 2
+#   python -m benchmarks.sessions_load --users 16 --output benchmarks/results/sessions_load.json
+import argparse
+import contextlib
+import json
+import os
+import platform
+import sys
+import threading
+import time
+
+import numpy as np
+
+import helper.memory_accounting as ma
+import helper.utils as ut
+from benchmarks import reruns
+from benchmarks.cold_start import check_compiles
+
+DEFAULT_USERS = [1, 4]
+DEFAULT_ROUNDS = 2
+PAGES = {
+  'glossary': 'pages/2_Glossary.py',
+  'data_summary': 'pages/1_Data_Summary.py',
+  'faq': 'pages/3_FAQ.py',
+}
+STEPS = ['open', 'falls_no', 'fill_form', 'submit'] + list(PAGES)
+PERCENTILES = [50, 90, 99]
+
+
+@contextlib.contextmanager
+def shared_runtime():
+  """ Install one mock Runtime, one script cache and the test config for every AppTest run of the block """
+  from unittest.mock import MagicMock, patch
+  from streamlit.runtime import Runtime
+  from streamlit.runtime.caching.storage.dummy_cache_storage import MemoryCacheStorageManager
+  from streamlit.runtime.media_file_manager import MediaFileManager
+  from streamlit.runtime.memory_media_file_storage import MemoryMediaFileStorage
+  from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+  from streamlit.testing.v1.util import patch_config_options
+
+  runtime = MagicMock(spec=Runtime)
+  runtime.media_file_mgr = MediaFileManager(MemoryMediaFileStorage('/mock/media'))
+  runtime.cache_storage_manager = MemoryCacheStorageManager()
+
+  compile_script = ScriptCache.get_bytecode
+  bytecode, bytecode_lock = {}, threading.Lock()
+
+  def get_bytecode(script_cache, script_path):
+    with bytecode_lock:
+      if script_path not in bytecode:
+        bytecode[script_path] = compile_script(script_cache, script_path)
+      return bytecode[script_path]
+
+  # The runs still set and reset Runtime._instance, it is no longer read
+  with patch.object(Runtime, 'instance', classmethod(lambda cls: runtime)), \
+       patch.object(Runtime, 'exists', classmethod(lambda cls: True)), \
+       patch.object(ScriptCache, 'get_bytecode', get_bytecode), \
+       patch_config_options({'global.appTest': True}):
+    yield runtime
+
+
+def _fill_form(app, rng, falls_no):
+  """ Fill every field of the form with a random patient """
+  for key in reruns.FORM_ANSWERS:
+    app.selectbox(key=key).set_value(['No', 'Yes'][rng.integers(0, 2)])
+  for i, column in enumerate(ut.functional_test_data['column']):
+    low, high, step = (ut.functional_test_data[key][i] for key in ('min', 'max', 'step'))
+    value = low + step * rng.integers(0, int(round((high - low) / step)) + 1)
+    app.number_input(key=column).set_value(round(value, 2) if ut.functional_test_data['type'][i] == 'float' else int(value))
+  for fall_index in range(1, falls_no + 1):
+    for label, options in ut.prop_columns.items():
+      app.selectbox(key=f"{label}_fall_{fall_index}").set_value(options[rng.integers(0, len(options))])
+    app.number_input(key=f"hosp_days_fall_{fall_index}").set_value(int(rng.integers(0, 3)))
+
+
+def run_session(user, session_round, latencies, errors):
+  """ Replay a scripted session, append the latency (s) of every step to latencies[step] and its errors to errors.
+  Return the app, None if the session stopped at an error """
+  from streamlit.testing.v1 import AppTest
+
+  rng = np.random.default_rng([user, session_round])
+  falls_no = 1 + (user + session_round) % ut.max_falls
+  session_errors = [] # The errors of this session only, errors is shared by the threads
+
+  def step(name, action):
+    start = time.perf_counter()
+    app = action()
+    latencies[name].append(time.perf_counter() - start)
+    if app.exception:
+      session_errors.append(f"user {user}, {name}: {app.exception[0].message}")
+    return app
+
+  app = AppTest.from_file('Main.py', default_timeout=300)
+  step('open', app.run)
+  try:
+    reruns.check_rendered(app)
+  except SystemExit as e:
+    errors.append(f"user {user}, open: {e}")
+    return None
+  step('falls_no', lambda: app.slider(key='falls_no').set_value(falls_no).run())
+  step('fill_form', lambda: (_fill_form(app, rng, falls_no), app.run())[1])
+  step('submit', lambda: app.button(key='form_submit_button').click().run())
+  if not session_errors and not (len(app.subheader) > 0 and app.subheader[0].value == 'Predicted Profile'):
+    session_errors.append(f"user {user}: no prediction shown ({[error.value for error in app.error]})")
+  for page, path in PAGES.items():
+    step(page, AppTest.from_file(path, default_timeout=300).run)
+  errors.extend(session_errors)
+  return app
+
+
+def measure(users, rounds=DEFAULT_ROUNDS):
+  """ Return the report of |users| concurrent sessions, |rounds| sessions per user """
+  latencies = {name: [] for name in STEPS}
+  errors = []
+  sessions = [] # Kept alive until the memory is measured, as the sessions of a server
+
+  def user_thread(user):
+    for session_round in range(rounds):
+      try:
+        app = run_session(user, session_round, latencies, errors)
+        if app is not None:
+          sessions.append(app)
+      except Exception as e: # e.g. a run that timed out
+        errors.append(f"user {user}: {e!r}")
+
+  rss_before = ma.resident_set_size()
+  cpu_before = time.process_time()
+  start = time.perf_counter()
+  threads = [threading.Thread(target=user_thread, args=(user,), name=f"epif-user-{user}") for user in range(users)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  wall = time.perf_counter() - start
+  cpu = time.process_time() - cpu_before
+  rss_after = ma.resident_set_size()
+
+  return {
+    'users': users,
+    'sessions': len(sessions),
+    'wall_s': round(wall, 2),
+    'sessions_per_minute': round(60 * len(sessions) / wall, 1),
+    'cpu_cores_used': round(cpu / wall, 2),
+    'rss_mb': round(rss_after / 2**20, 1),
+    'memory_per_session_mb': round((rss_after - rss_before) / 2**20 / max(len(sessions), 1), 2),
+    'latency_ms': {
+      name: {f"p{p}": round(float(np.percentile(values, p)) * 1000, 1) for p in PERCENTILES}
+      for name, values in latencies.items() if values
+    },
+    'errors': errors[:10]
+  }
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Concurrent-session load test of the Streamlit app.')
+  parser.add_argument('--users', type=int, nargs='+', default=DEFAULT_USERS, help='numbers of concurrent users, one run each')
+  parser.add_argument('--rounds', type=int, default=DEFAULT_ROUNDS, help='sessions per user')
+  parser.add_argument('--output', default=None, help='JSON file of the report')
+  args = parser.parse_args(argv)
+
+  sys.path.insert(0, os.getcwd())
+  os.environ.setdefault('EPIF_LOG_LEVEL', 'WARNING') # The spans of every rerun would flood the output
+
+  report = {
+    'python': platform.python_version(),
+    'platform': platform.platform(),
+    'cpu_count': os.cpu_count(),
+    'rounds': args.rounds,
+    'runs': []
+  }
+  # A script that does not compile would be run as an empty page, without an exception
+  for script in ['Main.py'] + list(PAGES.values()):
+    check_compiles(script)
+  with shared_runtime():
+    # Warm-up: imports, model, explainer, page assets (a round that the measured sessions do not replay)
+    errors = []
+    run_session(0, args.rounds, {name: [] for name in STEPS}, errors)
+    if errors:
+      raise SystemExit(f"The warm-up session failed: {errors[0]}")
+    for users in args.users:
+      report['runs'].append(measure(users, args.rounds))
+      run = report['runs'][-1]
+      print(f"{users} user/s: {run['sessions_per_minute']} sessions/min, submit p90 {run['latency_ms'].get('submit', {}).get('p90')} ms, "
+            f"{run['cpu_cores_used']} cores, {run['memory_per_session_mb']} MB/session, {len(run['errors'])} error/s", file=sys.stderr)
+
+  print(json.dumps(report, indent=2))
+  if args.output:
+    with open(args.output, 'w', encoding='utf-8') as report_file:
+      json.dump(report, report_file, indent=2)
+      report_file.write('\n')
+  if any(run['errors'] for run in report['runs']):
+    raise SystemExit(1)
+
+
+if __name__ == '__main__':
+  main()
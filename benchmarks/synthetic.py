@@ -0,0 +1,66 @@
+# Synthetic patient generator for the benchmarks.
+# Patients are drawn within the limits of the form: the ranges of helper/utils.feature_ranges and
+# helper/utils.functional_test_data, the options of helper/utils.prop_columns (one option per fall, 1 to
+# helper/utils.max_falls falls, as the fall cards of 'Main.py'), and the column groups of
+# 'data/columns_types.pkl'. Every value is one the form could have produced.
+import numpy as np
+import pandas as pd
+
+import helper.artifacts as art
+import helper.utils as ut
+
+HOSPITALIZATION_RATE = 0.3 # Share of the falls that ended up in a hospital
+
+
+def generate_patients(n, seed=0, columns_types=None):
+  """ Return a DataFrame of |n| synthetic patients, columns in the groups' order of columns_types.pkl
+
+  Keyword argument:
+  n             -- number of patients
+  seed          -- seed of the random generator
+  columns_types -- the column groups (loaded from 'data/columns_types.pkl' if None)
+  """
+  rng = np.random.default_rng(seed)
+  numerical_columns, ordinal_columns, binary_columns, prop_columns = columns_types or art.load_columns_types()
+  patients = {}
+
+  # Demographic and health status (same limits as the widgets of 'Main.py')
+  for col in ['Age', 'PillsPerDay', 'PhysicalActivity']:
+    patients[col] = rng.integers(ut.feature_ranges[col]['min'], ut.feature_ranges[col]['max'] + 1, n)
+  for col in binary_columns:
+    patients[col] = rng.integers(0, 2, n)
+
+  # Functional tests, on the grid of each widget's step
+  for i, col in enumerate(ut.functional_test_data['column']):
+    low, high, step = (ut.functional_test_data[key][i] for key in ('min', 'max', 'step'))
+    n_steps = int(round((high - low) / step))
+    patients[col] = np.round(low + step * rng.integers(0, n_steps + 1, n), 2)
+
+  # Falls: every fall selects one option per group, each selection adds the proportional weight
+  n_falls = rng.integers(1, ut.max_falls + 1, n)
+  fall_exists = np.arange(ut.max_falls)[None, :] < n_falls[:, None] # (patients x fall slots)
+  for col in prop_columns:
+    patients[col] = np.zeros(n)
+  for options in ut.prop_columns.values():
+    selected = rng.integers(0, len(options), (n, ut.max_falls))
+    for option_index, option in enumerate(options):
+      if option in ut.prop_columns_mapping: # 'Other' has no feature
+        count = ((selected == option_index) & fall_exists).sum(axis=1)
+        patients[ut.prop_columns_mapping[option]] = np.round(count * ut.proportional_weight, 2)
+
+  max_hospital_days = ut.feature_ranges['HospDays_min']['max']
+  hospital_days = np.where(
+    rng.random((n, ut.max_falls)) < HOSPITALIZATION_RATE,
+    rng.integers(1, max_hospital_days + 1, (n, ut.max_falls)),
+    0
+  )
+  patients['HospDays_min'] = np.where(fall_exists, hospital_days, max_hospital_days + 1).min(axis=1)
+  patients['HospitalAdmissions'] = ((hospital_days > 0) & fall_exists).sum(axis=1)
+
+  columns = numerical_columns + ordinal_columns + binary_columns + prop_columns
+  return pd.DataFrame({col: patients[col] for col in columns}).astype(float)
+
+
+def form_inputs(patients):
+  """ Return the patients as a list of {feature: value} dicts, the form of 'user_inputs' in 'Main.py' """
+  return patients.to_dict('records')
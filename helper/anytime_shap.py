@@ -0,0 +1,177 @@
+# Anytime SHAP explanation of a single patient.
+# The permutation estimate of helper/fast_shap.py is the mean of the estimates of independent (antithetic)
+# permutations, so it can be computed in batches: a first estimate from a few permutations is shown at once and
+# is refined in a background thread, until the evaluation budget is spent or the deadline has passed. Along with
+# the values, every snapshot has the standard error of the mean (spread of the permutations) and whether the
+# ranking of the top features changed since the previous batch. A small budget (the default one is a few
+# permutations) is spent at once instead: the cost of the first estimate tells whether the rest fits in
+# SYNCHRONOUS_SECONDS.
+# With the same seed, the permutations are the ones of FastSVCExplainer.explain_row, so an explanation that spends
+# the whole budget has the same values as the one-shot explainer.
+import contextvars
+import threading
+import time
+
+import numpy as np
+
+import helper.fast_shap as fs
+import helper.telemetry as tm
+
+FIRST_PERMUTATIONS = 1 # Permutations of the first estimate
+BATCH_PERMUTATIONS = 1 # Permutations added per refinement
+TOP_FEATURES = 10 # Features of the ranking (the features a waterfall plot shows)
+STDERR_TOLERANCE = 0.01 # Max standard error of the top features of a converged explanation
+SYNCHRONOUS_SECONDS = 0.1 # Estimated time of the refinement under which it is not run in the background
+
+
+class ProgressiveExplanation:
+  """ SHAP values of a single patient, refined in batches of permutations """
+
+  def __init__(self, explainer, x, max_evals=fs.DEFAULT_MAX_EVALS, deadline=None, seed=None, on_done=None):
+    """
+    Keyword argument:
+    explainer -- FastSVCExplainer
+    x         -- the row to explain, in the model's feature order
+    max_evals -- evaluation budget (defines the number of permutations, as in shap's PermutationExplainer)
+    deadline  -- seconds after which the refinement stops, whatever the budget left (no deadline if None)
+    seed      -- seed of the permutations
+    on_done   -- called with the explanation once the refinement has stopped
+    """
+    self.explainer = explainer
+    self.x = np.asarray(x, dtype=float).ravel()
+    self.deadline = None if deadline is None else time.monotonic() + deadline
+    self.on_done = on_done
+    self._shuffle = np.random.RandomState(seed).shuffle
+    self._lock = threading.Lock()
+    self._thread = None
+    self._sums = np.zeros((len(self.x), explainer.n_classes))
+    self._squares = np.zeros_like(self._sums)
+    self._ranking = None
+    self._final = None # (values, expected values) known beforehand
+    self.permutations = 0
+    self.ranking_stable = False
+    self.done = False
+
+    self._inds = explainer.varying_features(self.x)
+    if len(self._inds) == 0:
+      self.max_permutations = 0
+      self.expected_value = explainer.masked_proba(explainer.scorer.kernel_terms(self.x[None])[0], np.zeros((1, len(self.x))))[0]
+      self.ranking_stable = self.done = True
+      return
+    self.max_permutations = max_evals // (2 * len(self._inds) + 1)
+    if self.max_permutations == 0:
+      raise ValueError(f"max_evals={max_evals} is too low, it must be at least 2 * num_features + 1 = {2 * len(self._inds) + 1}!")
+    self.expected_value = None
+
+  @classmethod
+  def completed(cls, explainer, x, values, expected_value):
+    """ Return a done explanation of already computed values (e.g. from the explanation cache) """
+    explanation = cls(explainer, x)
+    explanation._final = (np.asarray(values, dtype=float).reshape(explanation._sums.shape), np.asarray(expected_value, dtype=float).ravel())
+    explanation.permutations = explanation.max_permutations
+    explanation.ranking_stable = explanation.done = True
+    return explanation
+
+  def _top_ranking(self, values):
+    return [tuple(np.argsort(-np.abs(values[:, c]), kind='stable')[:TOP_FEATURES]) for c in range(values.shape[1])]
+
+  def refine(self, permutations=BATCH_PERMUTATIONS):
+    """ Add a batch of permutations to the estimate. Return False if the refinement has stopped """
+    if self.done:
+      return False
+    permutations = min(permutations, self.max_permutations - self.permutations)
+    values, expected_value = self.explainer.permutation_values(self.x, self._inds, permutations, self._shuffle)
+    with self._lock:
+      self._sums += values.sum(axis=0)
+      self._squares += (values ** 2).sum(axis=0)
+      self.permutations += permutations
+      if self.expected_value is None:
+        self.expected_value = expected_value
+      ranking = self._top_ranking(self._sums / self.permutations)
+      self.ranking_stable = ranking == self._ranking
+      self._ranking = ranking
+      expired = self.deadline is not None and time.monotonic() >= self.deadline
+      self.done = self.permutations >= self.max_permutations or expired
+    if self.done and self.on_done is not None:
+      self.on_done(self)
+    return not self.done
+
+  @property
+  def complete(self):
+    """ True if the whole budget was spent (not stopped by the deadline) """
+    return self.permutations >= self.max_permutations
+
+  def _values(self):
+    if self._final is not None:
+      return self._final
+    if self.permutations == 0:
+      return np.zeros_like(self._sums), self.expected_value
+    return self._sums / self.permutations, self.expected_value
+
+  def _stderr(self):
+    if self._final is not None or self.max_permutations == 0:
+      return np.zeros_like(self._sums)
+    if self.permutations < 2:
+      return np.full_like(self._sums, np.inf)
+    mean = self._sums / self.permutations
+    variance = np.maximum(self._squares / self.permutations - mean ** 2, 0.0) * self.permutations / (self.permutations - 1)
+    return np.sqrt(variance / self.permutations)
+
+  def values(self):
+    """ Return (values (features x classes), expected values (classes)) of the current estimate """
+    with self._lock:
+      return self._values()
+
+  def stderr(self):
+    """ Return the standard error of the values (features x classes), inf before the second permutation """
+    with self._lock:
+      return self._stderr()
+
+  def snapshot(self, class_id):
+    """ Return the current estimate of a class: {'values', 'expected_value', 'permutations', 'max_permutations',
+    'stderr' (max over the top features), 'ranking_stable', 'converged', 'done'} """
+    with self._lock:
+      values, expected_value = self._values()
+      top = np.argsort(-np.abs(values[:, class_id]), kind='stable')[:TOP_FEATURES]
+      stderr = float(self._stderr()[top, class_id].max()) if len(top) else 0.0
+      return {
+        'values': values[:, class_id],
+        'expected_value': expected_value[class_id],
+        'permutations': self.permutations,
+        'max_permutations': self.max_permutations,
+        'stderr': stderr,
+        'ranking_stable': self.ranking_stable,
+        'converged': self.complete or (self.ranking_stable and stderr <= STDERR_TOLERANCE),
+        'done': self.done
+      }
+
+  def start(self, first_permutations=FIRST_PERMUTATIONS, synchronous_seconds=SYNCHRONOUS_SECONDS):
+    """ Compute the first estimate, then refine it in a background thread. Return self
+
+    Keyword argument:
+    first_permutations  -- permutations of the first estimate
+    synchronous_seconds -- the refinement is run before returning if the first estimate tells it takes less
+    """
+    started = time.perf_counter()
+    self.refine(first_permutations)
+    if self.done:
+      return self
+    seconds_per_permutation = (time.perf_counter() - started) / self.permutations
+    if seconds_per_permutation * (self.max_permutations - self.permutations) <= synchronous_seconds:
+      self.run()
+    else:
+      # The thread runs in a copy of the context, so its span is logged with the id of the submit
+      self._thread = threading.Thread(target=contextvars.copy_context().run, args=(self.run,), name='epif-anytime-shap', daemon=True)
+      self._thread.start()
+    return self
+
+  def run(self):
+    with tm.span('shap_refinement', max_permutations=self.max_permutations):
+      while self.refine():
+        pass
+
+  def join(self, timeout=None):
+    """ Wait for the background refinement """
+    if self._thread is not None:
+      self._thread.join(timeout)
+    return self.done
@@ -0,0 +1,265 @@
+# Versioned bundle of the model artifacts, without pickles.
+# The arrays that the app needs (scaler statistics, support vectors, dual coefficients, Platt parameters, the
+# background data of the SHAP masker) are exported from the pickles into one .npy file each, along with a
+# manifest ('manifest.json'): the format version, the feature schema (feature names, column groups), the shape,
+# dtype and sha256 of every array, the digests of the pickles they were exported from and the library versions.
+# The arrays are memory-mapped (read-only), so the server processes of a machine share their pages instead of
+# holding a copy each. A bundle is checked when it is opened, before any array is used: unknown format version,
+# missing, corrupted or inconsistent arrays and a schema that does not match the arrays are rejected.
+# The manifest and the checksums are read with the standard library only; NumPy is imported on the first array.
+#
+# Usage (from the root folder of the project):
+#   python -m helper.artifact_bundle --export    # export the pickles into './model/bundle' and check it
+#   python -m helper.artifact_bundle --check     # check the bundle, and that the pickles did not change since
+import argparse
+import hashlib
+import json
+import os
+import platform
+import shutil
+import tempfile
+import time
+
+import helper.artifacts as art
+
+BUNDLE_DIR = './model/bundle'
+MANIFEST_NAME = 'manifest.json'
+FORMAT = 'epif-artifacts'
+FORMAT_VERSION = 1
+SOURCES = [art.MODEL_PATH, art.SHAP_EXPLAINER_PATH, art.COLUMNS_TYPES_PATH]
+COLUMN_GROUPS = ['numerical', 'ordinal', 'binary', 'proportional'] # Order of 'data/columns_types.pkl'
+BACKGROUND = 'background'
+# Arrays of helper.compiled_scorer.CompiledScorer
+SCORER_ARRAYS = [
+  'feature_names', 'classes', 'mean', 'scale', 'support_vectors', 'dual_coef', 'n_support', 'intercept',
+  'kernel', 'gamma', 'coef0', 'degree', 'prob_a', 'prob_b'
+]
+# {array: dimensions}, 'features' must be the number of features of the schema
+ARRAY_DIMENSIONS = {
+  'mean': ('features',),
+  'scale': ('features',),
+  'support_vectors': (None, 'features'),
+  BACKGROUND: (None, 'features'),
+}
+
+
+def _sha256(path):
+  digest = hashlib.sha256()
+  with open(path, 'rb') as array_file:
+    for block in iter(lambda: array_file.read(1 << 20), b''):
+      digest.update(block)
+  return digest.hexdigest()
+
+
+def export_bundle(model, explainer, columns_types, directory=BUNDLE_DIR, sources=SOURCES):
+  """ Export the arrays of the pipeline and of the explainer's background into a bundle. Return the manifest
+
+  Keyword argument:
+  model         -- the fitted pipeline (model[0] -> StandardScaler, model[1] -> SVC)
+  explainer     -- the SHAP explainer, for the background data of its masker
+  columns_types -- the column groups of 'data/columns_types.pkl'
+  directory     -- folder of the bundle, replaced as a whole
+  sources       -- the files the bundle is exported from, their digests are kept in the manifest
+  """
+  import numpy as np
+  import helper.compiled_scorer as cs
+
+  scorer = cs.CompiledScorer.from_pipeline(model)
+  arrays = dict(scorer.arrays)
+  arrays[BACKGROUND] = np.ascontiguousarray(explainer.masker.data, dtype=float)
+
+  # Written next to the bundle and swapped in, so a reader never sees a half-written bundle
+  parent = os.path.dirname(os.path.abspath(directory))
+  os.makedirs(parent, exist_ok=True)
+  staging = tempfile.mkdtemp(dir=parent, prefix='.bundle-')
+  os.chmod(staging, 0o755) # Readable by the server processes of other users
+  manifest_arrays = {}
+  for name, array in arrays.items():
+    array = np.asarray(array)
+    file_name = f"{name}.npy"
+    np.save(os.path.join(staging, file_name), array, allow_pickle=False)
+    manifest_arrays[name] = {
+      'file': file_name,
+      'dtype': array.dtype.str,
+      'shape': list(array.shape),
+      'sha256': _sha256(os.path.join(staging, file_name))
+    }
+
+  versions = {'python': platform.python_version(), 'numpy': np.__version__}
+  for library in ('sklearn', 'shap'):
+    try:
+      versions[library] = __import__(library).__version__
+    except ImportError:
+      pass
+
+  manifest = {
+    'format': FORMAT,
+    'format_version': FORMAT_VERSION,
+    'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+    'libraries': versions,
+    'sources': {os.path.normpath(path): art.file_digest(path) for path in sources},
+    'schema': {
+      'feature_names': scorer.feature_names,
+      'columns_types': dict(zip(COLUMN_GROUPS, [list(group) for group in columns_types])),
+      'classes': [int(c) for c in scorer.classes]
+    },
+    'arrays': manifest_arrays
+  }
+  with open(os.path.join(staging, MANIFEST_NAME), 'w', encoding='utf-8') as manifest_file:
+    json.dump(manifest, manifest_file, indent=2)
+    manifest_file.write('\n')
+
+  if os.path.isdir(directory):
+    retired = tempfile.mkdtemp(dir=parent, prefix='.bundle-old-')
+    os.replace(directory, os.path.join(retired, 'bundle'))
+    os.replace(staging, directory)
+    shutil.rmtree(retired)
+  else:
+    os.replace(staging, directory)
+  return manifest
+
+
+class ArtifactBundle:
+  """ Checked, memory-mapped view of an exported bundle """
+
+  def __init__(self, directory=BUNDLE_DIR, verify=True):
+    """
+    Keyword argument:
+    directory -- folder of the bundle
+    verify    -- check the sha256 of every array file (the manifest and the schema are always checked)
+    """
+    self.directory = directory
+    manifest_path = os.path.join(directory, MANIFEST_NAME)
+    if not os.path.isfile(manifest_path):
+      raise FileNotFoundError(f"No artifact bundle in '{directory}'. Export it with: python -m helper.artifact_bundle --export")
+    with open(manifest_path, 'rb') as manifest_file:
+      manifest_bytes = manifest_file.read()
+    try:
+      self.manifest = json.loads(manifest_bytes)
+    except ValueError as e:
+      raise ValueError(f"Invalid artifact bundle '{directory}': unreadable manifest ({e})") from None
+    # Identifies the model: the manifest has the checksum of every array
+    self.digest = hashlib.sha256(manifest_bytes).hexdigest()
+    self._arrays = None
+    self._check_manifest()
+    if verify:
+      self._check_files()
+
+  def _error(self, message):
+    return ValueError(f"Invalid artifact bundle '{self.directory}': {message}")
+
+  def _check_manifest(self):
+    manifest = self.manifest
+    if manifest.get('format') != FORMAT:
+      raise self._error(f"unknown format '{manifest.get('format')}'")
+    if manifest.get('format_version') != FORMAT_VERSION:
+      raise self._error(f"format version {manifest.get('format_version')} is not supported (expected {FORMAT_VERSION})")
+
+    schema, arrays = manifest['schema'], manifest['arrays']
+    feature_names = schema['feature_names']
+    grouped = [name for group in COLUMN_GROUPS for name in schema['columns_types'][group]]
+    if sorted(grouped) != sorted(feature_names):
+      raise self._error('the column groups of the schema do not match its features')
+    missing = [name for name in SCORER_ARRAYS + [BACKGROUND] if name not in arrays]
+    if missing:
+      raise self._error(f"missing array/s: {', '.join(missing)}")
+    for name, dimensions in ARRAY_DIMENSIONS.items():
+      shape = arrays[name]['shape']
+      expected = [len(feature_names) if dimension == 'features' else size for dimension, size in zip(dimensions, shape)]
+      if len(shape) != len(dimensions) or shape != expected:
+        raise self._error(f"array '{name}' has shape {shape}, {len(feature_names)} features expected")
+    if arrays['classes']['shape'] != [len(schema['classes'])]:
+      raise self._error('the classes of the schema do not match the model')
+
+  def _check_files(self):
+    for name, entry in self.manifest['arrays'].items():
+      path = os.path.join(self.directory, entry['file'])
+      if not os.path.isfile(path):
+        raise self._error(f"missing file '{entry['file']}'")
+      if _sha256(path) != entry['sha256']:
+        raise self._error(f"checksum mismatch of '{entry['file']}' (corrupted or modified file)")
+
+  @property
+  def feature_names(self):
+    return list(self.manifest['schema']['feature_names'])
+
+  @property
+  def columns_types(self):
+    """ Return the feature names grouped by type: numerical, ordinal, binary, proportional (as 'data/columns_types.pkl') """
+    columns_types = self.manifest['schema']['columns_types']
+    return [list(columns_types[group]) for group in COLUMN_GROUPS]
+
+  def stale_sources(self):
+    """ Return the source files that changed since the export (the ones that no longer exist are ignored) """
+    return [
+      path for path, digest in self.manifest['sources'].items()
+      if os.path.exists(path) and art.file_digest(path) != digest
+    ]
+
+  def arrays(self):
+    """ Return {name: read-only memory-mapped array} """
+    if self._arrays is None:
+      import numpy as np
+      arrays = {}
+      for name, entry in self.manifest['arrays'].items():
+        array = np.load(os.path.join(self.directory, entry['file']), mmap_mode='r', allow_pickle=False)
+        if array.dtype.str != entry['dtype'] or list(array.shape) != entry['shape']:
+          raise self._error(f"array '{name}' is {array.dtype.str} {list(array.shape)}, the manifest says {entry['dtype']} {entry['shape']}")
+        arrays[name] = array
+      self._arrays = arrays
+    return self._arrays
+
+  def scorer(self):
+    """ Return the CompiledScorer of the pipeline """
+    import helper.compiled_scorer as cs
+    return cs.CompiledScorer({name: array for name, array in self.arrays().items() if name != BACKGROUND})
+
+  def background(self):
+    """ Return the background data of the SHAP masker (rows x features) """
+    return self.arrays()[BACKGROUND]
+
+  def explainer(self):
+    """ Return the FastSVCExplainer of the app """
+    import helper.fast_shap as fs
+    return fs.FastSVCExplainer(self.scorer(), self.background())
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Export or check the versioned bundle of the model artifacts.')
+  parser.add_argument('--directory', default=BUNDLE_DIR)
+  parser.add_argument('--export', action='store_true', help='export the pickles into the bundle')
+  parser.add_argument('--check', action='store_true', help='check the bundle against the pickles')
+  parser.add_argument('--rows', type=int, default=10_000, help='number of rows of the parity check')
+  args = parser.parse_args(argv)
+
+  if args.export:
+    manifest = export_bundle(art.load_model(), art.load_shap_explainer(), art.load_columns_types(), args.directory)
+    print(f"Exported {len(manifest['arrays'])} arrays into '{args.directory}'")
+
+  start = time.perf_counter()
+  bundle = ArtifactBundle(args.directory)
+  scorer = bundle.scorer()
+  print(f"Bundle checked and opened in {(time.perf_counter() - start) * 1000:.1f} ms, digest {bundle.digest[:12]}")
+
+  if args.check or args.export:
+    import numpy as np
+    import pandas as pd
+    import helper.compiled_scorer as cs
+
+    stale = bundle.stale_sources()
+    if stale:
+      raise SystemExit(f"The bundle is out of date, changed since the export: {', '.join(stale)}")
+    model = art.load_model()
+    rng = np.random.default_rng(0)
+    background = np.asarray(bundle.background())
+    X = pd.DataFrame(background[rng.integers(0, len(background), args.rows)], columns=bundle.feature_names)
+    diff = cs.check_parity(scorer, model, X)
+    print(f"predict_proba max abs difference from the pickled pipeline: {diff:.2e}")
+    if diff > cs.PARITY_TOLERANCE:
+      raise SystemExit('The bundle does not match the pickled pipeline.')
+    if bundle.columns_types != art.load_columns_types():
+      raise SystemExit('The column groups of the bundle do not match the pickled ones.')
+
+
+if __name__ == '__main__':
+  main()
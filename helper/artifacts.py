@@ -0,0 +1,45 @@
+# Paths and plain loaders of the serialized artifacts.
+# They hold no Streamlit state, so they can be used by the app (wrapped in @st.cache_resource)
+# as well as by command-line tools that run outside of Streamlit.
+import hashlib
+import json
+import pickle
+
+MODEL_PATH = './model/clf_pipeline.pkl'
+SHAP_EXPLAINER_PATH = './model/shap_explainer.pkl'
+COLUMNS_TYPES_PATH = './data/columns_types.pkl'
+INTERVENTIONS_PATH = './data/interventions.json'
+
+
+def load_model(path=MODEL_PATH):
+  """ Return the fitted pipeline (model[0] -> StandardScaler, model[1] -> SVC) """
+  with open(path, 'rb') as model_file:
+    return pickle.load(model_file)
+
+
+def load_shap_explainer(path=SHAP_EXPLAINER_PATH):
+  """ Return the fitted SHAP explainer of the pipeline """
+  with open(path, 'rb') as shap_explainer_file:
+    return pickle.load(shap_explainer_file)
+
+
+def load_columns_types(path=COLUMNS_TYPES_PATH):
+  """ Return the feature names grouped by type: numerical, ordinal, binary, proportional """
+  with open(path, 'rb') as columns_types_file:
+    return pickle.load(columns_types_file)
+
+
+def load_intervention_data(path=INTERVENTIONS_PATH):
+  """ Return the intervention data """
+  with open(path, 'r', encoding="utf-8") as interventions_file:
+    return json.load(interventions_file)
+
+
+def file_digest(*paths):
+  """ Return the sha256 hex digest of the content of the given files """
+  digest = hashlib.sha256()
+  for path in paths:
+    with open(path, 'rb') as artifact_file:
+      for block in iter(lambda: artifact_file.read(1 << 20), b''):
+        digest.update(block)
+  return digest.hexdigest()
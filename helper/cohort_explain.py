@@ -0,0 +1,198 @@
+# SHAP explanations of a whole cohort file, for the audits of the screened patients.
+# The cohort (.csv or .parquet) is streamed in chunks; every chunk is explained by a worker process with the
+# explainer of the app (helper/fast_shap.py, built once per worker from the memory-mapped arrays of the artifact
+# bundle, see helper/artifact_bundle.py), and the chunks are written in the cohort's order. Every patient is
+# explained with its own seed (seed + row number), so the values do not depend on the chunk size or on the number
+# of workers.
+# Outputs:
+#   - one row per patient: the probabilities, the winner class, the base value and the SHAP value of every
+#     feature for the winner class (every class with --all-classes),
+#   - optionally (--summary), the mean |SHAP| of every feature over the patients of each profile, the statistic
+#     of the bar plots of the 'Data Summary' page.
+#
+# Usage (from the root folder of the project):
+#   python -m helper.cohort_explain cohort.parquet explanations.parquet --jobs 8 --summary mean_abs_shap.json
+#   python -m helper.cohort_explain cohort.csv explanations.csv --id-column PatientID --all-classes
+import argparse
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import helper.artifact_bundle as ab
+import helper.fast_shap as fs
+import helper.input_schema as ins
+import helper.scoring as sc
+
+DEFAULT_CHUNKSIZE = 256 # Patients per worker task
+DEFAULT_SEED = 0
+_explainer = None # The explainer of a worker process
+
+
+def _init_worker(bundle_directory):
+  global _explainer
+  # The bundle was checked by the parent process
+  _explainer = ab.ArtifactBundle(bundle_directory, verify=False).explainer()
+
+
+def _explain_chunk(job):
+  """ Worker: return (probabilities, SHAP values (rows x features x classes), base values) of a chunk """
+  first_row, X, seed, max_evals = job
+  values, base_values = [], []
+  for i, x in enumerate(X):
+    row_values, expected_value = _explainer.explain_row(x, max_evals=max_evals, rng=np.random.RandomState(seed + first_row + i))
+    values.append(row_values)
+    base_values.append(expected_value)
+  return _explainer.predict_proba(X), np.stack(values), np.stack(base_values)
+
+
+def explanation_frame(proba, values, base_values, feature_names, all_classes=False):
+  """ Return the output rows of a chunk
+
+  Keyword argument:
+  proba         -- (rows x classes) probabilities
+  values        -- (rows x features x classes) SHAP values
+  base_values   -- (rows x classes) expected values
+  feature_names -- feature names in the model's order
+  all_classes   -- keep the SHAP values of every class, not only of the winner class
+  """
+  winner_class = np.argmax(proba, axis=1)
+  rows = np.arange(len(proba))
+  frame = pd.DataFrame(proba, columns=sc.RISK_PROFILES)
+  frame['winner_class'] = winner_class
+  frame['winner_profile'] = np.asarray(sc.RISK_PROFILES)[winner_class]
+  if all_classes:
+    for class_id in range(proba.shape[1]):
+      frame[f"base_value_{class_id}"] = base_values[:, class_id]
+      shap_columns = pd.DataFrame(values[:, :, class_id], columns=[f"shap_{name}_{class_id}" for name in feature_names])
+      frame = pd.concat([frame, shap_columns], axis=1)
+  else:
+    frame['base_value'] = base_values[rows, winner_class]
+    shap_columns = pd.DataFrame(values[rows, :, winner_class], columns=[f"shap_{name}" for name in feature_names])
+    frame = pd.concat([frame, shap_columns], axis=1)
+  return frame
+
+
+class ProfileSummary:
+  """ Running mean |SHAP| of every feature over the patients of each profile """
+
+  def __init__(self, feature_names, n_classes=len(sc.RISK_PROFILES)):
+    self.feature_names = list(feature_names)
+    self.abs_sums = np.zeros((n_classes, len(self.feature_names)))
+    self.counts = np.zeros(n_classes, dtype=np.int64)
+
+  def add(self, proba, values):
+    winner_class = np.argmax(proba, axis=1)
+    for class_id in range(len(self.counts)):
+      in_class = winner_class == class_id
+      self.abs_sums[class_id] += np.abs(values[in_class, :, class_id]).sum(axis=0)
+      self.counts[class_id] += int(in_class.sum())
+
+  def result(self):
+    """ Return {profile: {'patients', 'mean_abs_shap': {feature: value}, highest first}} """
+    result = {}
+    for class_id, profile in enumerate(sc.RISK_PROFILES):
+      means = self.abs_sums[class_id] / self.counts[class_id] if self.counts[class_id] else np.zeros(len(self.feature_names))
+      order = np.argsort(-means, kind='stable')
+      result[profile] = {
+        'patients': int(self.counts[class_id]),
+        'mean_abs_shap': {self.feature_names[i]: float(means[i]) for i in order}
+      }
+    return result
+
+
+def _chunks(input_path, features, columns_types, chunksize, id_column):
+  """ Yield (first row number, ids or None, X array) of the cohort """
+  schema = ins.build_schema(columns_types)
+  first_row = 0
+  for chunk in sc.read_cohort(input_path, chunksize):
+    X = sc.prepare_features(chunk, features, columns_types, schema, first_row)
+    ids = chunk[id_column].to_numpy() if id_column is not None else None
+    yield first_row, ids, X.to_numpy(dtype=float)
+    first_row += len(X)
+
+
+def explain_cohort(input_path, output_path, summary_path=None, jobs=os.cpu_count(), chunksize=DEFAULT_CHUNKSIZE,
+                   seed=DEFAULT_SEED, max_evals=fs.DEFAULT_MAX_EVALS, id_column=None, all_classes=False,
+                   bundle_directory=ab.BUNDLE_DIR):
+  """ Explain every patient of the cohort file and write the results. Return the number of explained patients
+
+  Keyword argument:
+  input_path       -- cohort file (.csv or .parquet), one patient per row, columns named as the model's features
+  output_path      -- output file (.csv or .parquet)
+  summary_path     -- JSON file of the mean |SHAP| per profile (not written if None)
+  jobs             -- worker processes (1 explains in this process)
+  chunksize        -- patients per worker task
+  seed             -- seed of the SHAP permutations
+  max_evals        -- evaluation budget of every explanation
+  id_column        -- a column of the cohort that is copied into the output (e.g. the patient id)
+  all_classes      -- keep the SHAP values of every class, not only of the winner class
+  bundle_directory -- folder of the artifact bundle
+  """
+  bundle = ab.ArtifactBundle(bundle_directory)
+  features = bundle.feature_names
+  chunks = _chunks(input_path, features, bundle.columns_types, chunksize, id_column)
+  summary = ProfileSummary(features, len(bundle.manifest['schema']['classes']))
+
+  def write(writer, ids, result):
+    proba, values, base_values = result
+    frame = explanation_frame(proba, values, base_values, features, all_classes)
+    if ids is not None:
+      frame.insert(0, id_column, ids)
+    writer.write(frame)
+    summary.add(proba, values)
+    return len(frame)
+
+  n_explained = 0
+  with sc.CohortWriter(output_path) as writer:
+    if jobs <= 1:
+      _init_worker(bundle_directory)
+      for first_row, ids, X in chunks:
+        n_explained += write(writer, ids, _explain_chunk((first_row, X, seed, max_evals)))
+    else:
+      with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker, initargs=(bundle_directory,)) as executor:
+        # At most 2 tasks per worker in flight, so the cohort is never held in memory as a whole
+        pending = deque()
+        for first_row, ids, X in chunks:
+          pending.append((ids, executor.submit(_explain_chunk, (first_row, X, seed, max_evals))))
+          if len(pending) >= 2 * jobs:
+            ids, future = pending.popleft()
+            n_explained += write(writer, ids, future.result())
+        while pending:
+          ids, future = pending.popleft()
+          n_explained += write(writer, ids, future.result())
+
+  if summary_path is not None:
+    with open(summary_path, 'w', encoding='utf-8') as summary_file:
+      json.dump(summary.result(), summary_file, indent=2)
+      summary_file.write('\n')
+  return n_explained
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Explain every patient of a cohort with the SHAP explainer of the app.')
+  parser.add_argument('input', help='cohort file (.csv or .parquet)')
+  parser.add_argument('output', help='output file (.csv or .parquet)')
+  parser.add_argument('--summary', default=None, help='JSON file of the mean |SHAP| of every feature per profile')
+  parser.add_argument('--jobs', type=int, default=os.cpu_count(), help='worker processes')
+  parser.add_argument('--chunksize', type=int, default=DEFAULT_CHUNKSIZE, help='patients per worker task')
+  parser.add_argument('--seed', type=int, default=DEFAULT_SEED)
+  parser.add_argument('--max-evals', type=int, default=fs.DEFAULT_MAX_EVALS)
+  parser.add_argument('--id-column', default=None, help='column copied into the output, e.g. the patient id')
+  parser.add_argument('--all-classes', action='store_true', help='SHAP values of every class, not only of the winner class')
+  args = parser.parse_args(argv)
+
+  start = time.perf_counter()
+  n_explained = explain_cohort(
+    args.input, args.output, summary_path=args.summary, jobs=args.jobs, chunksize=args.chunksize,
+    seed=args.seed, max_evals=args.max_evals, id_column=args.id_column, all_classes=args.all_classes
+  )
+  print(f"{n_explained} patients explained into '{args.output}' in {time.perf_counter() - start:.1f} s")
+
+
+if __name__ == '__main__':
+  main()
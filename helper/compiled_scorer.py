@@ -0,0 +1,249 @@
+# Pure-NumPy scorer of the StandardScaler + SVC pipeline of 'model/clf_pipeline.pkl'.
+# The parameters that `predict_proba` needs (scaler mean/scale, support vectors, dual coefficients, intercepts,
+# kernel parameters and the Platt scaling parameters) are pulled out of the pipeline into a dict of arrays, which
+# the artifact bundle stores (see helper/artifact_bundle.py).
+# The scorer reproduces `model.predict_proba` with the libsvm formulas (pairwise decision values, Platt scaling,
+# pairwise coupling) on a single row (dict or array, no DataFrame) or on millions of rows (in chunks).
+#
+# Usage (from the root folder of the project):
+#   python -m helper.compiled_scorer --check   # parity with the pipeline
+import argparse
+import time
+
+import numpy as np
+
+import helper.artifacts as art
+
+SUPPORTED_KERNELS = ('linear', 'poly', 'rbf', 'sigmoid')
+PARITY_TOLERANCE = 1e-9 # Max absolute difference from `model.predict_proba`
+DEFAULT_CHUNKSIZE = 65_536 # Rows per kernel matrix, bounds the memory to chunksize x support vectors
+
+
+def _sigmoid_predict(decision_values, prob_a, prob_b):
+  """ Platt scaling of the pairwise decision values, as in libsvm's sigmoid_predict """
+  fApB = decision_values * prob_a + prob_b
+  # Both branches are numerically stable versions of 1 / (1 + exp(fApB))
+  positive = fApB >= 0
+  exp_neg = np.exp(-np.abs(fApB))
+  return np.where(positive, exp_neg / (1.0 + exp_neg), 1.0 / (1.0 + exp_neg))
+
+
+def _pairwise_coupling(r, n_classes, min_prob=1e-7):
+  """ Vectorized libsvm multiclass_probability. Return (samples x classes) probabilities
+
+  Keyword argument:
+  r         -- (samples x pairs) pairwise probabilities, pairs ordered as (0,1), (0,2), ..., (1,2), ...
+  n_classes -- number of classes
+  """
+  # R[i][j] -> probability of class i against class j, one column of samples per pair of classes
+  R = [[None] * n_classes for _ in range(n_classes)]
+  p = 0
+  for i in range(n_classes):
+    for j in range(i + 1, n_classes):
+      R[i][j] = np.clip(r[:, p], min_prob, 1 - min_prob)
+      R[j][i] = 1 - R[i][j]
+      p += 1
+
+  # Q[t][t] = sum_j r[j][t]^2, Q[t][j] = -r[j][t] * r[t][j]
+  Q = np.empty((n_classes, n_classes, r.shape[0]))
+  for t in range(n_classes):
+    for j in range(n_classes):
+      if j != t:
+        Q[t, j] = -R[j][t] * R[t][j]
+    Q[t, t] = sum(R[j][t] ** 2 for j in range(n_classes) if j != t)
+
+  probs = np.full((n_classes, r.shape[0]), 1.0 / n_classes)
+  eps = 0.005 / n_classes
+  for _ in range(max(100, n_classes)):
+    Qp = np.einsum('tjn,jn->tn', Q, probs)
+    pQp = (probs * Qp).sum(axis=0)
+    # libsvm stops every sample independently, so the samples that converged are dropped
+    active = np.abs(Qp - pQp).max(axis=0) >= eps
+    if not active.any():
+      break
+    if not active.all():
+      rows = np.flatnonzero(active)
+      Qa, Qpa, pa, pQpa = Q[:, :, rows], Qp[:, rows], probs[:, rows], pQp[rows]
+    else:
+      Qa, Qpa, pa, pQpa = Q, Qp, probs.copy(), pQp
+    for t in range(n_classes):
+      diff = (-Qpa[t] + pQpa) / Qa[t, t]
+      pa[t] += diff
+      pQpa = (pQpa + diff * (diff * Qa[t, t] + 2 * Qpa[t])) / (1 + diff) / (1 + diff)
+      Qpa = (Qpa + diff * Qa[t]) / (1 + diff)
+      pa /= (1 + diff)
+    if active.all():
+      probs = pa
+    else:
+      probs[:, rows] = pa
+  return probs.T
+
+
+def _pair_coefficients(dual_coef, n_support):
+  """ Return a (support vectors x pairs) matrix W, so that the pairwise decision values are K @ W + intercept """
+  n_classes = len(n_support)
+  starts = np.concatenate([[0], np.cumsum(n_support)])
+  W = np.zeros((dual_coef.shape[1], n_classes * (n_classes - 1) // 2))
+  p = 0
+  for i in range(n_classes):
+    for j in range(i + 1, n_classes):
+      W[starts[i]:starts[i + 1], p] = dual_coef[j - 1, starts[i]:starts[i + 1]]
+      W[starts[j]:starts[j + 1], p] = dual_coef[i, starts[j]:starts[j + 1]]
+      p += 1
+  return W
+
+
+class CompiledScorer:
+  """ NumPy-only `predict_proba` of a StandardScaler + SVC(probability=True) pipeline """
+
+  def __init__(self, arrays):
+    """
+    Keyword argument:
+    arrays -- dict of the arrays of the pipeline (see from_pipeline)
+    """
+    self.arrays = arrays
+    self.feature_names = [str(name) for name in arrays['feature_names']]
+    self.classes = arrays['classes']
+    self.n_classes = len(self.classes)
+    self.kernel = str(arrays['kernel'])
+    self.gamma = float(arrays['gamma'])
+    self.coef0 = float(arrays['coef0'])
+    self.degree = int(arrays['degree'])
+    self.mean = arrays['mean']
+    self.scale = arrays['scale']
+    self.support_vectors = arrays['support_vectors']
+    self.intercept = arrays['intercept']
+    self.prob_a = arrays['prob_a']
+    self.prob_b = arrays['prob_b']
+    self.pair_coef = _pair_coefficients(arrays['dual_coef'], arrays['n_support'])
+    self._support_vectors_sq = (self.support_vectors ** 2).sum(axis=1)
+
+  @classmethod
+  def from_pipeline(cls, model):
+    """ Pull the parameters out of the fitted pipeline (model[0] -> StandardScaler, model[1] -> SVC) """
+    scaler, svc = model[0], model[1]
+    if svc.kernel not in SUPPORTED_KERNELS or not svc.probability:
+      raise ValueError("Only SVC models with a built-in kernel and probability=True are supported.")
+    return cls({
+      'feature_names': np.asarray(scaler.get_feature_names_out(), dtype=str),
+      'classes': np.asarray(svc.classes_),
+      'mean': np.asarray(scaler.mean_, dtype=float),
+      'scale': np.asarray(scaler.scale_, dtype=float),
+      'support_vectors': np.asarray(svc.support_vectors_, dtype=float),
+      'dual_coef': np.asarray(svc.dual_coef_, dtype=float),
+      'n_support': np.asarray(svc.n_support_),
+      'intercept': np.asarray(svc.intercept_, dtype=float),
+      'kernel': np.asarray(svc.kernel),
+      'gamma': np.asarray(svc._gamma, dtype=float),
+      'coef0': np.asarray(svc.coef0, dtype=float),
+      'degree': np.asarray(svc.degree),
+      'prob_a': np.asarray(svc.probA_, dtype=float),
+      'prob_b': np.asarray(svc.probB_, dtype=float),
+    })
+
+  def as_array(self, X):
+    """ Return X as a (rows x features) float array in the model's feature order
+
+    Keyword argument:
+    X -- dict of a single patient ({feature: value}), DataFrame with the features as columns, or array
+    """
+    if isinstance(X, dict):
+      return np.array([[X[name] for name in self.feature_names]], dtype=float)
+    if hasattr(X, 'columns'):
+      return X[self.feature_names].to_numpy(dtype=float)
+    return np.atleast_2d(np.asarray(X, dtype=float))
+
+  def kernel_terms(self, X):
+    """ Return the per feature terms of the kernel against the support vectors, shape (rows x features x SVs)
+
+    The kernel is a function of the sum of these terms over the features (see `apply_kernel`).
+    """
+    Z = (np.asarray(X, dtype=float) - self.mean) / self.scale
+    if self.kernel == 'rbf':
+      return (Z[:, :, None] - self.support_vectors.T[None, :, :]) ** 2
+    return Z[:, :, None] * self.support_vectors.T[None, :, :]
+
+  def apply_kernel(self, s):
+    """ Return the kernel value given the sum of its per feature terms """
+    match self.kernel:
+      case 'linear':
+        return s
+      case 'poly':
+        return (self.gamma * s + self.coef0) ** self.degree
+      case 'rbf':
+        return np.exp(-self.gamma * s)
+      case 'sigmoid':
+        return np.tanh(self.gamma * s + self.coef0)
+
+  def kernel_matrix(self, X):
+    """ Return the (rows x SVs) kernel matrix of X, without the (rows x features x SVs) terms """
+    Z = (np.asarray(X, dtype=float) - self.mean) / self.scale
+    if self.kernel == 'rbf':
+      s = (Z ** 2).sum(axis=1)[:, None] - 2 * Z @ self.support_vectors.T + self._support_vectors_sq[None, :]
+      return self.apply_kernel(np.maximum(s, 0.0))
+    return self.apply_kernel(Z @ self.support_vectors.T)
+
+  def proba_from_decision(self, decision_values):
+    """ Return (samples x classes) probabilities given the (samples x pairs) decision values """
+    return _pairwise_coupling(_sigmoid_predict(decision_values, self.prob_a, self.prob_b), self.n_classes)
+
+  def proba_from_kernel(self, K):
+    """ Return (samples x classes) probabilities given (samples x SVs) kernel values """
+    return self.proba_from_decision(K @ self.pair_coef + self.intercept)
+
+  def predict_proba(self, X, chunksize=DEFAULT_CHUNKSIZE):
+    """ Return the probabilities of X, equal to `model.predict_proba(X)` """
+    X = self.as_array(X)
+    probs = np.empty((len(X), self.n_classes))
+    for start in range(0, len(X), chunksize):
+      probs[start:start + chunksize] = self.proba_from_kernel(self.kernel_matrix(X[start:start + chunksize]))
+    return probs
+
+
+def check_parity(scorer, model, X):
+  """ Return the max absolute difference of the probabilities from `model.predict_proba(X)`
+
+  Keyword argument:
+  scorer -- CompiledScorer
+  model  -- the fitted pipeline
+  X      -- DataFrame of patients
+  """
+  return np.abs(scorer.predict_proba(X) - model.predict_proba(X)).max()
+
+
+def main(argv=None):
+  import pandas as pd
+
+  parser = argparse.ArgumentParser(description='Check the parity and the speed of the compiled scorer.')
+  parser.add_argument('--check', action='store_true', help='compare against the pickled pipeline')
+  parser.add_argument('--rows', type=int, default=100_000, help='number of rows of the parity/speed check')
+  args = parser.parse_args(argv)
+
+  model = art.load_model()
+  scorer = CompiledScorer.from_pipeline(model)
+  if args.check:
+    # Rows around the background data of the explainer, perturbed to cover the input ranges
+    background = art.load_shap_explainer().masker.data
+    rng = np.random.default_rng(0)
+    X = background[rng.integers(len(background), size=args.rows)] + rng.normal(0, 0.5, (args.rows, background.shape[1]))
+    X = pd.DataFrame(X, columns=scorer.feature_names)
+
+    diff = check_parity(scorer, model, X)
+    row = X.iloc[0].to_dict()
+    start = time.perf_counter()
+    for _ in range(1000):
+      scorer.predict_proba(row)
+    single_row_ms = (time.perf_counter() - start)
+    start = time.perf_counter()
+    for _ in range(100):
+      model.predict_proba(pd.DataFrame([row]))
+    sklearn_row_ms = (time.perf_counter() - start) * 10
+
+    print(f"predict_proba max abs difference on {args.rows} rows: {diff:.2e} (tolerance {PARITY_TOLERANCE:.0e})")
+    print(f"Single row: {single_row_ms:.3f} ms (compiled) | {sklearn_row_ms:.3f} ms (pipeline + DataFrame)")
+    if diff > PARITY_TOLERANCE:
+      raise SystemExit('The compiled scorer does not match the pickled pipeline.')
+
+
+if __name__ == '__main__':
+  main()
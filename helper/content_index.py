@@ -0,0 +1,167 @@
+# Full-text index of the clinical content: FAQs, glossary and interventions.
+# The three JSON files are compiled once into an inverted index {term: {document: weight}}; the terms are kept
+# sorted, so every word of a query matches the terms that start with it (prefix matching, for search as you
+# type) with a bisect instead of a scan of the content. Hits are ranked with a tf-idf score, the words of the
+# titles weigh more than the ones of the bodies.
+import json
+import math
+import re
+import unicodedata
+from bisect import bisect_left
+from collections import defaultdict
+
+FAQS_PATH = './data/faqs.json'
+GLOSSARY_PATH = './data/glossary.json'
+INTERVENTIONS_PATH = './data/interventions.json'
+SOURCES = {'faq': 'FAQ', 'glossary': 'Glossary', 'intervention': 'Interventions'}
+TITLE_WEIGHT = 3.0
+PREFIX_WEIGHT = 0.5 # A prefix match counts half as much as the whole word
+DEFAULT_LIMIT = 10
+_WORD = re.compile(r'[a-z0-9]+')
+
+
+def tokenize(text):
+  """ Return the lowercase words of the text, accents removed """
+  normalized = unicodedata.normalize('NFKD', text.casefold())
+  return _WORD.findall(''.join(c for c in normalized if not unicodedata.combining(c)))
+
+
+def faq_documents(faqs):
+  return [
+    {
+      'source': 'faq',
+      'title': row['question'],
+      'section': row['type'],
+      'body': '\n'.join([row['description']] + [f"• {item}" for item in row.get('items', [])])
+    }
+    for row in faqs
+  ]
+
+
+def glossary_documents(glossary):
+  return [
+    {'source': 'glossary', 'title': row['factor'], 'section': 'Interpretation of the risk factors', 'body': row['description']}
+    for row in glossary['interpretation']
+  ]
+
+
+def intervention_documents(interventions):
+  documents = []
+  for class_data in interventions.values():
+    documents.append({
+      'source': 'intervention',
+      'title': class_data['title'],
+      'section': class_data['title'],
+      'body': '\n'.join([class_data.get('description', '')] + [f"• {focus}" for focus in class_data.get('focus', [])])
+    })
+    for section in class_data['interventions']:
+      documents.append({
+        'source': 'intervention',
+        'title': section['title'],
+        'section': class_data['title'],
+        'body': '\n'.join(f"• {item}" for item in section['items'])
+      })
+  return documents
+
+
+class ContentIndex:
+  """ Inverted index of the documents {'source', 'title', 'section', 'body'} """
+
+  def __init__(self, documents):
+    self.documents = list(documents)
+    postings = defaultdict(lambda: defaultdict(float))
+    for doc_id, document in enumerate(self.documents):
+      for term in tokenize(document['title']):
+        postings[term][doc_id] += TITLE_WEIGHT
+      for term in tokenize(document['body']) + tokenize(document['section']):
+        postings[term][doc_id] += 1.0
+
+    self.terms = sorted(postings)
+    self.postings = {term: dict(docs) for term, docs in postings.items()}
+    n_documents = max(len(self.documents), 1)
+    self.idf = {term: math.log(1 + n_documents / len(docs)) for term, docs in self.postings.items()}
+
+  @classmethod
+  def from_files(cls, faqs_path=FAQS_PATH, glossary_path=GLOSSARY_PATH, interventions_path=INTERVENTIONS_PATH):
+    """ Return the index of the content files """
+    with open(faqs_path, 'r', encoding='utf-8') as faqs_file:
+      faqs = json.load(faqs_file)
+    with open(glossary_path, 'r', encoding='utf-8') as glossary_file:
+      glossary = json.load(glossary_file)
+    with open(interventions_path, 'r', encoding='utf-8') as interventions_file:
+      interventions = json.load(interventions_file)
+    return cls(faq_documents(faqs) + glossary_documents(glossary) + intervention_documents(interventions))
+
+  def expand(self, word):
+    """ Return [(term, weight)] of the indexed terms that start with the word """
+    matches = []
+    for i in range(bisect_left(self.terms, word), len(self.terms)):
+      term = self.terms[i]
+      if not term.startswith(word):
+        break
+      matches.append((term, 1.0 if term == word else PREFIX_WEIGHT))
+    return matches
+
+  def search(self, query, limit=DEFAULT_LIMIT, sources=None):
+    """ Return the ranked hits [(score, document)] of the documents that match every word of the query
+
+    Keyword argument:
+    query   -- free text; every word matches the terms that start with it
+    limit   -- max number of hits
+    sources -- keep only the documents of these sources ('faq', 'glossary', 'intervention'), all if None
+    """
+    words = tokenize(query)
+    if not words:
+      return []
+
+    scores = None
+    for word in dict.fromkeys(words): # Unique words, in order
+      word_scores = defaultdict(float)
+      for term, match_weight in self.expand(word):
+        for doc_id, weight in self.postings[term].items():
+          word_scores[doc_id] += match_weight * weight * self.idf[term]
+      if scores is None:
+        scores = word_scores
+      else:
+        scores = {doc_id: score + word_scores[doc_id] for doc_id, score in scores.items() if doc_id in word_scores}
+      if not scores:
+        return []
+
+    hits = [
+      (score, self.documents[doc_id]) for doc_id, score in scores.items()
+      if sources is None or self.documents[doc_id]['source'] in sources
+    ]
+    hits.sort(key=lambda hit: -hit[0])
+    return hits[:limit]
+
+
+def load_content_index():
+  """ Return the index of the content files. The pages wrap it in st.cache_resource: the cache entry is keyed on
+  this function, so both pages share a single index """
+  return ContentIndex.from_files()
+
+
+def render_search(index, key, placeholder='Search FAQs, glossary and interventions'):
+  """ Draw a search box and its ranked hits. Return True if a query was entered
+
+  Keyword argument:
+  index -- ContentIndex
+  key   -- key of the search box widget
+  """
+  import streamlit as st
+
+  query = st.text_input('Search', placeholder=placeholder, key=key, label_visibility='collapsed', icon=':material/search:')
+  if not query.strip():
+    return False
+
+  hits = index.search(query)
+  if not hits:
+    st.caption(f"No results for '{query}'.")
+    return True
+  st.caption(f"{len(hits)} result/s for '{query}'")
+  for _, document in hits:
+    # The interventions of every profile share their titles, so they are labelled with the profile
+    origin = document['section'] if document['source'] == 'intervention' else SOURCES[document['source']]
+    with st.expander(f"{document['title']}  ·  {origin}", expanded=False):
+      st.markdown(document['body'].replace('\n', '  \n'))
+  return True
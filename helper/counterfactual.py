@@ -0,0 +1,182 @@
+# Counterfactuals of the current patient: the smallest change of the modifiable inputs that moves the patient
+# to a lower risk profile ("what would need to improve for this patient to be Low risk?").
+# Only the inputs a clinical plan can change are searched, in the direction of an improvement (more physical
+# activity, fewer pills, better functional test scores), within the limits of the widgets of 'Main.py'.
+# The size of a change is the sum of the changes of its inputs, each one as a share of the input's range.
+# Beam search: at every step, every variant of the beam is moved by a few widget steps along every input, all the
+# candidates are scored with a single `predict_proba` call, and the best ones (highest probability of the lower
+# profiles) are kept. Once a variant reaches the target, the search goes on only with smaller changes, and the
+# best variant is then shrunk input by input while it stays in the target profile.
+import numpy as np
+
+import helper.utils as ut
+
+# Modifiable inputs: {feature: direction of an improvement}
+MODIFIABLE = {
+  'PhysicalActivity': 1,
+  'PillsPerDay': -1,
+  'BBS_Score': 1,
+  'FICSIT4_Score': 1,
+  'ShortFESI_Score': -1,
+  'TUG_Score': -1,
+}
+MOVE_FRACTIONS = (0.05, 0.1, 0.25) # Moves of every step, as shares of the input's range (at least one widget step)
+BEAM_WIDTH = 32
+MAX_DEPTH = 12
+MAX_RESULTS = 3 # Distinct counterfactuals returned per target
+
+
+def _limits(feature):
+  """ Return (min, max, step) of the feature's widget """
+  if feature in ut.functional_test_data['column']:
+    i = ut.functional_test_data['column'].index(feature)
+    return ut.functional_test_data['min'][i], ut.functional_test_data['max'][i], ut.functional_test_data['step'][i]
+  limits = ut.feature_ranges[feature]
+  return limits['min'], limits['max'], 1
+
+
+class CounterfactualSearch:
+  """ Beam search of the smallest improvement of the modifiable inputs that reaches a lower risk profile """
+
+  def __init__(self, scorer, feature_names, features=None, beam_width=BEAM_WIDTH, max_depth=MAX_DEPTH):
+    """
+    Keyword argument:
+    scorer        -- the fitted pipeline or a scorer with the same predict_proba (helper.compiled_scorer)
+    feature_names -- feature names in the model's order
+    features      -- the modifiable features (every feature of MODIFIABLE if None)
+    beam_width    -- variants kept at every step
+    max_depth     -- steps of the search
+    """
+    self.scorer = scorer
+    self.feature_names = list(feature_names)
+    self.features = list(features if features is not None else MODIFIABLE)
+    unknown = [feature for feature in self.features if feature not in MODIFIABLE or feature not in self.feature_names]
+    if unknown:
+      raise ValueError(f"'{', '.join(unknown)}' can not be modified. Allowed features: {', '.join(MODIFIABLE)}")
+    self.columns = np.array([self.feature_names.index(feature) for feature in self.features])
+    limits = np.array([_limits(feature) for feature in self.features], dtype=float)
+    self.minimum, self.maximum, self.step = limits.T
+    self.direction = np.array([MODIFIABLE[feature] for feature in self.features])
+    self.beam_width = beam_width
+    self.max_depth = max_depth
+
+    # Moves: (moves x features) numbers of widget steps, one input per move
+    n_steps = np.rint((self.maximum - self.minimum) / self.step).astype(int)
+    moves = []
+    for i, steps in enumerate(n_steps):
+      for size in sorted({max(1, int(round(fraction * steps))) for fraction in MOVE_FRACTIONS}):
+        move = np.zeros(len(self.features), dtype=int)
+        move[i] = size
+        moves.append(move)
+    self.moves = np.array(moves)
+
+  def _variants(self, x, steps):
+    """ Return the rows of the patient x moved by |steps| (variants x features) widget steps, rounded as the form """
+    variants = np.tile(x, (len(steps), 1))
+    variants[:, self.columns] = np.round(x[self.columns] + self.direction * steps * self.step, 2)
+    return variants
+
+  def _costs(self, steps):
+    return (steps * self.step / (self.maximum - self.minimum)).sum(axis=1)
+
+  def _max_steps(self, x):
+    """ Return the widget steps left in the direction of an improvement, per feature """
+    current = x[self.columns]
+    room = np.where(self.direction > 0, self.maximum - current, current - self.minimum)
+    return np.floor(np.maximum(room, 0) / self.step + 1e-9).astype(int)
+
+  def _shrink(self, x, steps, target_class):
+    """ Return the steps of a variant shrunk input by input, as long as it stays in the target profile """
+    while True:
+      candidates = []
+      for i in np.flatnonzero(steps):
+        for size in range(steps[i]):
+          candidate = steps.copy()
+          candidate[i] = size
+          candidates.append(candidate)
+      if not candidates:
+        return steps
+      candidates = np.array(candidates)
+      reached = self.scorer.predict_proba(self._variants(x, candidates)).argmax(axis=1) <= target_class
+      if not reached.any():
+        return steps
+      costs = self._costs(candidates)
+      steps = candidates[np.flatnonzero(reached)[np.argmin(costs[reached])]]
+
+  def search(self, x, target_class=0):
+    """ Return the counterfactuals of the patient, smallest change first: [{'changes': {feature: (from, to)},
+    'proba', 'winner_class', 'cost', 'row'}]. Empty if no change of the modifiable inputs reaches the target
+
+    Keyword argument:
+    x            -- the patient's row, in the model's feature order
+    target_class -- the variants must be assigned to this profile or a lower one
+    """
+    x = np.asarray(x, dtype=float).ravel()
+    max_steps = self._max_steps(x)
+    beam = np.zeros((1, len(self.features)), dtype=int)
+    seen = {beam[0].tobytes()}
+    found, best_cost = [], np.inf
+
+    for _ in range(self.max_depth):
+      candidates = (beam[:, None, :] + self.moves[None, :, :]).reshape(-1, len(self.features))
+      candidates = np.unique(np.minimum(candidates, max_steps), axis=0)
+      new = np.array([candidate.tobytes() not in seen for candidate in candidates], dtype=bool)
+      candidates = candidates[new]
+      costs = self._costs(candidates)
+      candidates, costs = candidates[costs < best_cost], costs[costs < best_cost] # Pruned: no smaller change
+      if len(candidates) == 0:
+        break
+      seen.update(candidate.tobytes() for candidate in candidates)
+
+      proba = self.scorer.predict_proba(self._variants(x, candidates)) # One batched call per step
+      reached = proba.argmax(axis=1) <= target_class
+      for i in np.flatnonzero(reached):
+        found.append((costs[i], candidates[i]))
+      if reached.any():
+        best_cost = min(best_cost, costs[reached].min())
+
+      # The variants closest to the target go on
+      remaining = np.flatnonzero(~reached)
+      progress = proba[remaining, :target_class + 1].sum(axis=1)
+      beam = candidates[remaining[np.argsort(-progress, kind='stable')[:self.beam_width]]]
+      if len(beam) == 0:
+        break
+
+    results, kept = [], set()
+    for _, steps in sorted(found, key=lambda item: item[0]):
+      steps = self._shrink(x, steps, target_class)
+      if steps.tobytes() in kept:
+        continue
+      kept.add(steps.tobytes())
+      results.append(steps)
+      if len(results) == MAX_RESULTS:
+        break
+    if not results:
+      return []
+
+    results = np.array(results)
+    rows = self._variants(x, results)
+    proba = self.scorer.predict_proba(rows)
+    costs = self._costs(results)
+    counterfactuals = []
+    for i in np.argsort(costs, kind='stable'):
+      changed = np.flatnonzero(results[i])
+      counterfactuals.append({
+        'changes': {self.features[j]: (float(x[self.columns[j]]), float(rows[i, self.columns[j]])) for j in changed},
+        'proba': proba[i],
+        'winner_class': int(proba[i].argmax()),
+        'cost': float(costs[i]),
+        'row': rows[i]
+      })
+    return counterfactuals
+
+
+def lower_profiles(search, x, winner_class):
+  """ Return {target class: counterfactuals} for every profile lower than the patient's one
+
+  Keyword argument:
+  search       -- CounterfactualSearch
+  x            -- the patient's row, in the model's feature order
+  winner_class -- the patient's profile
+  """
+  return {target_class: search.search(x, target_class) for target_class in range(winner_class)}
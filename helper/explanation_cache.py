@@ -0,0 +1,190 @@
+# Cache of predictions and SHAP explanations.
+# The inputs of the form are bounded and discrete or rounded into 2 decimals, so the same patient vector comes up
+# often. An entry is keyed on the hash of the canonical input vector and of the model artifacts, so a retrained
+# model never serves the explanations of the previous one.
+# Entries are kept in a memory LRU and, optionally, as .npz files in a directory shared between processes.
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+import helper.telemetry as tm
+
+DEFAULT_MAXSIZE = 1024
+DECIMALS = 2 # Same rounding as the inputs of 'Main.py'
+
+
+def canonical_key(row, artifacts_digest, decimals=DECIMALS):
+  """ Return the cache key of a patient
+
+  Keyword argument:
+  row              -- the feature values of the patient, in the model's feature order
+  artifacts_digest -- digest of the model artifacts (see helper.artifacts.file_digest)
+  decimals         -- rounding of the values, so near-duplicate inputs share the key
+  """
+  values = np.round(np.asarray(row, dtype=np.float64).ravel(), decimals) + 0.0 # '+ 0.0' turns -0.0 into 0.0
+  digest = hashlib.sha256(artifacts_digest.encode('utf-8'))
+  digest.update(values.tobytes())
+  return digest.hexdigest()
+
+
+class ExplanationCache:
+  """ Thread-safe LRU cache of {'proba', 'values', 'base_values'} arrays with an optional on-disk layer """
+
+  def __init__(self, maxsize=DEFAULT_MAXSIZE, directory=None):
+    """
+    Keyword argument:
+    maxsize   -- max number of entries kept in memory
+    directory -- folder of the on-disk layer (disabled if None)
+    """
+    self.maxsize = maxsize
+    self.directory = directory
+    self._entries = OrderedDict()
+    self._lock = threading.Lock()
+    self.hits = 0
+    self.disk_hits = 0
+    self.misses = 0
+    if directory is not None:
+      os.makedirs(directory, exist_ok=True)
+
+  def _path(self, key):
+    return os.path.join(self.directory, f'{key}.npz')
+
+  def _remember(self, key, entry):
+    self._entries[key] = entry
+    self._entries.move_to_end(key)
+    while len(self._entries) > self.maxsize:
+      self._entries.popitem(last=False)
+
+  def get(self, key):
+    """ Return the entry of the key or None """
+    with self._lock:
+      if key in self._entries:
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return self._entries[key]
+
+    if self.directory is not None and os.path.exists(self._path(key)):
+      try:
+        with np.load(self._path(key)) as npz_file:
+          entry = {name: npz_file[name] for name in npz_file.files}
+      except (OSError, ValueError):
+        entry = None # A corrupted or partially copied file is treated as a miss and overwritten later
+      if entry is not None:
+        with self._lock:
+          self._remember(key, entry)
+          self.disk_hits += 1
+        return entry
+
+    with self._lock:
+      self.misses += 1
+    return None
+
+  def put(self, key, entry):
+    """ Store the entry (dict of arrays) of the key """
+    entry = {name: np.asarray(value) for name, value in entry.items()}
+    with self._lock:
+      self._remember(key, entry)
+
+    if self.directory is not None:
+      # Written into a temporary file first, so other processes never read a half written entry
+      fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+      try:
+        with os.fdopen(fd, 'wb') as tmp_file:
+          np.savez(tmp_file, **entry)
+        os.replace(tmp_path, self._path(key))
+      except OSError:
+        if os.path.exists(tmp_path):
+          os.remove(tmp_path)
+
+  def clear(self):
+    """ Drop the memory entries and reset the counters (the on-disk entries are kept) """
+    with self._lock:
+      self._entries.clear()
+      self.hits = self.disk_hits = self.misses = 0
+
+  def stats(self):
+    """ Return the hit/miss counters """
+    with self._lock:
+      lookups = self.hits + self.disk_hits + self.misses
+      return {
+        'hits': self.hits,
+        'disk_hits': self.disk_hits,
+        'misses': self.misses,
+        'hit_rate': (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+        'size': len(self._entries),
+        'maxsize': self.maxsize
+      }
+
+
+def predict_and_explain(cache, key, model, explainer, input_row_df):
+  """ Return (probabilities, shap.Explanation) of a single patient, from the cache when possible
+
+  Keyword argument:
+  cache        -- ExplanationCache
+  key          -- the cache key of the patient (see canonical_key)
+  model        -- the fitted pipeline or a scorer with the same predict_proba (helper.compiled_scorer)
+  explainer    -- the SHAP explainer
+  input_row_df -- single row DataFrame of the patient
+  """
+  import shap
+
+  with tm.span('explanation_cache_get'):
+    entry = cache.get(key)
+  if entry is None:
+    with tm.span('predict_proba'):
+      proba = model.predict_proba(input_row_df)
+    with tm.span('shap_explainer'):
+      shap_values = explainer(input_row_df)
+    entry = {'proba': proba, 'values': shap_values.values, 'base_values': shap_values.base_values}
+    cache.put(key, entry)
+
+  shap_values = shap.Explanation(
+    values=entry['values'],
+    base_values=entry['base_values'],
+    data=input_row_df.to_numpy(dtype=float),
+    feature_names=list(input_row_df.columns)
+  )
+  return entry['proba'], shap_values
+
+
+def predict_and_explain_anytime(cache, key, model, explainer, input_row_df, max_evals=None, deadline=None):
+  """ Return (probabilities, helper.anytime_shap.ProgressiveExplanation) of a single patient
+
+  The probabilities and a first SHAP estimate are computed at once, the estimate is refined in a background thread
+  and put into the cache when the whole budget is spent. A cached explanation is returned as done.
+
+  Keyword argument:
+  cache        -- ExplanationCache
+  key          -- the cache key of the patient (see canonical_key)
+  model        -- a scorer with the same predict_proba as the pipeline (helper.compiled_scorer)
+  explainer    -- helper.fast_shap.FastSVCExplainer
+  input_row_df -- single row DataFrame of the patient
+  max_evals    -- evaluation budget of the explanation (the explainer's default if None)
+  deadline     -- seconds after which the refinement stops (no deadline if None)
+  """
+  import helper.anytime_shap as ax
+  import helper.fast_shap as fs
+
+  x = input_row_df.to_numpy(dtype=float)[0]
+  with tm.span('explanation_cache_get'):
+    entry = cache.get(key)
+  if entry is not None:
+    return entry['proba'], ax.ProgressiveExplanation.completed(explainer, x, entry['values'][0], entry['base_values'][0])
+
+  with tm.span('predict_proba'):
+    proba = model.predict_proba(input_row_df)
+
+  def on_done(explanation):
+    # An explanation stopped by the deadline is not as precise as the budget asks, so it is not cached
+    if explanation.complete:
+      values, expected_value = explanation.values()
+      cache.put(key, {'proba': proba, 'values': values[None], 'base_values': expected_value[None]})
+
+  explanation = ax.ProgressiveExplanation(explainer, x, max_evals=max_evals or fs.DEFAULT_MAX_EVALS, deadline=deadline, on_done=on_done)
+  with tm.span('shap_first_estimate'):
+    explanation.start()
+  return proba, explanation
@@ -0,0 +1,130 @@
+# Encoding of the fall events of a patient into the fall related features of the model.
+# Every fall selects one option per group of helper/utils.prop_columns (cause, location, time of the day) and has
+# its days of hospitalization. A selected option adds helper/utils.proportional_weight to its feature ('Other' has
+# no feature); HospDays_min is the fewest days of hospitalization over the falls and HospitalAdmissions the number
+# of falls that ended up in a hospital.
+#   - encode_falls: the falls of a single patient (the fall cards of 'Main.py'), in plain Python,
+#   - encode_events: a table of fall events, one row per fall of many patients (e.g. the export of a records
+#     system), with grouped NumPy reductions.
+# Both give the same values. The output of encode_events is validated as the form's inputs by helper/scoring.py
+# (e.g. no more than 5 falls per patient, see helper/input_schema.py).
+#
+# Usage (from the root folder of the project), the per-patient features of a fall events file:
+#   python -m helper.fall_events events.csv falls.parquet --id-column PatientID
+#   python -m helper.fall_events events.csv cohort.csv --id-column PatientID --patients patients.csv
+import argparse
+import time
+
+import helper.utils as ut
+
+# Columns of a fall events table: {group of helper/utils.prop_columns: column}
+EVENT_COLUMNS = {'Cause': 'cause', 'Location': 'site', 'Time': 'time'}
+HOSPITAL_DAYS_COLUMN = 'hospital_days'
+HOSPITAL_FEATURES = ['HospitalAdmissions', 'HospDays_min']
+
+
+def fall_features():
+  """ Return the fall related features, in the order of helper/utils.prop_columns """
+  return [ut.prop_columns_mapping[option] for options in ut.prop_columns.values() for option in options if option in ut.prop_columns_mapping]
+
+
+def encode_falls(falls):
+  """ Return {feature: value} of the fall related features of a patient
+
+  Keyword argument:
+  falls -- one dict per fall: {group of helper/utils.prop_columns: selected option (None if not selected),
+           'hospital_days': days of hospitalization}
+  """
+  counts = {option: 0 for options in ut.prop_columns.values() for option in options}
+  for fall in falls:
+    for group in ut.prop_columns:
+      if fall.get(group) in counts:
+        counts[fall[group]] += 1
+
+  features = {feature: 0.0 for feature in fall_features()}
+  for option, count in counts.items():
+    if option in ut.prop_columns_mapping: # There is no feature called 'Other'. It's just for convenience of user
+      features[ut.prop_columns_mapping[option]] = round(count * ut.proportional_weight, 2)
+
+  hospital_days = [fall.get(HOSPITAL_DAYS_COLUMN) or 0 for fall in falls]
+  features['HospDays_min'] = min(hospital_days) if hospital_days else 0
+  features['HospitalAdmissions'] = sum(days > 0 for days in hospital_days)
+  return features
+
+
+def encode_events(events, id_column, columns=EVENT_COLUMNS, hospital_days_column=HOSPITAL_DAYS_COLUMN):
+  """ Return a DataFrame of the fall related features, one row per patient (indexed by the patient id, in the
+  order of the patients' first fall). Raise ValueError on an unknown or missing option
+
+  Keyword argument:
+  events               -- DataFrame of fall events, one row per fall
+  id_column            -- column of the patient id
+  columns              -- {group of helper/utils.prop_columns: column of the selected option}
+  hospital_days_column -- column of the days of hospitalization (empty values count as 0)
+  """
+  import numpy as np
+  import pandas as pd
+
+  missing = [column for column in [id_column, hospital_days_column] + list(columns.values()) if column not in events.columns]
+  if missing:
+    raise ValueError(f"The fall events have no column/s named: {', '.join(missing)}")
+
+  patient_codes, patient_ids = pd.factorize(events[id_column], sort=False)
+  if (patient_codes < 0).any():
+    raise ValueError(f"Empty patient id in rows: {np.flatnonzero(patient_codes < 0)[:10].tolist()}")
+  n_patients = len(patient_ids)
+  encoded = {}
+
+  # Falls per (patient, option) of every group: one bincount over patient * options + option
+  for group, column in columns.items():
+    options = ut.prop_columns[group]
+    option_codes = pd.Categorical(events[column], categories=options).codes.astype(np.int64)
+    if (option_codes < 0).any():
+      bad_rows = np.flatnonzero(option_codes < 0)
+      raise ValueError(
+        f"Unknown or empty fall {group.lower()} in rows {bad_rows[:10].tolist()} "
+        f"(e.g. {events[column].iloc[bad_rows[0]]!r}). Allowed: {', '.join(options)}"
+      )
+    counts = np.bincount(patient_codes * len(options) + option_codes, minlength=n_patients * len(options)).reshape(n_patients, len(options))
+    for option_index, option in enumerate(options):
+      if option in ut.prop_columns_mapping:
+        encoded[ut.prop_columns_mapping[option]] = np.round(counts[:, option_index] * ut.proportional_weight, 2)
+
+  # Minimum and count of the days per patient: reduceat over the events sorted by patient
+  hospital_days = pd.to_numeric(events[hospital_days_column], errors='raise').fillna(0).to_numpy()
+  order = np.argsort(patient_codes, kind='stable')
+  starts = np.flatnonzero(np.r_[True, np.diff(patient_codes[order]) != 0])
+  encoded['HospDays_min'] = np.minimum.reduceat(hospital_days[order], starts)
+  encoded['HospitalAdmissions'] = np.bincount(patient_codes, weights=hospital_days > 0, minlength=n_patients)
+
+  frame = pd.DataFrame({feature: encoded[feature] for feature in fall_features() + HOSPITAL_FEATURES}, index=pd.Index(patient_ids, name=id_column))
+  return frame.astype(float)
+
+
+def main(argv=None):
+  import helper.scoring as sc
+  import pandas as pd
+
+  parser = argparse.ArgumentParser(description='Encode a fall events file into the fall related features of every patient.')
+  parser.add_argument('input', help='fall events file (.csv or .parquet), one row per fall')
+  parser.add_argument('output', help='output file (.csv or .parquet), one row per patient')
+  parser.add_argument('--id-column', required=True, help='column of the patient id')
+  parser.add_argument('--patients', default=None, help='file of the other features of the patients (same id column), joined to the output')
+  args = parser.parse_args(argv)
+
+  start = time.perf_counter()
+  events = pd.concat(sc.read_cohort(args.input), ignore_index=True)
+  frame = encode_events(events, args.id_column)
+  if args.patients is not None:
+    patients = pd.concat(sc.read_cohort(args.patients), ignore_index=True)
+    # The fall related features come from the events
+    frame = patients.drop(columns=[column for column in frame.columns if column in patients.columns]).join(frame, on=args.id_column)
+  else:
+    frame = frame.reset_index()
+  with sc.CohortWriter(args.output) as writer:
+    writer.write(frame)
+  print(f"{len(events)} fall events of {len(frame)} patients encoded into '{args.output}' in {time.perf_counter() - start:.1f} s")
+
+
+if __name__ == '__main__':
+  main()
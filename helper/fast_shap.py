@@ -0,0 +1,203 @@
+# SHAP explanations specialised for the StandardScaler + SVC pipeline of 'model/clf_pipeline.pkl'.
+#
+# The pickled explainer ('model/shap_explainer.pkl') is a generic shap PermutationExplainer: for every
+# permutation it calls `predict_proba` of the pipeline separately, on (masks x background rows) samples.
+# Here the same antithetic permutation estimate is computed, but:
+#   (a) the kernel terms of the input row and of the background rows against the support vectors are
+#       computed once, per feature, and every masked sample is assembled from them,
+#   (b) the masked samples of all permutations are evaluated as a single batch,
+#   (c) the probabilities are computed with the libsvm formulas (Platt scaling + pairwise coupling)
+#       on NumPy arrays, without going through sklearn (see helper.compiled_scorer).
+# With the same random permutations the values match the pickled explainer (see check_against_explainer).
+#
+# Usage (from the root folder of the project), compares against the pickled explainer:
+#   python -m helper.fast_shap --rows 20
+import argparse
+import time
+
+import numpy as np
+
+import helper.artifacts as art
+import helper.compiled_scorer as cs
+
+PARITY_TOLERANCE = 1e-6 # Max absolute difference from the pickled explainer, given the same permutations
+DEFAULT_MAX_EVALS = 500 # Same default as shap's PermutationExplainer
+
+
+class FastSVCExplainer:
+  """ Permutation SHAP explainer of a StandardScaler + SVC(probability=True) pipeline """
+
+  def __init__(self, scorer, background, feature_names=None):
+    """
+    Keyword argument:
+    scorer        -- CompiledScorer of the pipeline (helper.compiled_scorer)
+    background    -- (rows x features) background data of the masker
+    feature_names -- feature names (the model's feature order if None)
+    """
+    self.scorer = scorer
+    self.feature_names = list(feature_names if feature_names is not None else scorer.feature_names)
+    self.n_classes = scorer.n_classes
+    self.background = np.asarray(background, dtype=float)
+    self.background_terms = scorer.kernel_terms(self.background) # Computed once, reused for every explanation
+    self.background_terms_sum = self.background_terms.sum(axis=1)
+
+  @classmethod
+  def from_explainer(cls, model, explainer):
+    """ Build from the pipeline and the pickled shap explainer (its masker holds the background data) """
+    return cls(cs.CompiledScorer.from_pipeline(model), explainer.masker.data)
+
+  def predict_proba(self, X):
+    """ Return the probabilities of X, equal to `model.predict_proba(X)` """
+    return self.scorer.predict_proba(X)
+
+  def masked_proba(self, x_terms, masks):
+    """ Return the model output of every mask, averaged over the background rows (masks x classes)
+
+    Keyword argument:
+    x_terms -- kernel terms of the explained row, shape (features x SVs)
+    masks   -- (masks x features) boolean array, True where the feature takes the value of the explained row
+    """
+    masks = np.asarray(masks, dtype=float)
+    n_masks, n_background = masks.shape[0], len(self.background)
+    delta = x_terms[None, :, :] - self.background_terms # (background x features x SVs)
+
+    scorer = self.scorer
+    if scorer.kernel == 'linear' or (scorer.kernel == 'poly' and scorer.degree == 1):
+      # The kernel is affine in the sum of its terms, so the terms are projected on the pairs of classes
+      # (SVs -> pairs) before the masks are applied
+      gamma, coef0 = (1.0, 0.0) if scorer.kernel == 'linear' else (scorer.gamma, scorer.coef0)
+      s = self.background_terms_sum @ scorer.pair_coef # (background x pairs)
+      s = s[None, :, :] + (masks @ (delta @ scorer.pair_coef).transpose(1, 0, 2).reshape(len(x_terms), -1)).reshape(n_masks, n_background, -1)
+      decision_values = gamma * s + coef0 * scorer.pair_coef.sum(axis=0) + scorer.intercept
+      probs = scorer.proba_from_decision(decision_values.reshape(-1, decision_values.shape[-1]))
+    else:
+      s = self.background_terms_sum[None, :, :] + (masks @ delta.transpose(1, 0, 2).reshape(len(x_terms), -1)).reshape(n_masks, n_background, -1)
+      probs = scorer.proba_from_kernel(scorer.apply_kernel(s.reshape(-1, s.shape[-1])))
+    return probs.reshape(n_masks, n_background, self.n_classes).mean(axis=1)
+
+  def varying_features(self, x):
+    """ Return the indexes of the features of x that differ from a background value (the only ones with an effect) """
+    # As in shap's MaskedModel.varying_inputs
+    return np.where(np.any(~np.isclose(x, self.background), axis=0))[0]
+
+  def permutation_values(self, x, inds, npermutations, shuffle):
+    """ Return (values of every permutation (permutations x features x classes), expected values (classes))
+
+    Keyword argument:
+    x             -- the row to explain, in the model's feature order
+    inds          -- the varying features (see varying_features), shuffled in place
+    npermutations -- number of antithetic permutations
+    shuffle       -- the shuffle function of the permutations (e.g. np.random.RandomState(0).shuffle)
+    """
+    n_features = len(x)
+    # Forward: features are switched on in the permutation order, backward: switched off in the same order
+    steps = 2 * len(inds) + 1
+    permutations = []
+    masks = np.zeros((npermutations, steps, n_features), dtype=bool)
+    for k in range(npermutations):
+      shuffle(inds)
+      permutations.append(inds.copy())
+      for t in range(1, len(inds) + 1):
+        masks[k, t, inds[:t]] = True
+        masks[k, len(inds) + t, inds[t:]] = True
+
+    outputs = self.masked_proba(self.scorer.kernel_terms(x[None])[0], masks.reshape(-1, n_features))
+    outputs = outputs.reshape(npermutations, steps, self.n_classes)
+    values = np.zeros((npermutations, n_features, self.n_classes))
+    for k, perm in enumerate(permutations):
+      forward = outputs[k, 1:len(perm) + 1] - outputs[k, :len(perm)]
+      backward = outputs[k, len(perm):-1] - outputs[k, len(perm) + 1:]
+      values[k, perm] = (forward + backward) / 2
+    return values, outputs[0, 0]
+
+  def explain_row(self, x, max_evals=DEFAULT_MAX_EVALS, rng=None):
+    """ Return (values (features x classes), expected values (classes)) of a single row
+
+    Keyword argument:
+    x         -- the row to explain, in the model's feature order
+    max_evals -- evaluation budget, as in shap's PermutationExplainer (defines the number of permutations)
+    rng       -- np.random.RandomState used to shuffle the features (the global NumPy state if None)
+    """
+    x = np.asarray(x, dtype=float)
+    shuffle = rng.shuffle if rng is not None else np.random.shuffle
+    n_features = len(x)
+
+    inds = self.varying_features(x)
+    if len(inds) == 0:
+      expected_value = self.masked_proba(self.scorer.kernel_terms(x[None])[0], np.zeros((1, n_features)))[0]
+      return np.zeros((n_features, self.n_classes)), expected_value
+
+    npermutations = max_evals // (2 * len(inds) + 1)
+    if npermutations == 0:
+      raise ValueError(f"max_evals={max_evals} is too low, it must be at least 2 * num_features + 1 = {2 * len(inds) + 1}!")
+
+    values, expected_value = self.permutation_values(x, inds, npermutations, shuffle)
+    return values.mean(axis=0), expected_value
+
+  def __call__(self, X, max_evals=DEFAULT_MAX_EVALS, rng=None):
+    """ Return a shap.Explanation of X, with the same shape as the pickled explainer (rows x features x classes) """
+    import shap
+    data = np.asarray(X, dtype=float)
+    rows = [self.explain_row(x, max_evals=max_evals, rng=rng) for x in data]
+    return shap.Explanation(
+      values=np.stack([values for values, _ in rows]),
+      base_values=np.stack([expected_value for _, expected_value in rows]),
+      data=data,
+      feature_names=self.feature_names
+    )
+
+
+def check_against_explainer(fast_explainer, explainer, X, seed=0, max_evals=DEFAULT_MAX_EVALS):
+  """ Return the max absolute difference of the SHAP values and base values from the pickled explainer
+
+  Both explainers use the same random permutations (the pickled one shuffles through the global NumPy state).
+
+  Keyword argument:
+  fast_explainer -- FastSVCExplainer
+  explainer      -- the pickled shap explainer
+  X              -- DataFrame of rows to explain
+  seed           -- seed of the permutations
+  """
+  max_diff = 0.0
+  for i in range(len(X)):
+    row = X.iloc[[i]]
+    np.random.seed(seed + i)
+    expected = explainer(row, max_evals=max_evals, silent=True)
+    actual = fast_explainer(row, max_evals=max_evals, rng=np.random.RandomState(seed + i))
+    max_diff = max(
+      max_diff,
+      np.abs(expected.values - actual.values).max(),
+      np.abs(expected.base_values - actual.base_values).max()
+    )
+  return max_diff
+
+
+def main(argv=None):
+  import pandas as pd
+
+  parser = argparse.ArgumentParser(description='Compare the fast SVC explainer against the pickled SHAP explainer.')
+  parser.add_argument('--rows', type=int, default=20, help='number of background rows to explain')
+  args = parser.parse_args(argv)
+
+  model = art.load_model()
+  explainer = art.load_shap_explainer()
+  fast_explainer = FastSVCExplainer.from_explainer(model, explainer)
+  X = pd.DataFrame(explainer.masker.data[:args.rows], columns=fast_explainer.feature_names)
+
+  prob_diff = np.abs(fast_explainer.predict_proba(X) - model.predict_proba(X)).max()
+  shap_diff = check_against_explainer(fast_explainer, explainer, X)
+
+  start = time.perf_counter()
+  for i in range(len(X)):
+    fast_explainer(X.iloc[[i]])
+  elapsed = (time.perf_counter() - start) / len(X)
+
+  print(f"predict_proba max abs difference: {prob_diff:.2e}")
+  print(f"SHAP values max abs difference:   {shap_diff:.2e} (tolerance {PARITY_TOLERANCE:.0e})")
+  print(f"Fast explainer: {elapsed * 1000:.1f} ms per row")
+  if shap_diff > PARITY_TOLERANCE:
+    raise SystemExit('The fast explainer does not match the pickled explainer.')
+
+
+if __name__ == '__main__':
+  main()
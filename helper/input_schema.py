@@ -0,0 +1,343 @@
+# Declarative schema of the patient inputs, shared by the form of 'Main.py' and the batch paths (helper/scoring.py,
+# helper/service.py).
+# The schema is built once from the column groups ('data/columns_types.pkl', or the artifact bundle), the limits of
+# the widgets (helper/utils.functional_test_data and helper/utils.feature_ranges) and the fall options
+# (helper/utils.prop_columns). Every field has a kind (numerical, ordinal, binary, proportional or categorical),
+# its range, its step and whether it is required; the fall related features are also checked together (rules):
+# the fall times add up to 1 to 5 falls, there are no more causes, sites or hospital admissions than falls.
+# A single form (a dict of values) and a whole cohort (a DataFrame, or a dict of columns) are validated the same
+# way, field by field, with NumPy masks over the rows. The result lists every (row, field, message) error.
+#
+# Usage (from the root folder of the project), validate a cohort file:
+#   python -m helper.input_schema cohort.parquet --errors errors.csv
+import argparse
+import time
+
+import helper.utils as ut
+
+NUMERICAL = 'numerical'
+ORDINAL = 'ordinal'
+BINARY = 'binary'
+PROPORTIONAL = 'proportional'
+CATEGORICAL = 'categorical' # Selectbox of the form, e.g. the options of a fall card (not a feature of the model)
+TOLERANCE = 1e-6 # Of the steps and of the sums of the proportional features (they are rounded into 2 decimals)
+MAX_REPORTED_ERRORS = 10 # Errors listed in the message of a rejected cohort
+
+MISSING_MESSAGE = 'must be filled'
+
+
+class Field:
+  """ A single input: its kind, range, step and whether it is required """
+
+  def __init__(self, name, kind, label=None, minimum=None, maximum=None, step=None, options=None, required=True):
+    """
+    Keyword argument:
+    name     -- the feature (or widget key) name
+    kind     -- NUMERICAL, ORDINAL, BINARY, PROPORTIONAL or CATEGORICAL
+    label    -- the name shown in the messages (the name if None)
+    minimum  -- lowest allowed value (no limit if None)
+    maximum  -- highest allowed value (no limit if None)
+    step     -- the values are multiples of step above minimum, e.g. 1 for integers (any value if None)
+    options  -- allowed values of a CATEGORICAL field
+    required -- an empty value is an error. Empty values of the other fields count as 0
+    """
+    self.name = name
+    self.kind = kind
+    self.label = label or name
+    self.minimum = minimum
+    self.maximum = maximum
+    self.step = step
+    self.options = list(options) if options is not None else None
+    self.required = required
+
+  def __repr__(self):
+    return f"Field({self.name!r}, {self.kind!r}, minimum={self.minimum}, maximum={self.maximum}, step={self.step})"
+
+
+class Rule:
+  """ A check of several fields of a row, run on the rows whose fields are all valid """
+
+  def __init__(self, name, fields, check, message):
+    """
+    Keyword argument:
+    name    -- reported as the field of the error
+    fields  -- the fields the check reads
+    check   -- function of {field: float array} that returns the boolean mask of the invalid rows
+    message -- the error message
+    """
+    self.name = name
+    self.fields = list(fields)
+    self.check = check
+    self.message = message
+
+
+class ValidationReport:
+  """ Errors of a validation: (rows, field, message) per failed check """
+
+  def __init__(self, n_rows, failures):
+    self.n_rows = n_rows
+    self.failures = failures # [(row indexes array, field, message)]
+
+  @property
+  def ok(self):
+    return not self.failures
+
+  def invalid_rows(self):
+    """ Return the sorted indexes of the rows with at least one error """
+    import numpy as np
+    if not self.failures:
+      return np.zeros(0, dtype=np.int64)
+    return np.unique(np.concatenate([rows for rows, _, _ in self.failures]))
+
+  def counts(self):
+    """ Return {field: number of invalid rows} """
+    counts = {}
+    for rows, field, _ in self.failures:
+      counts[field] = counts.get(field, 0) + len(rows)
+    return counts
+
+  def errors(self, limit=None):
+    """ Return [(row, field, message)] sorted by row, the first |limit| ones if limit is not None """
+    import numpy as np
+    if not self.failures:
+      return []
+    rows = np.concatenate([failure[0] for failure in self.failures])
+    failure_ids = np.concatenate([np.full(len(failure[0]), i) for i, failure in enumerate(self.failures)])
+    order = np.lexsort((failure_ids, rows))
+    if limit is not None:
+      order = order[:limit]
+    return [(int(rows[i]), self.failures[failure_ids[i]][1], self.failures[failure_ids[i]][2]) for i in order]
+
+  def to_frame(self):
+    """ Return the errors as a DataFrame with the columns: row, field, message """
+    import pandas as pd
+    return pd.DataFrame(self.errors(), columns=['row', 'field', 'message'])
+
+  def raise_for_errors(self, first_row=0):
+    """ Raise ValueError with the first errors if there are any
+
+    Keyword argument:
+    first_row -- added to the row indexes of the message (e.g. the first row of a chunk)
+    """
+    if self.failures:
+      errors = self.errors(MAX_REPORTED_ERRORS)
+      listed = '; '.join(f"row {row + first_row}: '{field}' {message}" for row, field, message in errors)
+      raise ValueError(f"{len(self.invalid_rows())} invalid row/s. {listed}")
+
+
+class InputSchema:
+  """ The fields and the rules of the inputs """
+
+  def __init__(self, fields, rules=()):
+    self.fields = {field.name: field for field in fields}
+    self.rules = list(rules)
+
+  def with_fields(self, fields):
+    """ Return a copy of the schema with extra fields (e.g. the widgets of the form) """
+    return InputSchema(list(self.fields.values()) + list(fields), self.rules)
+
+  def _columns(self, data):
+    """ Return (number of rows, {name: column}) of a dict of values, a dict of columns or a DataFrame """
+    import numpy as np
+    columns = {name: data[name] for name in self.fields if name in data}
+    if not columns:
+      return (len(data) if hasattr(data, 'columns') else 1), columns
+    if all(np.ndim(column) == 0 for column in columns.values()):
+      return 1, {name: [value] for name, value in columns.items()}
+    return len(next(iter(columns.values()))), columns
+
+  def _numbers(self, column):
+    """ Return (float array, mask of the empty values, mask of the values that are not numbers) of a column """
+    import numpy as np
+    import pandas as pd
+    values = np.asarray(column.to_numpy() if hasattr(column, 'to_numpy') else column)
+    if values.dtype.kind in 'biuf':
+      values = values.astype(float, copy=False)
+      empty = np.isnan(values)
+      return values, empty, np.zeros(len(values), dtype=bool)
+    empty = pd.isna(values)
+    numbers = pd.to_numeric(pd.Series(values), errors='coerce').to_numpy(dtype=float)
+    return numbers, empty, np.isnan(numbers) & ~empty
+
+  def validate(self, data):
+    """ Return the ValidationReport of the data
+
+    Keyword argument:
+    data -- a single row ({field: value}), or many: a DataFrame or {field: column}. The fields that are not in
+            the schema are ignored, the missing required ones are errors of every row
+    """
+    import numpy as np
+    n_rows, columns = self._columns(data)
+    failures = []
+    invalid = np.zeros(n_rows, dtype=bool)
+    values = {}
+
+    def fail(mask, name, message):
+      if mask.any():
+        failures.append((np.flatnonzero(mask), name, message))
+        invalid[mask] = True
+
+    for name, field in self.fields.items():
+      if name not in columns:
+        if field.required:
+          fail(np.ones(n_rows, dtype=bool), name, MISSING_MESSAGE)
+        continue
+
+      if field.kind == CATEGORICAL:
+        column = np.asarray(columns[name], dtype=object)
+        empty = np.array([value is None or value != value for value in column], dtype=bool)
+        if field.required:
+          fail(empty, name, MISSING_MESSAGE)
+        allowed = set(field.options)
+        fail(np.array([value not in allowed for value in column], dtype=bool) & ~empty, name, f"must be one of: {', '.join(map(str, field.options))}")
+        continue
+
+      numbers, empty, not_number = self._numbers(columns[name])
+      fail(not_number, name, 'must be a number')
+      if field.required:
+        fail(empty, name, MISSING_MESSAGE)
+      numbers = np.where(empty, 0.0, numbers)
+      valid = ~empty & ~not_number
+      if field.minimum is not None or field.maximum is not None:
+        low = -np.inf if field.minimum is None else field.minimum
+        high = np.inf if field.maximum is None else field.maximum
+        fail(valid & ((numbers < low - TOLERANCE) | (numbers > high + TOLERANCE)), name, f"must be between {low} and {high}")
+      if field.kind == BINARY:
+        fail(valid & (numbers != 0) & (numbers != 1), name, 'must be 0 (No) or 1 (Yes)')
+      elif field.step is not None:
+        steps = (numbers - (field.minimum or 0)) / field.step
+        fail(valid & (np.abs(steps - np.round(steps)) > TOLERANCE), name, f"must be a multiple of {field.step}")
+      values[name] = numbers
+
+    # The rules read valid fields only, so an error is reported once
+    valid_rows = ~invalid
+    for rule in self.rules:
+      if all(name in values for name in rule.fields):
+        fail(valid_rows & rule.check(values), rule.name, rule.message)
+    return ValidationReport(n_rows, failures)
+
+
+def _group_features(group):
+  """ Return the features of the options of a group of the fall cards ('Other' has no feature) """
+  return [ut.prop_columns_mapping[option] for option in ut.prop_columns[group] if option in ut.prop_columns_mapping]
+
+
+def _falls(values):
+  """ Return the number of falls of every row: every fall has a time of the day """
+  return sum(values[feature] for feature in _group_features('Time')) / ut.proportional_weight
+
+
+def _more_than_falls(group):
+  def check(values):
+    return sum(values[feature] for feature in _group_features(group)) / ut.proportional_weight > _falls(values) + TOLERANCE
+  return check
+
+
+def _fall_count(values):
+  falls = _falls(values)
+  return (falls < 1 - TOLERANCE) | (falls > ut.max_falls + TOLERANCE)
+
+
+def _hospital_admissions(values):
+  return values['HospitalAdmissions'] > _falls(values) + TOLERANCE
+
+
+def _hospital_days(values):
+  import numpy as np
+  # The minimum is over every fall: it is 0 unless every fall ended up in a hospital
+  every_fall_admitted = np.abs(values['HospitalAdmissions'] - _falls(values)) <= TOLERANCE
+  return every_fall_admitted != (values['HospDays_min'] > 0)
+
+
+def build_schema(columns_types):
+  """ Return the InputSchema of the model's features
+
+  Keyword argument:
+  columns_types -- the column groups of 'data/columns_types.pkl' (numerical, ordinal, binary, proportional)
+  """
+  numerical_columns, ordinal_columns, binary_columns, prop_columns = columns_types
+  ranges = dict(ut.feature_ranges)
+  for i, column in enumerate(ut.functional_test_data['column']):
+    ranges[column] = {key: ut.functional_test_data[key][i] for key in ('type', 'min', 'max', 'step')}
+
+  fields = []
+  for kind, columns in ((NUMERICAL, numerical_columns), (ORDINAL, ordinal_columns)):
+    for column in columns:
+      if column not in ranges:
+        raise ValueError(f"No range of the {kind} feature '{column}' (see helper/utils.feature_ranges)")
+      limits = ranges[column]
+      # Integers are on a grid of 1, the step of a float widget is not enforced (its format rounds the value)
+      step = 1 if limits['type'] == 'int' else None
+      fields.append(Field(column, kind, minimum=limits['min'], maximum=limits['max'], step=step))
+  for column in binary_columns:
+    fields.append(Field(column, BINARY, label=column.split('_', 1)[-1]))
+  for column in prop_columns:
+    # Missing fall options count as 0, as the options the fall cards did not select
+    fields.append(Field(column, PROPORTIONAL, minimum=0.0, maximum=ut.max_falls * ut.proportional_weight, step=ut.proportional_weight, required=False))
+
+  time_features = _group_features('Time')
+  rules = [
+    Rule('FallTime', time_features, _fall_count, f"the fall times must add up to 1 to {ut.max_falls} falls ({ut.proportional_weight} per fall)"),
+    Rule('FallCause', _group_features('Cause') + time_features, _more_than_falls('Cause'), 'more fall causes than falls'),
+    Rule('FallSiteMerged', _group_features('Location') + time_features, _more_than_falls('Location'), 'more fall sites than falls'),
+    Rule('HospitalAdmissions', ['HospitalAdmissions'] + time_features, _hospital_admissions, 'more hospital admissions than falls'),
+    Rule('HospDays_min', ['HospDays_min', 'HospitalAdmissions'] + time_features, _hospital_days, 'must be above 0 if, and only if, every fall was hospitalized'),
+  ]
+  # A rule is kept if the features it reads are features of the model
+  names = {field.name for field in fields}
+  return InputSchema(fields, [rule for rule in rules if set(rule.fields) <= names])
+
+
+def fall_card_fields(falls_no):
+  """ Return the CATEGORICAL fields of the fall cards of the form (keys '{group}_fall_{fall index}')
+
+  Keyword argument:
+  falls_no -- number of fall cards
+  """
+  return [
+    Field(f"{group}_fall_{i}", CATEGORICAL, label=group, options=options)
+    for i in range(1, falls_no + 1) for group, options in ut.prop_columns.items()
+  ]
+
+
+def main(argv=None):
+  import helper.artifact_bundle as ab
+  import helper.scoring as sc
+
+  parser = argparse.ArgumentParser(description='Validate a cohort file against the input schema of the model.')
+  parser.add_argument('input', help='cohort file (.csv or .parquet)')
+  parser.add_argument('--errors', default=None, help='output file (.csv or .parquet) of every (row, field, message) error')
+  parser.add_argument('--chunksize', type=int, default=1_000_000, help='rows validated at once')
+  args = parser.parse_args(argv)
+
+  schema = build_schema(ab.ArtifactBundle(verify=False).columns_types)
+  start = time.perf_counter()
+  n_rows, n_invalid, counts = 0, 0, {}
+  writer = sc.CohortWriter(args.errors) if args.errors else None
+  try:
+    for chunk in sc.read_cohort(args.input, args.chunksize):
+      report = schema.validate(chunk)
+      n_invalid += len(report.invalid_rows())
+      for field, count in report.counts().items():
+        counts[field] = counts.get(field, 0) + count
+      if writer is not None and not report.ok:
+        errors = report.to_frame()
+        errors['row'] += n_rows
+        writer.write(errors)
+      n_rows += len(chunk)
+  except BaseException:
+    if writer is not None:
+      writer.discard()
+    raise
+  if writer is not None:
+    writer.close()
+
+  print(f"{n_rows} rows validated in {time.perf_counter() - start:.2f} s, {n_invalid} invalid")
+  for field, count in sorted(counts.items(), key=lambda item: -item[1]):
+    print(f"  {field}: {count}")
+  if n_invalid:
+    raise SystemExit(1)
+
+
+if __name__ == '__main__':
+  main()
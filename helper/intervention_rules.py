@@ -0,0 +1,100 @@
+# Personalised selection of the interventions.
+# The fall location of a patient forms a bitmask of flags (indoor, outdoor); every (profile, flags) pair is
+# compiled once into the list of sections of 'data/interventions.json' to show, so the selection is a single
+# lookup. The flags are computed for one patient {feature: value} as well as for a cohort DataFrame, whose fall
+# location is inferred from the fall sites.
+import numpy as np
+
+import helper.artifacts as art
+
+# Fall location of the form -> location flags
+LOCATIONS = {'Indoor': ('indoor',), 'Outdoor': ('outdoor',), 'Both': ('indoor', 'outdoor')}
+# Sections of the profiles that are shown only for a fall location
+LOCATION_SECTIONS = {'indoor_interventions': 'indoor', 'outdoor_interventions': 'outdoor'}
+FLAGS = ('indoor', 'outdoor') # Bit i of a mask is FLAGS[i]
+INDOOR_SITES = ['FallSiteMerged_Bedroom', 'FallSiteMerged_Bathroom']
+OUTDOOR_SITES = ['FallSiteMerged_YardBalcony', 'FallSiteMerged_PavementRoad']
+
+
+def _any_site(X, sites):
+  fell = X[sites[0]] > 0
+  for site in sites[1:]:
+    fell = fell | (X[site] > 0)
+  return np.asarray(fell, dtype=bool)
+
+
+def location_flags(X, location_type=None):
+  """ Return the mask of the active flags: an int for a patient, an array of ints for a cohort
+
+  Keyword argument:
+  X             -- {feature: value} of a patient or DataFrame of a cohort
+  location_type -- fall location of the form ("Indoor", "Outdoor", "Both"). If None it is inferred from the
+                   fall sites (Bedroom, Bathroom -> indoor, Yard or Balcony, Pavement or Road -> outdoor),
+                   both when they tell neither
+  """
+  active = {}
+  if location_type is None:
+    indoor, outdoor = _any_site(X, INDOOR_SITES), _any_site(X, OUTDOOR_SITES)
+    unknown = ~indoor & ~outdoor
+    active['indoor'], active['outdoor'] = indoor | unknown, outdoor | unknown
+  elif location_type in LOCATIONS:
+    for flag in FLAGS:
+      active[flag] = np.asarray(flag in LOCATIONS[location_type])
+  else:
+    raise ValueError(f"Unknown fall location '{location_type}'. Allowed values: {', '.join(LOCATIONS)}")
+
+  mask = sum(active[flag].astype(np.int64) << bit for bit, flag in enumerate(FLAGS))
+  return int(mask) if np.ndim(mask) == 0 else mask
+
+
+def active_flags(mask):
+  """ Return the names of the active flags of the mask """
+  return [flag for bit, flag in enumerate(FLAGS) if mask >> bit & 1]
+
+
+def compile_sections(class_data, mask):
+  """ Return the intervention sections of the profile for the flags of the mask
+
+  Keyword argument:
+  class_data -- intervention data of the profile (an entry of 'data/interventions.json')
+  mask       -- flags (see location_flags)
+  """
+  flags = set(active_flags(mask))
+  return tuple(
+    section for section in class_data['interventions']
+    if section['code'] not in LOCATION_SECTIONS or LOCATION_SECTIONS[section['code']] in flags
+  )
+
+
+class DecisionTable:
+  """ The intervention sections of every (profile, flags) pair, compiled once """
+
+  def __init__(self, interventions):
+    """
+    Keyword argument:
+    interventions -- {class key: intervention data of the profile} ('data/interventions.json')
+    """
+    self.table = {
+      (class_key, mask): compile_sections(class_data, mask)
+      for class_key, class_data in interventions.items()
+      for mask in range(1 << len(FLAGS))
+    }
+    self.codes = {key: ';'.join(section['code'] for section in sections) for key, sections in self.table.items()}
+
+  @classmethod
+  def from_files(cls, interventions_path=art.INTERVENTIONS_PATH):
+    """ Return the table of the content file """
+    return cls(art.load_intervention_data(interventions_path))
+
+  def select(self, class_key, mask):
+    """ Return the intervention sections of the profile ('class_0', ...) for the flags of the mask """
+    return self.table[(class_key, mask)]
+
+  def select_codes(self, winner_classes, masks):
+    """ Return the section codes, joined by ';', of every patient of a cohort
+
+    Keyword argument:
+    winner_classes -- class id of every patient
+    masks          -- flags of every patient (see location_flags)
+    """
+    return [self.codes[(f"class_{class_id}", mask)] for class_id, mask in zip(np.asarray(winner_classes).tolist(), np.asarray(masks).tolist())]
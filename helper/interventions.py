@@ -1,11 +1,11 @@
 import streamlit as st
 
-def render_interventions(class_data, location_type):
+def render_interventions(class_data, sections):
   """ Returns the UI interventions for the specified elder.
 
   Keyword argument:
-  class_data    -- intervention data for the specified elder
-  location_type -- The location type of elder's fall/s (possible values: "indoor", "outdoor", "both")
+  class_data -- intervention data for the specified elder
+  sections   -- intervention sections selected for the elder's fall location (see helper/intervention_rules.py)
   """
 
   # Check if class_data exist
@@ -32,20 +32,8 @@ def render_interventions(class_data, location_type):
   st.space()
   st.caption("🛠 Recommended Interventions")
 
-  # Rule-based filter of the location type of fall/s of elder
-  blocked_intervention = ""
-  match location_type:
-    case "Indoor":
-      blocked_intervention = "outdoor_interventions"
-    case "Outdoor":
-      blocked_intervention = "indoor_interventions"
-    case "Both":
-      blocked_intervention = ""
-
   # Recommendations-Interventions based on: (a) class and (b) personalized fall/s conditions
-  for section in class_data["interventions"]:
-    if (section["code"] == blocked_intervention):
-      continue
+  for section in sections:
     with st.expander(section["title"], expanded=True):
       for item in section["items"]:
         st.markdown(f"• {item}")
\ No newline at end of file
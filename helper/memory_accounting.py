@@ -0,0 +1,219 @@
+# Memory accounting of the app: the bytes retained by every session and by the caches shared by the sessions.
+# The bytes of an object are counted by walking what it references (containers, attributes, NumPy arrays,
+# pandas frames). The objects shared by the sessions (the model version, the explainer, the caches) are counted
+# once, as caches, and not again in every session that references them. Memory-mapped arrays (the artifact
+# bundle, see helper/artifact_bundle.py) are file pages shared by the processes, they count as 0.
+# A submit only sizes the state of its own session, recorded into a SessionLedger. The shared caches are sized by
+# a MemoryMonitor, in a background thread, and the totals are exported as gauges along with the timing metrics
+# (see helper/telemetry.py).
+# Standard library only: NumPy and pandas objects are recognised without importing them.
+import logging
+import mmap
+import os
+import resource
+import sys
+import threading
+import time
+import types
+from collections import OrderedDict, deque
+
+import helper.telemetry as tm
+
+DEFAULT_SESSION_MAX_MB = 16 # Bytes of the results a session keeps, at least the last one is always kept
+DEFAULT_MONITOR_SECONDS = 30 # Period of the sizing of the shared caches
+SESSION_TTL_SECONDS = 3600 # A session that has not submitted for this long is dropped from the ledger
+MAX_SESSIONS = 10_000 # Sessions kept by the ledger
+
+# Referenced, but neither owned nor walked: code, classes, threads
+_NOT_WALKED = (
+  type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType, types.MethodType, types.CodeType,
+  threading.Thread
+)
+
+
+def _is_mapped(array):
+  """ True if the NumPy array is a view of a memory-mapped file """
+  while array is not None:
+    if type(array).__name__ == 'memmap' or isinstance(array, mmap.mmap):
+      return True
+    array = getattr(array, 'base', None)
+  return False
+
+
+def deep_sizeof(obj, exclude=()):
+  """ Return the bytes retained by the object and by everything it references
+
+  Keyword argument:
+  obj     -- the object
+  exclude -- objects that are not counted (nor what they reference), e.g. the shared caches
+  """
+  seen = {id(excluded) for excluded in exclude}
+  stack = [obj]
+  total = 0
+  while stack:
+    current = stack.pop()
+    if id(current) in seen:
+      continue
+    seen.add(id(current))
+    module = type(current).__module__
+    if isinstance(current, _NOT_WALKED):
+      continue
+
+    if module.startswith('numpy') and hasattr(current, 'nbytes'):
+      if _is_mapped(current):
+        continue
+      total += sys.getsizeof(current) # With its data if it owns it
+      if getattr(current, 'base', None) is not None:
+        stack.append(current.base)
+      continue
+    if module.startswith('pandas') and hasattr(current, 'memory_usage'):
+      usage = current.memory_usage(deep=True)
+      total += int(usage.sum()) if hasattr(usage, 'sum') else int(usage)
+      continue
+
+    total += sys.getsizeof(current)
+    if isinstance(current, dict):
+      stack.extend(current.keys())
+      stack.extend(current.values())
+    elif isinstance(current, (list, tuple, set, frozenset, deque)):
+      stack.extend(current)
+    elif not isinstance(current, (str, bytes, bytearray, int, float, complex, bool)):
+      if hasattr(current, '__dict__'):
+        stack.append(vars(current))
+      for slot in getattr(type(current), '__slots__', ()):
+        if hasattr(current, slot):
+          stack.append(getattr(current, slot))
+  return total
+
+
+def resident_set_size():
+  """ Return the resident set size of the process (bytes) """
+  try:
+    with open('/proc/self/statm', encoding='ascii') as statm:
+      return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+  except OSError: # Not Linux: the peak resident set size instead
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def bound_results(results, max_bytes, exclude=()):
+  """ Drop the oldest results of a session until they fit in max_bytes (the last one is kept). Return their bytes
+
+  Keyword argument:
+  results   -- the ResultStore of the session (see helper/result_store.py)
+  max_bytes -- bytes the results may retain
+  exclude   -- shared objects, not counted (see deep_sizeof)
+  """
+  size = deep_sizeof(results, exclude)
+  while len(results) > 1 and size > max_bytes:
+    results.pop_oldest()
+    size = deep_sizeof(results, exclude)
+  return size
+
+
+class SessionLedger:
+  """ Thread-safe record of the bytes retained by the sessions of the process """
+
+  def __init__(self, ttl=SESSION_TTL_SECONDS, maxsize=MAX_SESSIONS):
+    """
+    Keyword argument:
+    ttl     -- seconds after which a session that was not recorded again is dropped
+    maxsize -- sessions kept, the least recently recorded ones are dropped first
+    """
+    self.ttl = ttl
+    self.maxsize = maxsize
+    self._sessions = OrderedDict() # {session id: (time, {session state key: bytes})}
+    self._lock = threading.Lock()
+
+  def record(self, session_id, sizes):
+    """ Record the bytes of the session
+
+    Keyword argument:
+    session_id -- id of the session
+    sizes      -- {session state key: bytes}
+    """
+    now = time.monotonic()
+    with self._lock:
+      self._sessions[session_id] = (now, dict(sizes))
+      self._sessions.move_to_end(session_id)
+      while self._sessions and (len(self._sessions) > self.maxsize or now - next(iter(self._sessions.values()))[0] > self.ttl):
+        self._sessions.popitem(last=False)
+
+  def sessions(self):
+    """ Return {session id: bytes} """
+    with self._lock:
+      return {session_id: sum(sizes.values()) for session_id, (_, sizes) in self._sessions.items()}
+
+  def stats(self):
+    """ Return the number of sessions, their total and their max bytes, and the total bytes per session state key """
+    with self._lock:
+      totals = [sum(sizes.values()) for _, sizes in self._sessions.values()]
+      keys = {}
+      for _, sizes in self._sessions.values():
+        for key, size in sizes.items():
+          keys[key] = keys.get(key, 0) + size
+    return {'sessions': len(totals), 'bytes': sum(totals), 'max_bytes': max(totals, default=0), 'keys': keys}
+
+
+class MemoryMonitor:
+  """ Sizes the caches shared by the sessions in a background thread and exports the gauges of the memory """
+
+  def __init__(self, caches, versions=None, ledger=None):
+    """
+    Keyword argument:
+    caches   -- {name: cache shared by the sessions}
+    versions -- {name: function returning the version of the cache}: the cache is sized again only when its
+                version changes (a constant for a cache that never changes). The other caches are sized every time
+    ledger   -- SessionLedger of the sessions (a new one if None)
+    """
+    self.caches = caches
+    self.versions = versions or {}
+    self.ledger = ledger if ledger is not None else SessionLedger()
+    self.cache_bytes = {}
+    self._sized = {} # {name: version of the cache when it was sized}
+    self._thread = None
+    self._stop = threading.Event()
+
+  def update(self):
+    """ Size the caches (see versions) and export the gauges """
+    for name, cache in self.caches.items():
+      version = self.versions[name]() if name in self.versions else object()
+      if name in self._sized and self._sized[name] == version:
+        continue
+      try:
+        self.cache_bytes[name] = deep_sizeof(cache, [other for other in self.caches.values() if other is not cache])
+      except RuntimeError: # Changed by a session while it was walked, sized again next time
+        continue
+      self._sized[name] = version
+
+    stats = self.ledger.stats()
+    help_text = 'Bytes retained by the session state of the sessions of the process.'
+    tm.REGISTRY.set_gauge('session_retained_bytes', help_text, stats['bytes'], stat='total')
+    tm.REGISTRY.set_gauge('session_retained_bytes', help_text, stats['max_bytes'], stat='max')
+    tm.REGISTRY.set_gauge('sessions_tracked', 'Sessions recorded by the memory accounting.', stats['sessions'])
+    for name, size in self.cache_bytes.items():
+      tm.REGISTRY.set_gauge('cache_retained_bytes', 'Bytes retained by the caches shared by the sessions.', size, cache=name)
+    tm.REGISTRY.set_gauge('process_resident_bytes', 'Resident set size of the process.', resident_set_size())
+
+  def _watch(self, interval):
+    while True:
+      try:
+        with tm.span('memory_accounting'):
+          self.update()
+      except Exception as e: # The monitor must outlive any error, it only exports gauges
+        tm.log_event('memory_monitor_error', level=logging.ERROR, error=repr(e))
+      if self._stop.wait(interval):
+        return
+
+  def start(self, interval=DEFAULT_MONITOR_SECONDS):
+    """ Size the caches now and every interval seconds, in a background thread. Return self """
+    if self._thread is None:
+      self._thread = threading.Thread(target=self._watch, args=(interval,), name='epif-memory-monitor', daemon=True)
+      self._thread.start()
+    return self
+
+  def stop(self):
+    self._stop.set()
+    if self._thread is not None:
+      self._thread.join()
+      self._thread = None
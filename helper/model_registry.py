@@ -0,0 +1,165 @@
+# Registry of the model version that serves the predictions, reloaded without a restart.
+# A thread watches the manifest of the artifact bundle (helper/artifact_bundle.py). When a new bundle is exported,
+# it is opened and checked, warmed up with a few predictions and explanations of its background rows, and only
+# then swapped in: the requests that start after the swap get the new version, the ones already running (and the
+# results already shown) keep the version they started with, whose memory-mapped arrays stay valid.
+# A new bundle that fails its checks or its warm-up, or whose feature schema differs from the current one (the
+# form of the app is built on it, so a restart is needed), is rejected and the current version keeps serving.
+#
+# Usage (from the root folder of the project), watch the bundle and print the swaps:
+#   python -m helper.model_registry --poll-seconds 2
+import argparse
+import logging
+import os
+import threading
+import time
+
+import helper.artifact_bundle as ab
+import helper.telemetry as tm
+
+DEFAULT_POLL_SECONDS = 5.0
+WARM_UP_ROWS = 4 # Background rows predicted and explained before a swap
+WARM_UP_MAX_EVALS = 200
+
+
+class ModelVersion:
+  """ A loaded bundle; the scorer and the explainer are built on first use """
+
+  def __init__(self, bundle):
+    self.bundle = bundle
+    self.version = bundle.digest[:12]
+    self.digest = bundle.digest
+    self.created = bundle.manifest.get('created')
+    self._lock = threading.Lock()
+    self._scorer = None
+    self._explainer = None
+
+  @property
+  def scorer(self):
+    """ CompiledScorer of the version """
+    with self._lock:
+      if self._scorer is None:
+        self._scorer = self.bundle.scorer()
+      return self._scorer
+
+  @property
+  def explainer(self):
+    """ FastSVCExplainer of the version """
+    scorer = self.scorer
+    with self._lock:
+      if self._explainer is None:
+        import helper.fast_shap as fs
+        self._explainer = fs.FastSVCExplainer(scorer, self.bundle.background())
+      return self._explainer
+
+  def warm_up(self, rows=WARM_UP_ROWS, max_evals=WARM_UP_MAX_EVALS):
+    """ Predict and explain a few background rows. Raise ValueError if the outputs are not probabilities """
+    import numpy as np
+    X = np.asarray(self.bundle.background()[:rows], dtype=float)
+    proba = self.scorer.predict_proba(X)
+    if not (np.all(np.isfinite(proba)) and np.allclose(proba.sum(axis=1), 1.0)):
+      raise ValueError(f"The model version {self.version} does not return probabilities")
+    for x in X:
+      self.explainer.explain_row(x, max_evals=max_evals, rng=np.random.RandomState(0))
+
+
+class ModelRegistry:
+  """ Holds the current ModelVersion and swaps in the new bundles """
+
+  def __init__(self, directory=ab.BUNDLE_DIR, check_sources=True):
+    """
+    Keyword argument:
+    directory     -- folder of the artifact bundle
+    check_sources -- reject a first bundle exported from other pickles than the current ones
+    """
+    self.directory = directory
+    self._lock = threading.Lock()
+    self._thread = None
+    self._stop = threading.Event()
+    self.swaps = 0
+    self.rejected = 0
+    self._signature = self._manifest_signature()
+    bundle = ab.ArtifactBundle(directory)
+    if check_sources and bundle.stale_sources():
+      raise ValueError(f"The artifact bundle is out of date ({', '.join(bundle.stale_sources())} changed). Export it again with: python -m helper.artifact_bundle --export")
+    self._current = ModelVersion(bundle)
+
+  def _manifest_signature(self):
+    try:
+      stat = os.stat(os.path.join(self.directory, ab.MANIFEST_NAME))
+    except FileNotFoundError:
+      return None
+    return stat.st_size, stat.st_mtime_ns, stat.st_ino
+
+  def current(self):
+    """ Return the ModelVersion that serves new requests """
+    with self._lock:
+      return self._current
+
+  def poll(self):
+    """ Load, warm up and swap in the bundle if it changed. Return True if a new version was swapped in """
+    signature = self._manifest_signature()
+    if signature is None or signature == self._signature:
+      return False
+    self._signature = signature
+
+    start = time.perf_counter()
+    current = self.current()
+    try:
+      candidate = ModelVersion(ab.ArtifactBundle(self.directory))
+      if candidate.digest == current.digest:
+        return False
+      if candidate.bundle.manifest['schema'] != current.bundle.manifest['schema']:
+        raise ValueError('the feature schema changed, the app must be restarted')
+      candidate.warm_up()
+    except (OSError, ValueError, KeyError) as e:
+      self.rejected += 1
+      tm.log_event('model_rejected', level=logging.ERROR, version=current.version, error=str(e))
+      return False
+
+    with self._lock:
+      self._current = candidate
+      self.swaps += 1
+    tm.log_event('model_swapped', previous=current.version, version=candidate.version, warm_up_ms=round((time.perf_counter() - start) * 1000, 1))
+    return True
+
+  def _watch(self, poll_seconds):
+    while not self._stop.wait(poll_seconds):
+      try:
+        self.poll()
+      except Exception as e: # The watcher must outlive any error, the current version keeps serving
+        tm.log_event('model_watch_error', level=logging.ERROR, error=repr(e))
+
+  def start(self, poll_seconds=DEFAULT_POLL_SECONDS):
+    """ Watch the bundle in a background thread (not if poll_seconds <= 0). Return self """
+    if poll_seconds > 0 and self._thread is None:
+      self._thread = threading.Thread(target=self._watch, args=(poll_seconds,), name='epif-model-registry', daemon=True)
+      self._thread.start()
+    return self
+
+  def stop(self):
+    self._stop.set()
+    if self._thread is not None:
+      self._thread.join()
+      self._thread = None
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Watch the artifact bundle and swap in its new versions.')
+  parser.add_argument('--directory', default=ab.BUNDLE_DIR)
+  parser.add_argument('--poll-seconds', type=float, default=DEFAULT_POLL_SECONDS)
+  args = parser.parse_args(argv)
+
+  tm.configure_logging()
+  registry = ModelRegistry(args.directory)
+  print(f"Serving model version {registry.current().version}, watching '{args.directory}'")
+  registry.start(args.poll_seconds)
+  try:
+    while True:
+      time.sleep(3600)
+  except KeyboardInterrupt:
+    registry.stop()
+
+
+if __name__ == '__main__':
+  main()
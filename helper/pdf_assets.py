@@ -0,0 +1,65 @@
+# Store of the instruction PDFs of the 'Glossary' page.
+# The folder is indexed once per process (file, size, modification time) and every PDF is mapped explicitly to
+# its assessment, not by the order of os.listdir. The bytes of a PDF are read on the first download only and
+# shared by every session; a file replaced on disk (other size or modification time) is read again.
+import os
+import threading
+
+PDFS_DIR = './assets/pdfs'
+# {assessment: PDF file}, in the order of the download buttons
+ASSESSMENT_PDFS = {
+  'BBS': 'BBS_score.pdf',
+  'FICSIT-4': 'FICSIT4_Score.pdf',
+  'Short FES-I': 'Short_FESI_Score.pdf',
+  'TUG': 'TUG_Score.pdf',
+}
+
+
+class PdfAssetStore:
+  """ Thread-safe, mtime-invalidated cache of the PDF files of the assessments """
+
+  def __init__(self, directory=PDFS_DIR, mapping=ASSESSMENT_PDFS):
+    """
+    Keyword argument:
+    directory -- folder of the PDF files
+    mapping   -- {assessment: file name}
+    """
+    self.directory = directory
+    self.mapping = dict(mapping)
+    self._bytes = {} # {file name: ((size, mtime_ns), bytes)}
+    self._lock = threading.Lock()
+    self.reads = 0
+    missing = [name for name in self.mapping.values() if not os.path.isfile(self.path(name))]
+    if missing:
+      raise FileNotFoundError(f"Missing PDF file/s in '{directory}': {', '.join(missing)}")
+
+  def path(self, file_name):
+    return os.path.join(self.directory, file_name)
+
+  def assessments(self):
+    """ Return [(assessment, file name)] in the order of the mapping """
+    return list(self.mapping.items())
+
+  def _signature(self, file_name):
+    stat = os.stat(self.path(file_name))
+    return stat.st_size, stat.st_mtime_ns
+
+  def read(self, file_name):
+    """ Return the bytes of the file, read from disk only if it is new or changed """
+    signature = self._signature(file_name)
+    with self._lock:
+      cached = self._bytes.get(file_name)
+      if cached is not None and cached[0] == signature:
+        return cached[1]
+
+    with open(self.path(file_name), 'rb') as pdf_file:
+      data = pdf_file.read()
+    with self._lock:
+      self._bytes[file_name] = (signature, data)
+      self.reads += 1
+    return data
+
+  def loader(self, assessment):
+    """ Return a callable without arguments that returns the PDF of the assessment (st.download_button's data) """
+    file_name = self.mapping[assessment]
+    return lambda: self.read(file_name)
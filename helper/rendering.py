@@ -0,0 +1,148 @@
+# Rendering of the SHAP plots into image bytes.
+# The waterfall plots are drawn by shap.plots.waterfall itself, the plot the clinicians read. It draws through
+# pyplot's global state (current figure/axes), so the drawing is serialized by a lock and the figure is closed as
+# soon as it has been saved into PNG/SVG bytes: no figure stays registered in pyplot. The bytes are cached by
+# (input hash, class id), so a repeated patient is never drawn twice.
+# The mean |SHAP| bar plots of the 'Data Summary' page are drawn on their own Figure (Agg canvas, no pyplot).
+import io
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+POSITIVE_COLOR = '#ff0051' # Same colors as shap's plots
+DEFAULT_MAXSIZE = 512
+DEFAULT_DPI = 200 # As st.pyplot, which showed the plots before they were cached
+_PYPLOT_LOCK = threading.Lock() # pyplot's current figure is shared by every thread of the process
+
+
+def waterfall_bytes(explanation, max_display=10, figsize=(6, 5), fmt='png', dpi=DEFAULT_DPI):
+  """ Return the waterfall plot of shap (shap.plots.waterfall) of a single explanation as bytes
+
+  Keyword argument:
+  explanation -- shap.Explanation of a single row and class, e.g. shap_values[0, :, class_id]
+  max_display -- number of bars; the least important features are merged into the last bar
+  figsize     -- size of the figure (inches)
+  fmt         -- 'png' or 'svg'
+  dpi         -- resolution of a png
+  """
+  import matplotlib.pyplot as plt
+  import shap
+
+  with _PYPLOT_LOCK:
+    fig = plt.figure(figsize=figsize)
+    try:
+      shap.plots.waterfall(explanation, max_display=max_display, show=False)
+      return figure_bytes(plt.gcf(), fmt=fmt, dpi=dpi)
+    finally:
+      plt.close(fig)
+
+
+def mean_abs_bar_figure(mean_abs_values, feature_names, max_display=15, figsize=(9, 7.5)):
+  """ Return a matplotlib Figure (not registered in pyplot) with the bar plot of the mean |SHAP| of each feature
+
+  Keyword argument:
+  mean_abs_values -- mean(|SHAP value|) of each feature
+  feature_names   -- feature names
+  max_display     -- number of bars; the least important features are summed into the last bar
+  """
+  mean_abs_values = np.asarray(mean_abs_values, dtype=float)
+  order = np.argsort(-mean_abs_values, kind='stable')
+  shown = order[:max_display - 1] if len(mean_abs_values) > max_display else order
+  rest = order[len(shown):]
+
+  labels = [feature_names[i] for i in shown]
+  bars = list(mean_abs_values[shown])
+  if len(rest) > 0:
+    labels.append(f"Sum of {len(rest)} other features")
+    bars.append(mean_abs_values[rest].sum())
+
+  fig = Figure(figsize=figsize)
+  FigureCanvasAgg(fig)
+  ax = fig.add_subplot()
+  ax.set_facecolor('#eaeaf2')
+  ax.grid(color='white', linewidth=1.2)
+  ax.set_axisbelow(True)
+
+  # The most important feature on the top
+  y_positions = np.arange(len(bars))[::-1]
+  ax.barh(y_positions, bars, color=POSITIVE_COLOR, height=0.7)
+  span = max(max(bars), 1e-12)
+  for y, bar in zip(y_positions, bars):
+    ax.text(bar + 0.01 * span, y, f"+{round(bar, 2):g}", va='center', ha='left', color=POSITIVE_COLOR, fontsize=12)
+
+  ax.set_yticks(y_positions, labels, fontsize=13)
+  ax.set_xlabel('mean(|SHAP value|)', fontsize=13)
+  ax.set_xlim(0, span * 1.12)
+  for side in ('right', 'top', 'left', 'bottom'):
+    ax.spines[side].set_visible(False)
+  ax.yaxis.set_ticks_position('none')
+  fig.tight_layout()
+  return fig
+
+
+def figure_bytes(fig, fmt='png', dpi=100):
+  """ Return the figure saved as bytes, the figure is cleared afterwards in any case """
+  try:
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format=fmt, dpi=dpi, bbox_inches='tight')
+    return buffer.getvalue()
+  finally:
+    fig.clear()
+
+
+class WaterfallRenderer:
+  """ Thread-safe LRU cache of rendered waterfall plots, keyed by (input hash, class id, format) """
+
+  def __init__(self, maxsize=DEFAULT_MAXSIZE, max_display=10, figsize=(6, 5), dpi=DEFAULT_DPI):
+    self.maxsize = maxsize
+    self.max_display = max_display
+    self.figsize = figsize
+    self.dpi = dpi
+    self._images = OrderedDict()
+    self._lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+
+  def render(self, input_hash, class_id, explanation, fmt='png', cache=True):
+    """ Return the waterfall plot of the class as bytes
+
+    Keyword argument:
+    input_hash  -- hash of the input vector (e.g. helper.explanation_cache.canonical_key)
+    class_id    -- the explained class
+    explanation -- shap.Explanation of a single row and class, e.g. shap_values[0, :, class_id]
+    fmt         -- 'png' or 'svg'
+    cache       -- False draws the plot without reading or filling the cache, e.g. for an intermediate estimate
+                   that is never requested again
+    """
+    key = (input_hash, class_id, fmt)
+    with self._lock:
+      if cache and key in self._images:
+        self._images.move_to_end(key)
+        self.hits += 1
+        return self._images[key]
+      if cache:
+        self.misses += 1
+
+    # Drawn outside of the cache's lock (shap's drawing has its own)
+    image = waterfall_bytes(explanation, max_display=self.max_display, figsize=self.figsize, fmt=fmt, dpi=self.dpi)
+    if not cache:
+      return image
+
+    with self._lock:
+      self._images[key] = image
+      while len(self._images) > self.maxsize:
+        self._images.popitem(last=False)
+    return image
+
+  def stats(self):
+    """ Return the hit/miss counters and the bytes held by the cache """
+    with self._lock:
+      return {
+        'hits': self.hits,
+        'misses': self.misses,
+        'size': len(self._images),
+        'bytes': sum(len(image) for image in self._images.values())
+      }
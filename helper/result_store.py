@@ -0,0 +1,59 @@
+# Per-session store of the finished predictions (probabilities, SHAP values, what-if curves).
+# A result is keyed on the hash of the inputs it was computed from, so a rerun (an expander, the fall
+# location, going back to previously submitted inputs) redraws it without calling the model, and a result
+# is never shown for inputs that changed since.
+# Standard library only: the hash is computed on every rerun of the inputs, before numpy is imported.
+import hashlib
+import json
+from collections import OrderedDict
+
+DEFAULT_MAXSIZE = 8 # Results kept per session
+DECIMALS = 2 # Same rounding as the inputs of 'Main.py'
+
+
+def input_hash(user_inputs, artifacts_digest=''):
+  """ Return the hash of the inputs of a prediction
+
+  Keyword argument:
+  user_inputs      -- {feature: value} of the form
+  artifacts_digest -- digest of the model artifacts, so a new model does not serve the results of the previous one
+  """
+  canonical = {k: round(float(v), DECIMALS) + 0.0 for k, v in user_inputs.items()} # '+ 0.0' turns -0.0 into 0.0
+  digest = hashlib.sha256(artifacts_digest.encode('utf-8'))
+  digest.update(json.dumps(canonical, sort_keys=True).encode('utf-8'))
+  return digest.hexdigest()
+
+
+class ResultStore:
+  """ LRU of the results of a session, {input hash: result} """
+
+  def __init__(self, maxsize=DEFAULT_MAXSIZE):
+    self.maxsize = maxsize
+    self._results = OrderedDict()
+
+  def __len__(self):
+    return len(self._results)
+
+  def __contains__(self, key):
+    return key in self._results
+
+  def get(self, key):
+    """ Return the result of the inputs' hash or None """
+    if key not in self._results:
+      return None
+    self._results.move_to_end(key)
+    return self._results[key]
+
+  def put(self, key, result):
+    self._results[key] = result
+    self._results.move_to_end(key)
+    while len(self._results) > self.maxsize:
+      self._results.popitem(last=False)
+
+  def pop_oldest(self):
+    """ Drop the least recently used result, return its key """
+    key, _ = self._results.popitem(last=False)
+    return key
+
+  def clear(self):
+    self._results.clear()
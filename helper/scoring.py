@@ -0,0 +1,232 @@
+# Headless scoring of the risk-profile model.
+# The same pipeline as in 'Main.py' is used, but a whole cohort file (.csv or .parquet) is streamed
+# in chunks and each chunk is passed to the model as a single vectorized `predict_proba` call.
+#
+# Usage (from the root folder of the project):
+#   python -m helper.scoring cohort.csv scored.csv --chunksize 10000 --id-column PatientID
+#   python -m helper.scoring cohort.csv scored.csv --interventions   # + codes of the personalised interventions
+# The patients are validated against the input schema of the form first (see helper/input_schema.py).
+import argparse
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+import helper.artifacts as art
+
+RISK_PROFILES = ["Low risk", "Moderate risk", "High risk"]
+CLOSE_CLASSES_THRESHOLD = 0.10 # Classes whose probability is within this distance of the winner are reported as close
+DEFAULT_CHUNKSIZE = 10_000
+
+
+def check_close_classes(winner_prob, probs, threshold=CLOSE_CLASSES_THRESHOLD):
+  """ Return the classes (indexes) whose probability is close to the probability of the winner class
+
+  Keyword argument:
+  winner_prob -- probability of the winner class
+  probs       -- probabilities of every class of a single patient
+  threshold   -- the maximum distance from the winner probability
+  """
+  close_classes = [ c for c, p in enumerate(probs) if ((winner_prob - p) <= threshold) ]
+  return close_classes
+
+
+def close_classes_mask(probs, threshold=CLOSE_CLASSES_THRESHOLD):
+  """ Vectorized version of check_close_classes. Return a boolean (patients x classes) array
+
+  Keyword argument:
+  probs     -- (patients x classes) array of probabilities
+  threshold -- the maximum distance from the winner probability
+  """
+  probs = np.asarray(probs)
+  return (probs.max(axis=1, keepdims=True) - probs) <= threshold
+
+
+def feature_order(model):
+  """ Return the feature names in the order the model was fit to """
+  return list(model[0].get_feature_names_out())
+
+
+def prepare_features(chunk, features, columns_types, schema=None, first_row=0):
+  """ Return a DataFrame with the model's features, in the model's order, ready for `predict_proba`
+
+  Numerical, ordinal and binary features are required. Proportional (fall related) features that are missing
+  are filled with 0.0, exactly as the form does for the options that were not selected.
+  Values are rounded into 2 decimals, as in 'Main.py'.
+
+  Keyword argument:
+  chunk         -- DataFrame of patients
+  features      -- feature names in the model's order
+  columns_types -- the column groups of 'data/columns_types.pkl'
+  schema        -- InputSchema (see helper/input_schema.py) the patients are validated against, raise ValueError
+                   with the first invalid rows (not validated if None)
+  first_row     -- row number of the chunk's first patient in the cohort, for the messages
+  """
+  numerical_columns, ordinal_columns, binary_columns, prop_columns = columns_types
+  if schema is not None:
+    schema.validate(chunk).raise_for_errors(first_row)
+  required_columns = numerical_columns + ordinal_columns + binary_columns
+
+  missing = [col for col in required_columns if col not in chunk.columns]
+  if missing:
+    raise ValueError(f"The cohort has no column/s named: {', '.join(missing)}")
+
+  X = chunk.reindex(columns=features)
+  X[prop_columns] = X[prop_columns].fillna(0.0)
+  X = X.apply(pd.to_numeric, errors='raise').astype(float)
+
+  if X[required_columns].isna().any(axis=None):
+    rows = X.index[X[required_columns].isna().any(axis=1)].tolist()
+    raise ValueError(f"Empty values of required features in rows: {rows[:10]}")
+  return X.round(2)
+
+
+def score_frame(model, X):
+  """ Return the probabilities, the winner class and the close classes of every patient of X
+
+  Keyword argument:
+  model -- the fitted pipeline
+  X     -- DataFrame with the model's features (see prepare_features)
+  """
+  y_pred_proba = model.predict_proba(X)
+  winner_class = np.argmax(y_pred_proba, axis=1)
+  close = close_classes_mask(y_pred_proba)
+
+  scored = pd.DataFrame(y_pred_proba, columns=RISK_PROFILES, index=X.index)
+  scored['winner_class'] = winner_class
+  scored['winner_profile'] = np.asarray(RISK_PROFILES)[winner_class]
+  # e.g. "0|1" when the patient is close to both the Low and the Moderate risk profiles
+  scored['close_classes'] = ['|'.join(map(str, np.flatnonzero(row))) for row in close]
+  return scored
+
+
+def read_cohort(path, chunksize=DEFAULT_CHUNKSIZE):
+  """ Yield the cohort file (.csv or .parquet) in DataFrame chunks of |chunksize| rows """
+  extension = os.path.splitext(path)[1].lower()
+  if extension == '.csv':
+    yield from pd.read_csv(path, chunksize=chunksize)
+  elif extension in ('.parquet', '.pq'):
+    import pyarrow.parquet as pq
+    for batch in pq.ParquetFile(path).iter_batches(batch_size=chunksize):
+      yield batch.to_pandas()
+  else:
+    raise ValueError(f"Unsupported cohort file '{path}'. Only .csv and .parquet files are allowed.")
+
+
+class CohortWriter:
+  """ Append scored chunks into a .csv or .parquet file.
+  The chunks go into a temporary file next to |path|, which replaces |path| on close(): a run that fails half-way
+  (e.g. an invalid chunk) leaves no truncated output behind. Used as a context manager, the chunks are discarded
+  on an exception """
+
+  def __init__(self, path):
+    self.path = path
+    self.extension = os.path.splitext(path)[1].lower()
+    if self.extension not in ('.csv', '.parquet', '.pq'):
+      raise ValueError(f"Unsupported output file '{path}'. Only .csv and .parquet files are allowed.")
+    self._parquet_writer = None
+    self._first_chunk = True
+    self._tmp_path = None
+
+  def write(self, chunk):
+    if self._tmp_path is None:
+      fd, self._tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)), suffix=f'{self.extension}.tmp')
+      os.close(fd)
+    if self.extension == '.csv':
+      chunk.to_csv(self._tmp_path, mode='w' if self._first_chunk else 'a', header=self._first_chunk, index=False)
+    else:
+      import pyarrow as pa
+      import pyarrow.parquet as pq
+      table = pa.Table.from_pandas(chunk, preserve_index=False)
+      if self._parquet_writer is None:
+        self._parquet_writer = pq.ParquetWriter(self._tmp_path, table.schema)
+      self._parquet_writer.write_table(table)
+    self._first_chunk = False
+
+  def close(self):
+    """ Finish the file: it replaces |path| (nothing is written if no chunk was) """
+    if self._parquet_writer is not None:
+      self._parquet_writer.close()
+      self._parquet_writer = None
+    if self._tmp_path is not None:
+      os.replace(self._tmp_path, self.path)
+      self._tmp_path = None
+
+  def discard(self):
+    """ Drop the written chunks, |path| is left as it was """
+    if self._parquet_writer is not None:
+      self._parquet_writer.close()
+      self._parquet_writer = None
+    if self._tmp_path is not None:
+      os.remove(self._tmp_path)
+      self._tmp_path = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    if exc_type is None:
+      self.close()
+    else:
+      self.discard()
+
+
+def score_cohort(input_path, output_path, model=None, columns_types=None, chunksize=DEFAULT_CHUNKSIZE, id_column=None, interventions=False, validate=True):
+  """ Score every patient of the cohort file and write the results. Return the number of scored patients
+
+  Keyword argument:
+  input_path    -- cohort file (.csv or .parquet), one patient per row, columns named as the model's features
+  output_path   -- output file (.csv or .parquet)
+  model         -- the fitted pipeline (loaded from 'model/clf_pipeline.pkl' if None)
+  columns_types -- the column groups (loaded from 'data/columns_types.pkl' if None)
+  chunksize     -- number of patients per `predict_proba` call
+  id_column     -- a column of the cohort that is copied into the output (e.g. the patient id)
+  interventions -- add the codes of the personalised intervention sections of every patient, the fall
+                   location inferred from the fall sites (see helper/intervention_rules.py)
+  validate      -- reject a cohort with values the form does not allow (see helper/input_schema.py)
+  """
+  model = model if model is not None else art.load_model()
+  columns_types = columns_types if columns_types is not None else art.load_columns_types()
+  features = feature_order(model)
+  schema = None
+  if validate:
+    import helper.input_schema as ins
+    schema = ins.build_schema(columns_types)
+  if interventions:
+    import helper.intervention_rules as ir
+    table = ir.DecisionTable.from_files()
+
+  n_scored = 0
+  with CohortWriter(output_path) as writer:
+    for chunk in read_cohort(input_path, chunksize):
+      X = prepare_features(chunk, features, columns_types, schema, first_row=n_scored)
+      scored = score_frame(model, X)
+      if interventions:
+        scored['interventions'] = table.select_codes(scored['winner_class'], ir.location_flags(X))
+      if id_column is not None:
+        scored.insert(0, id_column, chunk[id_column].to_numpy())
+      writer.write(scored)
+      n_scored += len(scored)
+  return n_scored
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Score a cohort of elderly fallers with the EPIF risk-profile model.')
+  parser.add_argument('input', help='cohort file (.csv or .parquet)')
+  parser.add_argument('output', help='output file (.csv or .parquet)')
+  parser.add_argument('--chunksize', type=int, default=DEFAULT_CHUNKSIZE, help='patients per model call')
+  parser.add_argument('--id-column', default=None, help='column copied into the output, e.g. the patient id')
+  parser.add_argument('--interventions', action='store_true', help='add the codes of the personalised intervention sections')
+  parser.add_argument('--no-validate', action='store_true', help='score the values the form does not allow as well (out of range, inconsistent falls)')
+  args = parser.parse_args(argv)
+
+  n_scored = score_cohort(
+    args.input, args.output, chunksize=args.chunksize, id_column=args.id_column, interventions=args.interventions,
+    validate=not args.no_validate
+  )
+  print(f"{n_scored} patients scored into '{args.output}'")
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,283 @@
+# Local HTTP service of the risk-profile model, for other hospital systems.
+# Plain asyncio (no web framework): JSON over HTTP/1.1 with keep-alive.
+#
+# Prediction requests that arrive within a few milliseconds of each other are merged by a MicroBatcher into
+# a single `predict_proba` call (at most --max-batch-size rows, waiting at most --max-wait-ms for the batch
+# to fill). The batch is scored in a worker thread, so the event loop keeps accepting requests meanwhile.
+#
+# Endpoints:
+#   POST /predict  {"patient": {feature: value, ...}}  -> probabilities, winner class, close classes, model version
+#   POST /explain  {"patient": {feature: value, ...}}  -> the above + SHAP values and base values per class
+#   GET  /health                                       -> model version and digest
+#   GET  /stats                                        -> p50/p99 latency, throughput and batch sizes
+#
+# Usage (from the root folder of the project):
+#   python -m helper.service --port 8502 --max-batch-size 64 --max-wait-ms 2
+#   python -m benchmarks.service_load --port 8502 --concurrency 64 --requests 5000
+import argparse
+import asyncio
+import json
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import helper.explanation_cache as ec
+import helper.input_schema as ins
+import helper.model_registry as mr
+import helper.scoring as sc
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8502
+DEFAULT_MAX_BATCH_SIZE = 64
+DEFAULT_MAX_WAIT_MS = 2.0
+LATENCY_WINDOW = 10_000 # Latencies kept for the percentiles
+MAX_BODY_BYTES = 1 << 20
+
+
+class BadRequest(Exception):
+  """ Error of the client's request, answered with HTTP 400 """
+
+
+class MicroBatcher:
+  """ Merge concurrent single-row requests into batched calls of |batch_fn| """
+
+  def __init__(self, batch_fn, max_batch_size=DEFAULT_MAX_BATCH_SIZE, max_wait_ms=DEFAULT_MAX_WAIT_MS, executor=None):
+    """
+    Keyword argument:
+    batch_fn       -- function of a (rows x features) array, returning one result per row
+    max_batch_size -- max rows per call
+    max_wait_ms    -- max time the first request of a batch waits for others
+    executor       -- executor of the calls (a single worker thread if None)
+    """
+    self.batch_fn = batch_fn
+    self.max_batch_size = max_batch_size
+    self.max_wait = max_wait_ms / 1000
+    self.executor = executor or ThreadPoolExecutor(max_workers=1)
+    self.batch_sizes = deque(maxlen=LATENCY_WINDOW)
+    self._queue = None
+    self._task = None
+
+  def start(self):
+    self._queue = asyncio.Queue()
+    self._task = asyncio.get_running_loop().create_task(self._run())
+
+  async def stop(self):
+    self._task.cancel()
+    try:
+      await self._task
+    except asyncio.CancelledError:
+      pass
+
+  async def submit(self, row):
+    """ Return the result of a single row, computed along with the other rows of its batch """
+    future = asyncio.get_running_loop().create_future()
+    await self._queue.put((row, future))
+    return await future
+
+  async def _run(self):
+    loop = asyncio.get_running_loop()
+    while True:
+      batch = [await self._queue.get()]
+      deadline = loop.time() + self.max_wait
+      while len(batch) < self.max_batch_size:
+        timeout = deadline - loop.time()
+        if timeout <= 0:
+          break
+        try:
+          batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+        except asyncio.TimeoutError:
+          break
+
+      rows = np.stack([row for row, _ in batch])
+      self.batch_sizes.append(len(batch))
+      try:
+        results = await loop.run_in_executor(self.executor, self.batch_fn, rows)
+      except Exception as e:
+        for _, future in batch:
+          if not future.done():
+            future.set_exception(e)
+        continue
+      for (_, future), result in zip(batch, results):
+        if not future.done():
+          future.set_result(result)
+
+
+class PredictionService:
+  """ Loads the same artifacts as the app and answers the HTTP requests """
+
+  def __init__(self, max_batch_size=DEFAULT_MAX_BATCH_SIZE, max_wait_ms=DEFAULT_MAX_WAIT_MS):
+    # Memory-mapped arrays of the artifact bundle, shared by the service processes of the machine. New bundles
+    # are swapped in by the registry (see serve); the feature schema never changes meanwhile
+    self.registry = mr.ModelRegistry()
+    bundle = self.registry.current().bundle
+    self.feature_names = bundle.feature_names
+    self.schema = ins.build_schema(bundle.columns_types)
+    self.explanation_cache = ec.ExplanationCache()
+    self.batcher = MicroBatcher(self.score_batch, max_batch_size, max_wait_ms)
+    self.explain_executor = ThreadPoolExecutor(max_workers=2)
+    self.latencies = {'predict': deque(maxlen=LATENCY_WINDOW), 'explain': deque(maxlen=LATENCY_WINDOW)}
+    self.n_requests = 0
+    self.started = time.perf_counter()
+
+  def patient_row(self, payload):
+    """ Return the feature vector (model order) of the request's patient. Missing fall features count as 0.
+    The patient is validated against the input schema of the form (see helper/input_schema.py) """
+    patient = payload.get('patient') if isinstance(payload, dict) else None
+    if not isinstance(patient, dict):
+      raise BadRequest("The body must be a JSON object with a 'patient' object.")
+    try:
+      report = self.schema.validate(patient)
+      if not report.ok:
+        raise BadRequest('; '.join(f"'{field}' {message}" for _, field, message in report.errors()))
+      return np.round([float(patient.get(name, 0.0)) for name in self.feature_names], 2)
+    except (TypeError, ValueError):
+      raise BadRequest('Every feature value must be a number.')
+
+  def score_batch(self, rows):
+    """ Return [(probabilities, model version)] of the rows, all scored by the current model version """
+    model_version = self.registry.current()
+    return [(proba, model_version) for proba in model_version.scorer.predict_proba(rows)]
+
+  def prediction(self, proba, model_version):
+    winner_class = int(np.argmax(proba))
+    return {
+      'probabilities': dict(zip(sc.RISK_PROFILES, map(float, proba))),
+      'winner_class': winner_class,
+      'winner_profile': sc.RISK_PROFILES[winner_class],
+      'close_classes': sc.check_close_classes(proba[winner_class], proba),
+      'model_version': model_version.version,
+      'model_digest': model_version.digest
+    }
+
+  def explain_row(self, row):
+    """ Return (probabilities, SHAP values, base values, model version) of a single row, from the cache when possible """
+    model_version = self.registry.current()
+    key = ec.canonical_key(row, model_version.digest)
+    entry = self.explanation_cache.get(key)
+    if entry is None:
+      values, base_values = model_version.explainer.explain_row(row)
+      entry = {'proba': model_version.scorer.predict_proba(row[None]), 'values': values[None], 'base_values': base_values[None]}
+      self.explanation_cache.put(key, entry)
+    return entry['proba'][0], entry['values'][0], entry['base_values'][0], model_version
+
+  async def handle(self, method, path, body):
+    """ Return (status, JSON response) of a request """
+    if method == 'GET' and path == '/health':
+      model_version = self.registry.current()
+      return 200, {'status': 'ok', 'model_version': model_version.version, 'model_digest': model_version.digest}
+    if method == 'GET' and path == '/stats':
+      return 200, self.stats()
+    if method != 'POST' or path not in ('/predict', '/explain'):
+      return 404, {'error': f'No endpoint {method} {path}'}
+
+    start = time.perf_counter()
+    try:
+      row = self.patient_row(json.loads(body or b'null'))
+    except json.JSONDecodeError:
+      raise BadRequest('The body is not valid JSON.')
+
+    if path == '/predict':
+      response = self.prediction(*await self.batcher.submit(row))
+    else:
+      loop = asyncio.get_running_loop()
+      proba, values, base_values, model_version = await loop.run_in_executor(self.explain_executor, self.explain_row, row)
+      response = self.prediction(proba, model_version)
+      response['base_values'] = dict(zip(sc.RISK_PROFILES, map(float, base_values)))
+      response['shap_values'] = {
+        profile: dict(zip(self.feature_names, map(float, values[:, class_id])))
+        for class_id, profile in enumerate(sc.RISK_PROFILES)
+      }
+    self.latencies[path[1:]].append(time.perf_counter() - start)
+    return 200, response
+
+  def stats(self):
+    """ Return the latency percentiles (ms), the throughput and the batch sizes """
+    elapsed = time.perf_counter() - self.started
+    report = {
+      'requests': self.n_requests,
+      'throughput_rps_since_start': self.n_requests / elapsed if elapsed > 0 else 0.0,
+      'mean_batch_size': float(np.mean(self.batcher.batch_sizes)) if self.batcher.batch_sizes else 0.0,
+      'max_batch_size': self.batcher.max_batch_size,
+      'max_wait_ms': self.batcher.max_wait * 1000
+    }
+    for endpoint, latencies in self.latencies.items():
+      if latencies:
+        p50, p99 = np.percentile(np.asarray(latencies) * 1000, [50, 99])
+        report[f'{endpoint}_latency_ms'] = {'p50': float(p50), 'p99': float(p99), 'count': len(latencies)}
+    return report
+
+  async def serve_connection(self, reader, writer):
+    """ Answer the requests of a keep-alive connection """
+    try:
+      while True:
+        request_line = await reader.readline()
+        if not request_line:
+          break
+        method, path, _ = request_line.decode('latin-1').split(' ', 2)
+        headers = {}
+        while True:
+          line = await reader.readline()
+          if line in (b'\r\n', b'\n', b''):
+            break
+          name, _, value = line.decode('latin-1').partition(':')
+          headers[name.strip().lower()] = value.strip()
+
+        length = int(headers.get('content-length', 0))
+        if length > MAX_BODY_BYTES:
+          status, response = 413, {'error': 'The body is too large.'}
+          body = None
+        else:
+          body = await reader.readexactly(length) if length else b''
+          self.n_requests += 1
+          try:
+            status, response = await self.handle(method, path.split('?')[0], body)
+          except BadRequest as e:
+            status, response = 400, {'error': str(e)}
+          except Exception as e:
+            status, response = 500, {'error': repr(e)}
+
+        payload = json.dumps(response).encode('utf-8')
+        keep_alive = headers.get('connection', '').lower() != 'close' and body is not None
+        writer.write(
+          f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+          f"Content-Type: application/json\r\nContent-Length: {len(payload)}\r\n"
+          f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode('latin-1') + payload
+        )
+        await writer.drain()
+        if not keep_alive:
+          break
+    except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+      pass
+    finally:
+      writer.close()
+
+
+async def serve(host=DEFAULT_HOST, port=DEFAULT_PORT, max_batch_size=DEFAULT_MAX_BATCH_SIZE, max_wait_ms=DEFAULT_MAX_WAIT_MS,
+                model_poll_seconds=mr.DEFAULT_POLL_SECONDS):
+  service = PredictionService(max_batch_size, max_wait_ms)
+  service.registry.start(model_poll_seconds)
+  service.batcher.start()
+  server = await asyncio.start_server(service.serve_connection, host, port)
+  print(f"EPIF service listening on http://{host}:{port} (max batch size {max_batch_size}, max wait {max_wait_ms} ms)")
+  async with server:
+    await server.serve_forever()
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='HTTP service of the EPIF risk-profile model.')
+  parser.add_argument('--host', default=DEFAULT_HOST)
+  parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+  parser.add_argument('--max-batch-size', type=int, default=DEFAULT_MAX_BATCH_SIZE, help='max rows per predict_proba call')
+  parser.add_argument('--max-wait-ms', type=float, default=DEFAULT_MAX_WAIT_MS, help='max wait for a batch to fill')
+  parser.add_argument('--model-poll-seconds', type=float, default=mr.DEFAULT_POLL_SECONDS, help='period of the check for a new model bundle (0: never)')
+  args = parser.parse_args(argv)
+  try:
+    asyncio.run(serve(args.host, args.port, args.max_batch_size, args.max_wait_ms, args.model_poll_seconds))
+  except KeyboardInterrupt:
+    pass
+
+
+if __name__ == '__main__':
+  main()
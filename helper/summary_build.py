@@ -0,0 +1,307 @@
+# Build of the assets of the 'Data Summary' page from the data and the current model:
+#   data/summary/overall_summary.txt              -- statistics of every patient
+#   data/summary/cluster_summary_{0,1,2}.txt      -- statistics of the patients of each risk profile
+#   assets/images/bar_plot_risk_profile_{0,1,2}.png -- mean |SHAP| of each feature, over the patients of the profile
+# The patients of a profile are the ones labelled with it (--label-column), or else the ones the current
+# model assigns to it. The three profiles are built in parallel worker processes.
+#
+# Every output is stamped with the hash of its inputs (the data, the labels, the model and explainer
+# artifacts, the code of the build) in 'data/summary/build_manifest.json', along with the hash of its own
+# content. An output is only rebuilt when a stamp no longer matches, i.e. when one of its inputs changed or the
+# file was edited by hand.
+#
+# The outputs are only built from the patients' data (--data): the committed ones come from the training data,
+# a sample of it (e.g. the background of the explainer) would overwrite them with other statistics.
+#
+# Usage (from the root folder of the project):
+#   python -m helper.summary_build --data training_data.csv --label-column Cluster
+#   python -m helper.summary_build --data training_data.csv         # profiles from the model
+#   python -m helper.summary_build --data training_data.csv --force --jobs 1
+import argparse
+import hashlib
+import json
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import helper.artifacts as art
+import helper.compiled_scorer as cs
+import helper.fast_shap as fs
+import helper.rendering as rd
+import helper.scoring as sc
+import helper.utils as ut
+
+SUMMARY_DIR = './data/summary'
+IMAGES_DIR = './assets/images'
+MANIFEST_PATH = './data/summary/build_manifest.json'
+BUILD_SOURCES = [__file__, rd.__file__] # A change of the code of the build invalidates every output
+DEFAULT_SEED = 0
+N_PROFILES = len(sc.RISK_PROFILES)
+
+# (label, feature) of the rows with mean and standard deviation. None is the number of falls.
+# The labels are the ones of the committed summaries, {label of the profiles: label of the overall summary}
+# differ
+NUMERIC_ROWS = [
+  ('Falls per elder', None),
+  ('Age (Years)', 'Age'),
+  ('Berg Balance Score [Higher=Better]', 'BBS_Score'),
+  ('Four Stage Balance Test Score [Higher=Better]', 'FICSIT4_Score'),
+  ('Total Hospital Admissions', 'HospitalAdmissions'),
+  ('Minimum Days at Hospital ', 'HospDays_min'),
+  ('Pills Per Day (Polypharmacy)', 'PillsPerDay'),
+  ('Physical Activity (1|None, 2|Walk, 3|Intense)', 'PhysicalActivity'),
+  ('Short FESI Score [Higher=Worse]', 'ShortFESI_Score'),
+  ('TUG Test (seconds) [Lower=Better]', 'TUG_Score'),
+]
+OVERALL_LABELS = {
+  'Short FESI Score [Higher=Worse]': 'Short FES (Fear) Score [Higher=Worse]',
+}
+CONDITION_ROWS = [
+  ('Cardiovascular Problems', 'has_CardiovascularProblems'),
+  ('Recent Blood Test', 'has_BloodTest'),
+  ('Balance Deficits', 'has_BalanceDeficitis'),
+  ('Osteoporosis', 'has_Osteoporosis'),
+  ('Diabetes', 'has_Diabetes'),
+  ('Vertigo', 'has_Vertigo'),
+]
+# Share of the falls per option. None is 'Other', the falls of no other option of the group
+FALL_ROWS = {
+  'Fall Sites': [
+    ('Bedroom', 'FallSiteMerged_Bedroom'),
+    ('Bathroom', 'FallSiteMerged_Bathroom'),
+    ('Stairs (In/Out)', 'FallSiteMerged_Stairs'),
+    ('Yard/Balcony', 'FallSiteMerged_YardBalcony'),
+    ('Pavement/Crossing Road', 'FallSiteMerged_PavementRoad'),
+    ('Other', None),
+  ],
+  'Fall Causes': [
+    ('Stumbling', 'FallCause_TrippedOnSomething'),
+    ('Sit/Stand', 'FallCause_UpDownSitting'),
+    ('Dizziness', 'FallCause_Dizzines'),
+    ('Reaching Something on High Position', 'FallCause_ReachingHighObject'),
+    ('Other', None),
+  ],
+  'Fall Times': [
+    ('Morning (Right after waking up)', 'FallTime_InMorning'),
+    ('Daytime (On common activities)', 'FallTime_DuringDay'),
+    ('Evening (Before bed)', 'FallTime_NightBeforeBed'),
+    ('Bedtime (When waking up at night)', 'FallTime_NightAtBed'),
+  ],
+}
+FALL_COUNT_GROUP = 'Fall Times' # Every fall has a time (the group has no 'Other'), so it counts the falls
+
+
+def summary_path(profile=None):
+  """ Return the summary file of a profile, or the overall one if None """
+  name = 'overall_summary.txt' if profile is None else f'cluster_summary_{profile}.txt'
+  return os.path.join(SUMMARY_DIR, name)
+
+
+def bar_plot_path(profile):
+  return os.path.join(IMAGES_DIR, f'bar_plot_risk_profile_{profile}.png')
+
+
+def fall_counts(X):
+  """ Return the number of falls of each patient """
+  columns = [feature for _, feature in FALL_ROWS[FALL_COUNT_GROUP]]
+  return np.rint(X[columns].sum(axis=1).to_numpy() / ut.proportional_weight)
+
+
+def summary_text(X, overall=False):
+  """ Return the summary (markdown with <br> line breaks, as the page shows it) of the patients of X, laid out as
+  the committed summaries
+
+  Keyword argument:
+  X       -- DataFrame of the patients
+  overall -- layout of 'overall_summary.txt' (every patient) instead of the one of the profiles
+  """
+  falls = fall_counts(X)
+  total_falls = falls.sum()
+  if overall:
+    lines = ['<br>', f"• Elders: {len(X)}<br>", f"• Falls: {total_falls:.0f}<br>", '']
+  else:
+    lines = [f"• Elders: {len(X)}<br>", f"• Falls: {total_falls:.0f}<br><br>", '']
+
+  def section(title):
+    return ['', f'##### {title}<br>'] if overall else ['', '<br>', '', f'##### {title}']
+
+  for label, feature in NUMERIC_ROWS:
+    values = falls if feature is None else X[feature].to_numpy(dtype=float)
+    sd = values.std(ddof=1) if len(values) > 1 else 0.0
+    label = OVERALL_LABELS.get(label, label) if overall else label
+    lines.append(f"• {label}: {values.mean():.2f} (M) | {sd:.2f} (SD)<br>")
+
+  lines += section('Health Conditions (presents)')
+  for label, feature in CONDITION_ROWS:
+    lines.append(f"• {label}: {100 * X[feature].mean():.2f}%<br>")
+
+  for group, rows in FALL_ROWS.items():
+    lines += section(group)
+    known = 0.0
+    for label, feature in rows:
+      if feature is None:
+        share = 100 - known
+      else:
+        share = 100 * (X[feature].sum() / ut.proportional_weight) / total_falls if total_falls else 0.0
+        known += share
+      lines.append(f"• {label}: {share:.2f}%<br>")
+  return '\n'.join(lines)
+
+
+def _digest(*parts):
+  digest = hashlib.sha256()
+  for part in parts:
+    digest.update(part if isinstance(part, bytes) else str(part).encode('utf-8'))
+    digest.update(b'\0')
+  return digest.hexdigest()
+
+
+def _write_atomic(path, content):
+  """ Write |content| (str or bytes) into |path| through a temporary file. Return the digest of the content """
+  data = content.encode('utf-8') if isinstance(content, str) else content
+  fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+  try:
+    with os.fdopen(fd, 'wb') as tmp_file:
+      tmp_file.write(data)
+    os.replace(tmp_path, path)
+  except OSError:
+    if os.path.exists(tmp_path):
+      os.remove(tmp_path)
+    raise
+  return hashlib.sha256(data).hexdigest()
+
+
+def _build_profile(job):
+  """ Worker: build the stale outputs of a single profile. Return {path: digest of the content} """
+  profile, X = job['profile'], job['X']
+  built = {}
+  if job['summary']:
+    built[summary_path(profile)] = _write_atomic(summary_path(profile), summary_text(X))
+  if job['bar_plot']:
+    explainer = fs.FastSVCExplainer(cs.CompiledScorer(job['scorer_arrays']), job['background'])
+    rng = np.random.RandomState(job['seed'] + profile)
+    values = np.stack([explainer.explain_row(x, rng=rng)[0][:, profile] for x in X.to_numpy(dtype=float)])
+    fig = rd.mean_abs_bar_figure(np.abs(values).mean(axis=0), list(X.columns))
+    built[bar_plot_path(profile)] = _write_atomic(bar_plot_path(profile), rd.figure_bytes(fig))
+  return built
+
+
+def load_manifest(path=MANIFEST_PATH):
+  if not os.path.exists(path):
+    return {}
+  with open(path, 'r', encoding='utf-8') as manifest_file:
+    return json.load(manifest_file)
+
+
+def is_fresh(manifest, path, stamp):
+  """ Return True if |path| was built from the inputs of |stamp| and was not modified since """
+  entry = manifest.get(path)
+  return (
+    entry is not None
+    and entry['stamp'] == stamp
+    and os.path.exists(path)
+    and art.file_digest(path) == entry['output_digest']
+  )
+
+
+def build(X, labels=None, jobs=N_PROFILES, force=False, seed=DEFAULT_SEED, model=None, explainer=None):
+  """ Rebuild the stale outputs. Return {path: 'built' | 'fresh'}
+
+  Keyword argument:
+  X         -- DataFrame of the patients, the model's features as columns
+  labels    -- risk profile of each patient (predicted by the model if None)
+  jobs      -- worker processes (1 builds in this process)
+  force     -- rebuild every output
+  seed      -- seed of the SHAP permutations
+  model     -- the fitted pipeline (loaded from 'model/clf_pipeline.pkl' if None)
+  explainer -- the SHAP explainer of the app, its background is used (loaded if None)
+  """
+  scorer = cs.CompiledScorer.from_pipeline(model if model is not None else art.load_model())
+  background = (explainer if explainer is not None else art.load_shap_explainer()).masker.data
+  X = X[scorer.feature_names]
+  labels_source = 'labels' if labels is not None else 'model'
+  if labels is None:
+    labels = np.argmax(scorer.predict_proba(X), axis=1)
+  labels = np.asarray(labels, dtype=int)
+
+  code_digest = art.file_digest(*BUILD_SOURCES)
+  data_digest = _digest(np.ascontiguousarray(X.to_numpy(dtype=float)).tobytes(), ','.join(X.columns))
+  labels_digest = _digest(labels_source, labels.tobytes())
+  model_digest = art.file_digest(art.MODEL_PATH, art.SHAP_EXPLAINER_PATH) if labels_source == 'model' else ''
+  shap_digest = _digest(art.file_digest(art.MODEL_PATH, art.SHAP_EXPLAINER_PATH), np.asarray(background, dtype=float).tobytes(), seed)
+
+  stamps = {summary_path(): _digest(code_digest, data_digest)}
+  for profile in range(N_PROFILES):
+    stamps[summary_path(profile)] = _digest(code_digest, data_digest, labels_digest, model_digest, profile)
+    stamps[bar_plot_path(profile)] = _digest(code_digest, data_digest, labels_digest, shap_digest, profile)
+
+  manifest = load_manifest()
+  stale = {path for path, stamp in stamps.items() if force or not is_fresh(manifest, path, stamp)}
+
+  built = {}
+  if summary_path() in stale:
+    built[summary_path()] = _write_atomic(summary_path(), summary_text(X, overall=True))
+
+  jobs_list = []
+  for profile in range(N_PROFILES):
+    job = {
+      'profile': profile,
+      'summary': summary_path(profile) in stale,
+      'bar_plot': bar_plot_path(profile) in stale
+    }
+    if not (job['summary'] or job['bar_plot']):
+      continue
+    X_profile = X[labels == profile]
+    if len(X_profile) == 0:
+      raise ValueError(f"No patient of the profile '{sc.RISK_PROFILES[profile]}', its summary cannot be built.")
+    job.update(X=X_profile, scorer_arrays=scorer.arrays, background=background, seed=seed)
+    jobs_list.append(job)
+
+  if jobs > 1 and len(jobs_list) > 1:
+    with ProcessPoolExecutor(max_workers=min(jobs, len(jobs_list))) as executor:
+      results = list(executor.map(_build_profile, jobs_list))
+  else:
+    results = [_build_profile(job) for job in jobs_list]
+  for result in results:
+    built.update(result)
+
+  for path, output_digest in built.items():
+    manifest[path] = {'stamp': stamps[path], 'output_digest': output_digest}
+  _write_atomic(MANIFEST_PATH, json.dumps(manifest, indent=2, sort_keys=True) + '\n')
+  return {path: 'built' if path in built else 'fresh' for path in stamps}
+
+
+def load_patients(features, path, label_column=None):
+  """ Return (X, labels) of the data file (csv/parquet)
+
+  Keyword argument:
+  features     -- feature names in the model's order
+  path         -- csv/parquet of the patients
+  label_column -- column of the risk profile, no labels if None
+  """
+  data = pd.concat(list(sc.read_cohort(path)), ignore_index=True)
+  labels = data.pop(label_column).to_numpy() if label_column else None
+  return sc.prepare_features(data, features, art.load_columns_types()), labels
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Build the assets of the 'Data Summary' page.")
+  parser.add_argument('--data', required=True, help='csv/parquet of the patients (the training data of the committed outputs)')
+  parser.add_argument('--label-column', default=None, help='column of the risk profile (0, 1, 2); predicted by the model if None')
+  parser.add_argument('--jobs', type=int, default=N_PROFILES, help='worker processes')
+  parser.add_argument('--seed', type=int, default=DEFAULT_SEED)
+  parser.add_argument('--force', action='store_true', help='rebuild every output')
+  args = parser.parse_args(argv)
+
+  model, explainer = art.load_model(), art.load_shap_explainer()
+  X, labels = load_patients(sc.feature_order(model), args.data, args.label_column)
+  results = build(X, labels, jobs=args.jobs, force=args.force, seed=args.seed, model=model, explainer=explainer)
+  for path, status in results.items():
+    print(f"{status:>6}  {path}")
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,227 @@
+# Timing spans of the prediction flow.
+# Every span is recorded into a histogram per stage and logged as a single JSON line (logger 'epif.telemetry'),
+# with the id of the submit it belongs to. The histograms, and the gauges (e.g. the bytes retained by the sessions
+# and the caches, see helper/memory_accounting.py), are exported in the Prometheus text format, into a file and/or
+# on a small HTTP endpoint:
+#   EPIF_METRICS_FILE=<path>  -- the file is rewritten after every submit
+#   EPIF_METRICS_PORT=<port>  -- GET http://127.0.0.1:<port>/metrics
+#   EPIF_LOG_LEVEL=<level>    -- level of the structured logs (INFO by default, WARNING hides the spans)
+# Standard library only, so it can be imported along with the page without delaying it.
+import contextlib
+import contextvars
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import uuid
+from bisect import bisect_left
+
+# Upper bounds (s) of the histogram buckets, the last one (+Inf) is implicit
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRIC_PREFIX = 'epif'
+
+logger = logging.getLogger('epif.telemetry')
+_submit_id = contextvars.ContextVar('epif_submit_id', default=None)
+
+
+class Histogram:
+  """ Cumulative histogram of durations (s), as a Prometheus histogram """
+
+  def __init__(self, buckets=DEFAULT_BUCKETS):
+    self.buckets = tuple(buckets)
+    self.counts = [0] * (len(self.buckets) + 1) # The last one is +Inf
+    self.sum = 0.0
+    self.count = 0
+
+  def observe(self, value):
+    self.counts[bisect_left(self.buckets, value)] += 1
+    self.sum += value
+    self.count += 1
+
+  def cumulative_counts(self):
+    """ Return [(upper bound, count of the values <= upper bound)], '+Inf' included """
+    bounds = [_format_bound(bound) for bound in self.buckets] + ['+Inf']
+    cumulative, total = [], 0
+    for bound, count in zip(bounds, self.counts):
+      total += count
+      cumulative.append((bound, total))
+    return cumulative
+
+
+def _format_bound(bound):
+  return repr(float(bound))
+
+
+class Telemetry:
+  """ Thread-safe registry of the stage histograms and the error counters """
+
+  def __init__(self, buckets=DEFAULT_BUCKETS):
+    self.buckets = tuple(buckets)
+    self._histograms = {}
+    self._errors = {}
+    self._gauges = {} # {(name, help): {labels: value}}
+    self._lock = threading.Lock()
+
+  def observe(self, stage, seconds):
+    """ Record a duration (s) of the stage """
+    with self._lock:
+      if stage not in self._histograms:
+        self._histograms[stage] = Histogram(self.buckets)
+      self._histograms[stage].observe(seconds)
+
+  def count_error(self, stage):
+    with self._lock:
+      self._errors[stage] = self._errors.get(stage, 0) + 1
+
+  def set_gauge(self, name, help, value, **labels):
+    """ Set a gauge, e.g. the bytes retained by a cache
+
+    Keyword argument:
+    name   -- name of the metric, without the 'epif_' prefix
+    help   -- description of the metric
+    value  -- current value
+    labels -- labels of the value (low cardinality: not a session or a patient)
+    """
+    with self._lock:
+      self._gauges.setdefault((name, help), {})[tuple(sorted(labels.items()))] = value
+
+  @contextlib.contextmanager
+  def span(self, stage, **fields):
+    """ Time the block: the duration goes into the stage's histogram and a structured log line
+
+    Keyword argument:
+    stage  -- name of the stage, the label of the histogram
+    fields -- extra fields of the log line only (e.g. class_id), so the metrics keep a low cardinality
+    """
+    status = 'ok'
+    start = time.perf_counter()
+    try:
+      yield
+    except Exception: # Not the control flow of Streamlit (st.rerun, st.stop), which derives from BaseException
+      status = 'error'
+      self.count_error(stage)
+      raise
+    finally:
+      duration = time.perf_counter() - start
+      self.observe(stage, duration)
+      if logger.isEnabledFor(logging.INFO):
+        log_event('span', stage=stage, duration_ms=round(duration * 1000, 3), status=status, **fields)
+
+  @contextlib.contextmanager
+  def submit(self, **fields):
+    """ Time a whole submit ('submit' stage); the spans inside it are logged with the same submit_id """
+    submit_id = uuid.uuid4().hex[:12]
+    with bind_submit(submit_id), self.span('submit', **fields):
+      yield submit_id
+
+  def totals(self):
+    """ Return {stage: (count, total seconds)} """
+    with self._lock:
+      return {stage: (histogram.count, histogram.sum) for stage, histogram in self._histograms.items()}
+
+  def render_prometheus(self):
+    """ Return the metrics in the Prometheus text exposition format """
+    with self._lock:
+      histograms = {stage: (histogram.cumulative_counts(), histogram.sum, histogram.count) for stage, histogram in self._histograms.items()}
+      errors = dict(self._errors)
+      gauges = {key: dict(values) for key, values in self._gauges.items()}
+
+    name = f'{METRIC_PREFIX}_stage_duration_seconds'
+    lines = [f'# HELP {name} Duration of each stage of the prediction flow.', f'# TYPE {name} histogram']
+    for stage in sorted(histograms):
+      cumulative, total, count = histograms[stage]
+      for bound, bound_count in cumulative:
+        lines.append(f'{name}_bucket{{stage="{stage}",le="{bound}"}} {bound_count}')
+      lines.append(f'{name}_sum{{stage="{stage}"}} {total!r}')
+      lines.append(f'{name}_count{{stage="{stage}"}} {count}')
+
+    name = f'{METRIC_PREFIX}_stage_errors_total'
+    lines += [f'# HELP {name} Stages that raised an exception.', f'# TYPE {name} counter']
+    for stage in sorted(errors):
+      lines.append(f'{name}{{stage="{stage}"}} {errors[stage]}')
+
+    for (gauge, help), values in sorted(gauges.items()):
+      name = f'{METRIC_PREFIX}_{gauge}'
+      lines += [f'# HELP {name} {help}', f'# TYPE {name} gauge']
+      for labels, value in sorted(values.items()):
+        label_text = ','.join(f'{label}="{label_value}"' for label, label_value in labels)
+        lines.append(f'{name}{{{label_text}}} {value!r}' if label_text else f'{name} {value!r}')
+    return '\n'.join(lines) + '\n'
+
+  def write_prometheus(self, path):
+    """ Write the metrics into |path| (through a temporary file, so a scraper never reads half of it) """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+      with os.fdopen(fd, 'w', encoding='utf-8') as tmp_file:
+        tmp_file.write(self.render_prometheus())
+      os.replace(tmp_path, path)
+    except OSError:
+      if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+      raise
+
+  def serve(self, port, host='127.0.0.1'):
+    """ Serve GET /metrics on a daemon thread and return the server """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    registry = self
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+      def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+          self.send_error(404)
+          return
+        payload = registry.render_prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+      def log_message(self, format, *args):
+        pass # Scrapes are not logged
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='epif-metrics', daemon=True).start()
+    return server
+
+
+@contextlib.contextmanager
+def bind_submit(submit_id):
+  """ Log the spans of the block with |submit_id| (e.g. the rendering of a prediction, on a later rerun) """
+  token = _submit_id.set(submit_id)
+  try:
+    yield
+  finally:
+    _submit_id.reset(token)
+
+
+def log_event(event, level=logging.INFO, **fields):
+  """ Log a single JSON line {'ts', 'event', 'submit_id', **fields} """
+  record = {'ts': round(time.time(), 3), 'event': event}
+  submit_id = _submit_id.get()
+  if submit_id is not None:
+    record['submit_id'] = submit_id
+  record.update(fields)
+  logger.log(level, json.dumps(record, default=str))
+
+
+def configure_logging(level=None):
+  """ Send the structured logs to stderr, one JSON object per line (once per process) """
+  if not logger.handlers:
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(handler)
+    logger.propagate = False
+  logger.setLevel(level or os.environ.get('EPIF_LOG_LEVEL', 'INFO').upper())
+
+
+# Registry of the process, shared by every session of the app
+REGISTRY = Telemetry()
+
+
+def span(stage, **fields):
+  """ Span of the process registry (see Telemetry.span) """
+  return REGISTRY.span(stage, **fields)
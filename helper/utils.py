@@ -85,4 +85,17 @@ widgets_key_names = [
  'TUG_Score',
  'has_Diabetes',
  'has_Vertigo',
- ]
\ No newline at end of file
+ ]
+
+# Limits of the other numerical and ordinal widgets of 'Main.py' (see also 'functional_test_data').
+# HospDays_min and HospitalAdmissions are aggregated from the 'Days of hospitalization' of the fall cards
+feature_ranges = {
+  'Age': {'type': 'int', 'min': 65, 'max': 80},
+  'PillsPerDay': {'type': 'int', 'min': 0, 'max': 5},
+  'PhysicalActivity': {'type': 'int', 'min': 1, 'max': 3},
+  'HospDays_min': {'type': 'int', 'min': 0, 'max': 20},
+  'HospitalAdmissions': {'type': 'int', 'min': 0, 'max': 5},
+}
+
+max_falls = 5 # Fall cards of the form (falls of the last 12 months)
+proportional_weight = 0.2 # Every fall adds it to the selected option of each group of 'prop_columns'
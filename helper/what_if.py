@@ -0,0 +1,70 @@
+# "What-if" sensitivity sweeps of the current patient.
+# Every variant row (one input changed across its whole allowed range, the rest unchanged) is built at once
+# with NumPy and all of them are scored with a single `predict_proba` call.
+import numpy as np
+import pandas as pd
+
+import helper.utils as ut
+import helper.scoring as sc
+
+# Allowed range of each input that can be swept: (min, max, step), same limits as the widgets of 'Main.py'
+SWEEP_RANGES = {
+  **{column: (ut.feature_ranges[column]['min'], ut.feature_ranges[column]['max'], 1) for column in ['Age', 'PillsPerDay', 'PhysicalActivity']},
+  **{
+    column: (ut.functional_test_data['min'][i], ut.functional_test_data['max'][i], ut.functional_test_data['step'][i])
+    for i, column in enumerate(ut.functional_test_data['column'])
+  }
+}
+
+
+def sweep_values(feature):
+  """ Return every allowed value of the feature, rounded into 2 decimals as the form does """
+  if feature not in SWEEP_RANGES:
+    raise ValueError(f"'{feature}' can not be swept. Allowed features: {', '.join(SWEEP_RANGES)}")
+  min_value, max_value, step = SWEEP_RANGES[feature]
+  n_values = int(round((max_value - min_value) / step)) + 1
+  return np.round(min_value + step * np.arange(n_values), 2)
+
+
+def build_variants(input_row_df, features):
+  """ Return (variants DataFrame, swept feature per row, swept value per row) for every value of every feature
+
+  Keyword argument:
+  input_row_df -- single row DataFrame of the patient
+  features     -- the features to sweep
+  """
+  row = input_row_df.to_numpy(dtype=float)[0]
+  columns = list(input_row_df.columns)
+  values = [sweep_values(feature) for feature in features]
+  sizes = [len(v) for v in values]
+
+  variants = np.tile(row, (sum(sizes), 1))
+  swept_feature = np.repeat(np.asarray(features, dtype=object), sizes)
+  swept_value = np.concatenate(values)
+  offsets = np.concatenate([[0], np.cumsum(sizes)])
+  for feature, start, end in zip(features, offsets[:-1], offsets[1:]):
+    variants[start:end, columns.index(feature)] = swept_value[start:end]
+  return pd.DataFrame(variants, columns=columns), swept_feature, swept_value
+
+
+def sweep(model, input_row_df, features=None):
+  """ Return {feature: DataFrame of the probabilities (index: the feature value, columns: risk profiles)}
+
+  Keyword argument:
+  model        -- the fitted pipeline or a scorer with the same predict_proba (helper.compiled_scorer)
+  input_row_df -- single row DataFrame of the patient
+  features     -- the features to sweep (every feature of SWEEP_RANGES if None)
+  """
+  features = list(features if features is not None else SWEEP_RANGES)
+  variants_df, swept_feature, swept_value = build_variants(input_row_df, features)
+  y_pred_proba = model.predict_proba(variants_df) # One batched call for every variant
+
+  curves = {}
+  for feature in features:
+    rows = swept_feature == feature
+    curves[feature] = pd.DataFrame(
+      y_pred_proba[rows],
+      columns=sc.RISK_PROFILES,
+      index=pd.Index(swept_value[rows], name=feature)
+    )
+  return curves
@@ -1,6 +1,7 @@
 import streamlit as st
 import json
-import os
+import helper.pdf_assets as pdf
+import helper.content_index as ci
 from streamlit_configuration import page_config as pc
 
 # Page configuration
@@ -13,9 +14,23 @@ def load_glossary():
   with open('./data/glossary.json', 'r', encoding="utf-8") as glossary_file:
     return json.load(glossary_file)
 
+# Search index of the FAQs, the glossary and the interventions, shared by both pages and every session
+load_content_index = st.cache_resource(ci.load_content_index)
+
+# The search reruns on its own, the rest of the page is not redrawn for every query
+@st.fragment
+def search_section():
+  ci.render_search(load_content_index(), key='glossary_search')
+
+# PDFs of the assessments, shared by every session
+@st.cache_resource
+def load_pdf_store():
+  return pdf.PdfAssetStore()
+
 
 # "Risk factors section"
 st.header("Risk factors", divider="gray", text_alignment="center")
+search_section()
 
 st.markdown("For clinical risk factors a ***yes*** or ***no*** response is asked for.")
 st.markdown("For functional assessments, demographic information and environmental factors of falls, predefined range of values is set.")
@@ -60,25 +75,18 @@ st.space()
 # "Guidlines of functional and psychological tests" section
 st.caption("Instructions to evaluate correctly the functional and psychological assessments")
 
-assessment_names_list = ["BBS", "FICSIT-4", "Short FES-I", "TUG"]
-
-assets_path = "./assets/pdfs/"
-folder_files = os.listdir(assets_path) # Get the files of the folder path
-pdf_list = [f for f in folder_files if f.lower().endswith('.pdf')] # Filter for files that end with .pdf
+# The PDFs are indexed once per process and read on the first download only (see helper/pdf_assets.py)
+pdf_store = load_pdf_store()
 
 # Create the download buttons
-for j in range(len(pdf_list)):
-  with open(f"{assets_path}{pdf_list[j]}", "rb") as f:
-  # Read and return the data of .pdf files
-    pdf_data = f.read()
-  
+for assessment, file_name in pdf_store.assessments():
   st.download_button(
-    label=f"Download :blue-background[{assessment_names_list[j]}] Instructions",
-    data=pdf_data,
-    file_name=f"{pdf_list[j]}",
+    label=f"Download :blue-background[{assessment}] Instructions",
+    data=pdf_store.loader(assessment), # Called on click, the page does not read the file
+    file_name=file_name,
     mime="application/pdf",
-    key=f"{pdf_list[j]}",
+    key=file_name,
     on_click="ignore",
     type="tertiary",
     icon=":material/download:"
-  )
\ No newline at end of file
+  )
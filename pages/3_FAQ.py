@@ -1,5 +1,6 @@
 import streamlit as st
 import json
+import helper.content_index as ci
 
 from streamlit_configuration import page_config as pc
 
@@ -13,11 +14,20 @@ def load_FAQs():
   with open('./data/faqs.json', 'r', encoding="utf-8") as faqs_file:
     return json.load(faqs_file)
 
+# Search index of the FAQs, the glossary and the interventions, shared by both pages and every session
+load_content_index = st.cache_resource(ci.load_content_index)
+
+# The search reruns on its own, the list below is not redrawn for every query
+@st.fragment
+def search_section():
+  ci.render_search(load_content_index(), key='faq_search')
+
 faqs = load_FAQs()
 
 
 # FAQs section
 st.header("Frequently Asked Questions", divider="gray", text_alignment="center")
+search_section()
 
 # print(faqs.types)
 # Create faqs display page
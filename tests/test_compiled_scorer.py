@@ -0,0 +1,47 @@
+# Parity of the NumPy scorer (helper/compiled_scorer.py) with the pickled pipeline 'model/clf_pipeline.pkl'.
+#
+# Usage (from the root folder of the project):
+#   python -m pytest tests
+import numpy as np
+import pandas as pd
+import pytest
+
+import helper.artifacts as art
+import helper.compiled_scorer as cs
+from benchmarks import synthetic
+
+
+@pytest.fixture(scope='module')
+def model():
+  return art.load_model()
+
+
+@pytest.fixture(scope='module')
+def scorer(model):
+  return cs.CompiledScorer.from_pipeline(model)
+
+
+@pytest.fixture(scope='module')
+def background(scorer):
+  return pd.DataFrame(art.load_shap_explainer().masker.data, columns=scorer.feature_names)
+
+
+def test_background_rows(scorer, model, background):
+  assert cs.check_parity(scorer, model, background) <= cs.PARITY_TOLERANCE
+
+
+def test_synthetic_patients(scorer, model):
+  X = synthetic.generate_patients(2_000, seed=1)[scorer.feature_names]
+  assert cs.check_parity(scorer, model, X) <= cs.PARITY_TOLERANCE
+
+
+def test_perturbed_rows(scorer, model, background):
+  # Around the background and off the grid of the widgets, so every pair of classes is crossed
+  rng = np.random.default_rng(0)
+  rows = background.to_numpy()[rng.integers(len(background), size=2_000)] + rng.normal(0, 0.5, (2_000, background.shape[1]))
+  assert cs.check_parity(scorer, model, pd.DataFrame(rows, columns=scorer.feature_names)) <= cs.PARITY_TOLERANCE
+
+
+def test_single_row(scorer, model, background):
+  row = background.iloc[0].to_dict()
+  np.testing.assert_allclose(scorer.predict_proba(row), model.predict_proba(pd.DataFrame([row])), rtol=0, atol=cs.PARITY_TOLERANCE)